@@ -146,6 +146,14 @@ function FleetCommanderDbusClient(readycb, errorcb) {
     ).fail(errorhandler);
   }
 
+  this.GetProfilesFull = function(cb, errcb) {
+    self._proxy.GetProfilesFull().done(
+      function(resp) {
+        cb(JSON.parse(resp));
+      }
+    ).fail(errorhandler);
+  }
+
   this.DeleteProfile = function(uid, cb, errcb) {
     self._proxy.DeleteProfile(uid).done(
       function(resp) {
@@ -154,6 +162,14 @@ function FleetCommanderDbusClient(readycb, errorcb) {
     ).fail(errorhandler);
   }
 
+  this.RefreshProfiles = function(cb, errcb) {
+    self._proxy.RefreshProfiles().done(
+      function(resp) {
+        cb(JSON.parse(resp));
+      }
+    ).fail(errorhandler);
+  }
+
   this.SaveProfile = function(data, cb, errcb) {
     self._proxy.SaveProfile(JSON.stringify(data)).done(
       function(resp) {
@@ -162,6 +178,22 @@ function FleetCommanderDbusClient(readycb, errorcb) {
     ).fail(errorhandler);
   }
 
+  this.CheckProfileTargets = function(data, cb, errcb) {
+    self._proxy.CheckProfileTargets(JSON.stringify(data)).done(
+      function(resp) {
+        cb(JSON.parse(resp));
+      }
+    ).fail(errorhandler);
+  }
+
+  this.SearchDirectory = function(kind, text, cb, errcb) {
+    self._proxy.SearchDirectory(kind, text).done(
+      function(resp) {
+        cb(JSON.parse(resp));
+      }
+    ).fail(errorhandler);
+  }
+
   // Favourites management methods
   this.HighlightedApps = function(data, uid, cb, errcb) {
     self._proxy.HighlightedApps(JSON.stringify(data), uid).done(
@@ -204,6 +236,15 @@ function FleetCommanderDbusClient(readycb, errorcb) {
     ).fail(errorhandler);
   }
 
+  this.SessionSaveFromRevision = function(uid, revision, changesets, cb, errcb) {
+    self._proxy.SessionSaveFromRevision(
+      uid, revision, JSON.stringify(changesets)).done(
+      function(resp) {
+        cb(JSON.parse(resp));
+      }
+    ).fail(errorhandler);
+  }
+
   this.IsSessionActive = function(uid, cb, errcb) {
     uid = uid || '';
     self._proxy.IsSessionActive(uid).done(
@@ -23,6 +23,7 @@ var _ = cockpit.gettext
 var fc = null;
 var currentuid = null;
 var currentprofile = null;
+var currentrevision = null;
 var state = {
   debuglevel: 'info',
   defaults: {
@@ -244,6 +245,7 @@ function refreshProfileList(cb) {
 function showAddProfile() {
   // Clear current profile
   currentprofile = null;
+  currentrevision = null;
   // Clear form data before show
   $('#profile-name').val('');
   $('#profile-desc').val('');
@@ -263,6 +265,7 @@ function editProfile(uid) {
     if (resp.status) {
       currentuid = uid;
       currentprofile = resp.data
+      currentrevision = resp.revision
 
       $('#profile-name').val(resp.data.name);
       $('#profile-desc').val(resp.data.description || '');
@@ -353,6 +356,7 @@ function selectDomain() {
   $('#domain-selection-modal').modal('hide');
   sessionStorage.setItem("fc.session.domain", $(this).attr('data-uuid'));
   sessionStorage.setItem("fc.session.profile_uid", currentuid);
+  sessionStorage.setItem("fc.session.profile_revision", currentrevision || '');
   showSpinnerDialog(
     _('Starting live session. Please wait...'))
   setTimeout(function(){
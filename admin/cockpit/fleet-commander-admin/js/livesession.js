@@ -190,11 +190,21 @@ function deployProfile() {
 
   stopLiveSession(function () {
     var uid = sessionStorage.getItem("fc.session.profile_uid");
+    var revision = sessionStorage.getItem("fc.session.profile_revision") || '';
     DEBUG > 0 && console.log('FC: Saving live session settings')
-    fc.SessionSave(uid, changesets, function(resp){
+    fc.SessionSaveFromRevision(uid, revision, changesets, function(resp){
         if (resp.status) {
           DEBUG > 0 && console.log('FC: Saved live session settings')
-          location.href='index.html'
+          if (resp.conflicts.length) {
+            DEBUG > 0 && console.log(
+              'FC: Conflicting changes saved meanwhile', resp.conflicts)
+            $('#spinner-dialog-modal').modal('hide');
+            showSessionConflicts(resp.conflicts, function() {
+              location.href='index.html'
+            });
+          } else {
+            location.href='index.html'
+          }
         } else {
           showMessageDialog(_('Error saving session'), _('Error'));
           $('#spinner-dialog-modal').modal('hide');
@@ -205,6 +215,24 @@ function deployProfile() {
   });
 }
 
+function showSessionConflicts(conflicts, closecb) {
+  // Settings changed both in this session and by others meanwhile
+  var list = $('<ul></ul>');
+  $.each(conflicts, function(i, conflict) {
+    $('<li></li>')
+      .append($('<strong></strong>').text(conflict.key))
+      .append(' (' + $('<span></span>').text(conflict.namespace).html() + ')')
+      .appendTo(list);
+  });
+  var message = $('<div></div>')
+    .append($('<p></p>').text(
+      _('Settings were saved, but these ones were also changed by ' +
+        'another session since this one started. Please review them ' +
+        'in the profile:')))
+    .append(list);
+  showMessageDialog(message.html(), _('Conflicting changes'), closecb);
+}
+
 $(document).ready (function () {
   $('#close-live-session').click(stopLiveSession);
   $('#review-changes').click(reviewAndSubmit);
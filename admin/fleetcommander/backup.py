@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4 sw=4 sts=4
+
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+"""
+Bulk export and import of desktop profiles
+
+Profiles are exported as newline delimited JSON. Each line holds one
+profile with its rule, as returned by FreeIPAConnector.get_profile():
+
+    {"description":"...","groups":[...],"hostgroups":[...],"hosts":[...],
+     "name":"...","priority":50,"settings":{...},"users":[...]}
+
+Imports can be resumed. The names of imported profiles are appended to a
+state file, and profiles found there are skipped when the import is run
+again. Usage:
+
+    python -m fleetcommander.backup export --output profiles.ndjson
+    python -m fleetcommander.backup import profiles.ndjson --state state
+"""
+
+import os
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+
+PROFILE_KEYS = (
+    'name', 'description', 'priority', 'settings',
+    'users', 'groups', 'hosts', 'hostgroups',
+)
+
+DEFAULT_WORKERS = 4
+DEFAULT_CHUNK_SIZE = 50
+
+
+def dump_profile(profile):
+    return json.dumps(profile, sort_keys=True, separators=(',', ':'))
+
+
+def export_profiles(ipa, fd, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes all profiles to given file as newline delimited JSON
+
+    Profiles are fetched chunk_size at a time, so only those are held in
+    memory. Returns the number of exported profiles.
+    """
+    count = 0
+    for profile in ipa.iter_profiles(chunk_size):
+        fd.write(dump_profile(profile))
+        fd.write('\n')
+        count += 1
+    return count
+
+
+def read_profiles(fd):
+    """
+    Iterates over the profiles in a newline delimited JSON file
+
+    ValueError is raised for lines not holding a valid profile.
+    """
+    for lineno, line in enumerate(fd, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            profile = json.loads(line)
+        except ValueError, e:
+            raise ValueError('Invalid JSON at line %s: %s' % (lineno, e))
+        if not isinstance(profile, dict):
+            raise ValueError('Expecting profile object at line %s' % lineno)
+        missing = [key for key in PROFILE_KEYS if key not in profile]
+        if missing:
+            raise ValueError('Missing %s at line %s' % (
+                ', '.join(missing), lineno))
+        yield profile
+
+
+class ProfileImporter(object):
+    """
+    Imports profiles into IPA using several threads
+
+    New profiles are created in chunks, each of them sent in batch
+    requests. Existing profiles are updated one by one. The import is
+    aborted if existing profiles can not be listed.
+    """
+
+    def __init__(self, ipa, workers=DEFAULT_WORKERS,
+                 chunk_size=DEFAULT_CHUNK_SIZE, state_file=None):
+        self.ipa = ipa
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.state_file = state_file
+
+    def load_state(self):
+        """
+        Returns the names of profiles imported by previous runs
+        """
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return set()
+        with open(self.state_file, 'r') as fd:
+            names = set([json.loads(line) for line in fd if line.strip()])
+        return names
+
+    def _get_chunks(self, profiles, imported, existing, report):
+        created = []
+        for profile in profiles:
+            name = profile['name']
+            if name in imported:
+                report['skipped'] += 1
+            elif name in existing:
+                yield 'update', [profile]
+            else:
+                created.append(profile)
+                if len(created) == self.chunk_size:
+                    yield 'create', created
+                    created = []
+        if created:
+            yield 'create', created
+
+    def _import_chunk(self, chunk):
+        action, profiles = chunk
+        if action == 'create':
+            failed = self.ipa.create_profiles(profiles)
+        else:
+            failed = {}
+            for profile in profiles:
+                try:
+                    self.ipa.save_profile(profile)
+                except Exception, e:
+                    failed[profile['name']] = '%s' % e
+        return action, profiles, failed
+
+    def run(self, profiles):
+        """
+        Imports given profiles. Returns a report with the number of created,
+        updated and skipped profiles and the errors of failed ones
+        """
+        report = {'created': 0, 'updated': 0, 'skipped': 0, 'failed': {}}
+        imported = self.load_state()
+        existing = set(self.ipa.get_profile_names())
+        state = None
+        if self.state_file is not None:
+            state = open(self.state_file, 'a')
+        pool = ThreadPool(self.workers)
+        try:
+            chunks = self._get_chunks(profiles, imported, existing, report)
+            for action, profiles, failed in pool.imap_unordered(
+                    self._import_chunk, chunks):
+                report['failed'].update(failed)
+                for profile in profiles:
+                    if profile['name'] in failed:
+                        continue
+                    report[action + 'd'] += 1
+                    if state is not None:
+                        state.write(json.dumps(profile['name']) + '\n')
+                if state is not None:
+                    state.flush()
+                logging.debug(
+                    'Imported %s profiles' % (
+                        report['created'] + report['updated']))
+        finally:
+            pool.close()
+            pool.join()
+            if state is not None:
+                state.close()
+        return report
+
+
+if __name__ == '__main__':
+
+    # Python imports
+    import sys
+    from argparse import ArgumentParser
+
+    # Fleet commander imports
+    from utils import parse_config
+    from fcfreeipa import FreeIPAConnector
+
+    parser = ArgumentParser(description='Fleet Commander profiles backup')
+    parser.add_argument(
+        '--configuration', action='store', metavar='CONFIGFILE', default=None,
+        help='Provide a configuration file path')
+    subparsers = parser.add_subparsers(dest='command')
+    export_parser = subparsers.add_parser(
+        'export', help='Export all profiles')
+    export_parser.add_argument(
+        '--output', action='store', default=None,
+        help='Write profiles to given file instead of standard output')
+    import_parser = subparsers.add_parser(
+        'import', help='Import profiles from a file')
+    import_parser.add_argument(
+        'input', action='store', help='Exported profiles file')
+    import_parser.add_argument(
+        '--state', action='store', default=None,
+        help='File recording imported profiles to resume the import')
+    import_parser.add_argument(
+        '--workers', action='store', type=int, default=DEFAULT_WORKERS,
+        help='Number of threads importing profiles (default: %s)' % (
+            DEFAULT_WORKERS))
+    import_parser.add_argument(
+        '--chunk-size', action='store', type=int, default=DEFAULT_CHUNK_SIZE,
+        help='Number of profiles created at once (default: %s)' % (
+            DEFAULT_CHUNK_SIZE))
+
+    args = parser.parse_args()
+    config = parse_config(args.configuration)
+
+    logging.basicConfig(
+        level=config['log_level'].upper(), format=config['log_format'])
+
+    compression_threshold = config['profile_data_compression_threshold']
+    if compression_threshold in (None, ''):
+        compression_threshold = None
+    else:
+        compression_threshold = int(compression_threshold)
+    ipa = FreeIPAConnector(
+        compression_threshold=compression_threshold,
+        chunk_size=int(config['profile_data_chunk_size']))
+
+    if args.command == 'export':
+        if args.output is None:
+            count = export_profiles(ipa, sys.stdout)
+        else:
+            with open(args.output, 'w') as fd:
+                count = export_profiles(ipa, fd)
+        logging.info('Exported %s profiles' % count)
+    else:
+        with open(args.input, 'r') as fd:
+            importer = ProfileImporter(
+                ipa, args.workers, args.chunk_size, args.state)
+            report = importer.run(read_profiles(fd))
+        print json.dumps(report, indent=2, sort_keys=True)
+        if report['failed']:
+            sys.exit(1)
@@ -19,10 +19,117 @@
 # Authors: Alberto Ruiz <aruiz@redhat.com>
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
+import sys
+import time
+import logging
+import threading
 import sqlite3
 import json
+import marshal
+import zlib
+from contextlib import contextmanager
+
+import constants
+
+SCHEMA_VERSION = 3.0
+
+# Pragmas applied to database connections for each storage profile
+STORAGE_PROFILES = {
+    # Rollback journal with full synchronization on every commit
+    'safe': [
+        ('journal_mode', 'DELETE'),
+        ('synchronous', 'FULL'),
+        ('busy_timeout', 5000),
+    ],
+    # Write ahead log, synchronized only on checkpoints
+    'wal': [
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('mmap_size', 64 * 1024 * 1024),
+        ('busy_timeout', 5000),
+    ],
+}
+
+DEFAULT_STORAGE_PROFILE = constants.DEFAULT_DATABASE_STORAGE_PROFILE
+
+
+class JSONCodec(object):
+    """
+    Serializes values as JSON text
+    """
+    NAME = 'json'
+
+    def encode(self, data):
+        return json.dumps(data)
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class MarshalCodec(object):
+    """
+    Serializes values using Python marshal binary format
+
+    Marshal format may change between Python versions and it is not safe
+    to load corrupted data, so it is only used by tables opting in to it.
+    Its name records the interpreter version, so data written by another
+    version is not decoded.
+    """
+    NAME = 'marshal%s%s' % sys.version_info[:2]
+
+    def encode(self, data):
+        return buffer(marshal.dumps(data))
+
+    def decode(self, data):
+        return marshal.loads(str(data))
+
+
+class ZlibCodec(object):
+    """
+    Compresses data already serialized by another codec
+    """
+    NAME = 'zlib'
+
+    def encode(self, data):
+        return buffer(zlib.compress(str(data)))
+
+    def decode(self, data):
+        return zlib.decompress(str(data))
+
+
+# Available codecs by name. Codecs can be chained joining names with '+'
+VALUE_CODECS = {
+    JSONCodec.NAME: JSONCodec(),
+    MarshalCodec.NAME: MarshalCodec(),
+    ZlibCodec.NAME: ZlibCodec(),
+}
+
 
-SCHEMA_VERSION = 1.0
+def encode_value(value, codec, compression_threshold=None):
+    """
+    Serialize a value with given codec
+
+    If a compression threshold is given, serialized data equal or bigger
+    than it is compressed using zlib. Returns serialized data and the name
+    of the codec chain needed for decoding it.
+    """
+    data = VALUE_CODECS[codec].encode(value)
+    if compression_threshold is not None and \
+       len(data) >= compression_threshold:
+        data = VALUE_CODECS[ZlibCodec.NAME].encode(data)
+        codec = '%s+%s' % (ZlibCodec.NAME, codec)
+    return data, codec
+
+
+def decode_value(data, codec):
+    """
+    Deserialize data encoded by given codec chain
+    """
+    for name in codec.split('+'):
+        if name not in VALUE_CODECS:
+            raise ValueError('Unknown value codec %s' % name)
+        data = VALUE_CODECS[name].decode(data)
+    return data
 
 
 class SQLiteDict(object):
@@ -45,78 +152,343 @@ class SQLiteDict(object):
 
     TABLE_NAME = 'sqlitedict_table'
 
-    def __init__(self, db):
+    # Codec for serialized types and size from which they are compressed.
+    # Values using plain JSON are stored without codec name in their type
+    # so they are readable by older versions. MarshalCodec is faster but
+    # its data can only be read by the same Python version
+    CODEC = JSONCodec.NAME
+    COMPRESSION_THRESHOLD = None
+
+    # Number of rows fetched at once when iterating
+    FETCH_SIZE = 100
+
+    # Keys only kept in memory. They do not survive service restarts
+    EPHEMERAL_KEYS = ()
+
+    # Schema versions and methods for updating tables to them
+    _SCHEMA_MIGRATIONS = [
+        (2.0, '_migrate_key_to_primary_key'),
+        (3.0, '_migrate_add_expiration'),
+    ]
+
+    def __init__(self, db, cache=True, check_external_changes=False):
         """
         Class initialization
+
+        When cache is enabled, every value read or written is kept in memory
+        so repeated reads do not hit the database. If other processes can
+        write to the same database file, check_external_changes makes the
+        cache to be flushed each time SQLite reports a foreign commit.
+
+        Values written inside a transaction are only visible to the thread
+        doing it until the transaction is committed.
         """
         self.db = db
-        self.cursor = db.cursor
+        self.cache_enabled = cache
+        self.check_external_changes = check_external_changes
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        self._cache_generation = 0
+        self._local = threading.local()
+        self._ephemeral = {}
         # Generate table if not exists
-        self.db.create_table(self.TABLE_NAME, **{
-            'key':    unicode,
-            'value':  unicode,
-            'type':   unicode,
-        })
+        self._create_table(self.TABLE_NAME)
 
-        if 'SCHEMA_VERSION' not in self:
+        schema_version = self._get_schema_version()
+        if schema_version is None:
             self['SCHEMA_VERSION'] = SCHEMA_VERSION
         else:
             # Check schema version
-            schema_version = self['SCHEMA_VERSION']
             if schema_version != SCHEMA_VERSION:
                 if schema_version < SCHEMA_VERSION:
-                    # TODO: Update schema
-                    pass
+                    self._update_schema(schema_version)
                 else:
                     # TODO: Raise an error?
                     pass
+        # Index used for purging expired keys
+        self.db.create_index(self.TABLE_NAME, 'expires')
+        self.db.register_table(self)
+
+    def _create_table(self, name):
+        """
+        Create a table with current schema
+        """
+        self.db.create_table(name, primary_key='key', **{
+            'key':     unicode,
+            'value':   unicode,
+            'type':    unicode,
+            'expires': float,
+        })
+
+    def _get_schema_version(self):
+        """
+        Return schema version of stored table, or None for new tables
+
+        Only columns present in every schema version are queried.
+        """
+        self.cursor.execute(
+            'SELECT value FROM %s WHERE key = ?' % self.TABLE_NAME,
+            ('SCHEMA_VERSION',))
+        data = self.cursor.fetchone()
+        if data is not None:
+            return float(data[0])
+        return None
+
+    def _update_schema(self, schema_version):
+        """
+        Apply all migrations needed to update table to current schema
+        """
+        for version, method in self._SCHEMA_MIGRATIONS:
+            if version <= schema_version:
+                continue
+            logging.info(
+                'Updating table %s from schema version %s to %s' % (
+                    self.TABLE_NAME, schema_version, version))
+            start = time.time()
+            # Disable implicit transaction handling so statements altering
+            # the schema do not commit before the migration is complete
+            isolation_level = self.db.conn.isolation_level
+            self.db.conn.isolation_level = None
+            try:
+                with self.db.transaction(rollback_callback=self.clear_cache):
+                    self.cursor.execute('BEGIN')
+                    rows = getattr(self, method)()
+                    self.clear_cache()
+                    self['SCHEMA_VERSION'] = version
+            finally:
+                self.db.conn.isolation_level = isolation_level
+            logging.info(
+                'Table %s updated to schema version %s in %.3f seconds '
+                '(%s rows)' % (
+                    self.TABLE_NAME, version, time.time() - start, rows))
+            schema_version = version
+
+    def _migrate_key_to_primary_key(self):
+        """
+        Rebuild table using key as primary key
+
+        Tables from schema 1.0 have no index and can have duplicated keys.
+        Last stored value is kept for every key.
+        """
+        old_table = '%s_old' % self.TABLE_NAME
+        self.cursor.execute('ALTER TABLE %s RENAME TO %s' % (
+            self.TABLE_NAME, old_table))
+        self._create_table(self.TABLE_NAME)
+        self.cursor.execute(
+            'INSERT OR REPLACE INTO %s (key, value, type) '
+            'SELECT key, value, type FROM %s ORDER BY rowid' % (
+                self.TABLE_NAME, old_table))
+        rows = self.cursor.rowcount
+        self.cursor.execute('DROP TABLE %s' % old_table)
+        return rows
+
+    def _migrate_add_expiration(self):
+        """
+        Add expiration time column and remove keys now kept in memory
+        """
+        self.cursor.execute('PRAGMA table_info(%s)' % self.TABLE_NAME)
+        columns = [row[1] for row in self.cursor.fetchall()]
+        # Tables rebuilt by previous migrations already have the column
+        if 'expires' not in columns:
+            self.cursor.execute(
+                'ALTER TABLE %s ADD COLUMN expires REAL' % self.TABLE_NAME)
+        rows = 0
+        for key in self.EPHEMERAL_KEYS:
+            self.cursor.execute(
+                'DELETE FROM %s WHERE key = ?' % self.TABLE_NAME, (key,))
+            rows += self.cursor.rowcount
+        return rows
+
+    @property
+    def cursor(self):
+        """
+        Database cursor for current thread
+        """
+        return self.db.cursor
+
+    def _check_data_version(self):
+        """
+        Flush cache if database was modified by another connection
+        """
+        with self.db.reading():
+            self.cursor.execute('PRAGMA data_version')
+            data_version = self.cursor.fetchone()[0]
+        if data_version != getattr(self._local, 'data_version', None):
+            self.clear_cache()
+            self._local.data_version = data_version
+
+    def _get_row(self, key):
+        """
+        Return stored (value, type, expires) for given key or None if it does
+        not exist or it is expired
+        """
+        data = self._get_stored_row(key)
+        if data is not None and data[2] is not None and \
+           data[2] <= time.time():
+            return None
+        return data
+
+    def _get_stored_row(self, key):
+        """
+        Return stored row for given key from memory or from database
+        """
+        if key in self.EPHEMERAL_KEYS:
+            return self._ephemeral.get(key)
+        if self.cache_enabled:
+            if self.check_external_changes:
+                self._check_data_version()
+            pending = getattr(self._local, 'pending', None)
+            if pending and key in pending:
+                return pending[key]
+            try:
+                return self._cache[key]
+            except KeyError:
+                generation = self._cache_generation
+        with self.db.reading():
+            self.cursor.execute('SELECT value, type, expires FROM %s WHERE key = ?' % self.TABLE_NAME, (key,))
+            data = self.cursor.fetchone()
+        if self.cache_enabled:
+            with self._cache_lock:
+                # Do not cache data if it was modified while reading it
+                if generation == self._cache_generation:
+                    self._cache[key] = data
+        return data
+
+    def _set_pending(self, key, data):
+        """
+        Keep a value written in current transaction for caching it on commit
+        """
+        if self.cache_enabled:
+            if getattr(self._local, 'pending', None) is None:
+                self._local.pending = {}
+            self._local.pending[key] = data
+
+    def _publish_pending(self):
+        """
+        Move values written in a committed transaction into the cache
+        """
+        pending = getattr(self._local, 'pending', None)
+        self._local.pending = None
+        with self._cache_lock:
+            self._cache_generation += 1
+            if pending:
+                self._cache.update(pending)
+
+    def _discard_pending(self):
+        """
+        Drop values written in a rolled back transaction
+        """
+        self._local.pending = None
+
+    def _decode(self, value, valuetype):
+        """
+        Build a value from its stored representation
+        """
+        valuetype, _, codec = valuetype.partition(':')
+        if valuetype in self._SERIALIZED_TYPES:
+            value = decode_value(value, codec or JSONCodec.NAME)
+        return self._SUPPORTED_TYPES[valuetype](value)
 
     def __getitem__(self, key):
         """
         Evaluation of config[key]
         """
-        self.cursor.execute('SELECT value, type FROM %s WHERE key = ?' % self.TABLE_NAME, (key,))
-        data = self.cursor.fetchone()
+        data = self._get_row(key)
         if data is not None:
-            valuetype = self._SUPPORTED_TYPES[data[1]]
-            if data[1] in self._SERIALIZED_TYPES:
-                value = json.loads(data[0])
-            else:
-                value = data[0]
-            return valuetype(value)
+            return self._decode(data[0], data[1])
         raise KeyError(key)
 
     def __setitem__(self, key, value):
         """
         Assignement to config[key]
         """
-        if key in self:
-            self.__delitem__(key)
+        self.set(key, value)
+
+    def set(self, key, value, ttl=None):
+        """
+        Set value for key, optionally expiring after ttl seconds
+
+        Ephemeral keys are set immediately, even inside a transaction.
+        """
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
 
         valuetype = type(value).__name__
         if valuetype not in self._SUPPORTED_TYPES.keys():
             raise ValueError('Type %s is not supported by SQLiteDict' % valuetype)
 
         if valuetype in self._SERIALIZED_TYPES:
-            value = json.dumps(value)
+            value, codec = encode_value(
+                value, self.CODEC, self.COMPRESSION_THRESHOLD)
+            if codec != JSONCodec.NAME:
+                valuetype = '%s:%s' % (valuetype, codec)
 
-        self.cursor.execute('INSERT INTO %s (key, value, type) values (?, ?, ?)' % self.TABLE_NAME, (key, value, valuetype))
-        self.db.conn.commit()
+        if key in self.EPHEMERAL_KEYS:
+            self._ephemeral[key] = (value, valuetype, expires)
+            return
+
+        with self.batch():
+            self.cursor.execute('INSERT OR REPLACE INTO %s (key, value, type, expires) values (?, ?, ?, ?)' % self.TABLE_NAME, (key, value, valuetype, expires))
+            self._set_pending(key, (value, valuetype, expires))
 
     def __delitem__(self, key):
         """
         Item deletion
         """
-        self.cursor.execute('DELETE FROM %s WHERE key=?' % self.TABLE_NAME, (key,))
-        self.db.conn.commit()
+        if key in self.EPHEMERAL_KEYS:
+            self._ephemeral.pop(key, None)
+            return
+        with self.batch():
+            self.cursor.execute('DELETE FROM %s WHERE key=?' % self.TABLE_NAME, (key,))
+            self._set_pending(key, None)
 
     def __contains__(self, key):
         """
         Item membership by key
         """
-        self.cursor.execute('SELECT value FROM %s WHERE key=?' % self.TABLE_NAME, (key,))
-        data = self.cursor.fetchone()
-        return data is not None
+        return self._get_row(key) is not None
+
+    def batch(self):
+        """
+        Context manager grouping all modifications in a single transaction
+
+        Changes are committed when the outermost block ends, or rolled back
+        if an exception is raised inside it. Only one thread can be writing
+        at a time.
+        """
+        return self.db.transaction(
+            commit_callback=self._publish_pending,
+            rollback_callback=self._discard_pending)
+
+    def update(self, *args, **kwargs):
+        """
+        Set several values in a single transaction
+        """
+        with self.batch():
+            for key, value in dict(*args, **kwargs).items():
+                self[key] = value
+
+    def purge_expired(self):
+        """
+        Remove all expired keys, returning the number of keys removed
+        """
+        now = time.time()
+        for key, data in self._ephemeral.items():
+            if data[2] is not None and data[2] <= now:
+                self._ephemeral.pop(key, None)
+        with self.batch():
+            self.cursor.execute(
+                'DELETE FROM %s WHERE expires <= ?' % self.TABLE_NAME, (now,))
+            return self.cursor.rowcount
+
+    def clear_cache(self):
+        """
+        Drop all cached values
+        """
+        with self._cache_lock:
+            self._cache_generation += 1
+            self._cache.clear()
 
     def get(self, key, default=None):
         """
@@ -135,20 +507,119 @@ class SQLiteDict(object):
             self[key] = value
         return self[key]
 
+    def _iterate_rows(self, columns, prefix=None):
+        """
+        Iterate over table rows sorted by key, fetching them in pages
+
+        Rows hold the key followed by given columns. Every page is read with
+        a new query starting after the last key seen, so other operations,
+        including writes to iterated keys, can be done while iterating and
+        every key is returned once. If a prefix is given, only keys starting
+        with it are returned.
+        """
+        query = 'SELECT %s FROM %s WHERE key %%s ? AND key != ? AND ' \
+            '(expires IS NULL OR expires > ?)' % (
+                ', '.join(('key',) + tuple(columns)), self.TABLE_NAME)
+        params = ['SCHEMA_VERSION', time.time()]
+        if prefix:
+            # Use a key range so the primary key index is used
+            query += ' AND key < ?'
+            params.append(prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+        query += ' ORDER BY key LIMIT %d' % self.FETCH_SIZE
+        # First page starts at prefix, next ones after the last key seen
+        operator, last = '>=', prefix or u''
+        cursor = self.db.conn.cursor()
+        try:
+            while True:
+                with self.db.reading():
+                    cursor.execute(query % operator, [last] + params)
+                    rows = cursor.fetchall()
+                for row in rows:
+                    yield row
+                if len(rows) < self.FETCH_SIZE:
+                    break
+                operator, last = '>', rows[-1][0]
+        finally:
+            cursor.close()
+
+    def _iterate_ephemeral(self, prefix=None):
+        """
+        Iterate over (key, data) of ephemeral keys currently set
+        """
+        for key in sorted(self._ephemeral.keys()):
+            if not prefix or key.startswith(prefix):
+                data = self._get_row(key)
+                if data is not None:
+                    yield key, data
+
+    def __len__(self):
+        """
+        Number of stored items
+        """
+        with self.db.reading():
+            self.cursor.execute(
+                'SELECT COUNT(*) FROM %s WHERE key != ? AND '
+                '(expires IS NULL OR expires > ?)' % self.TABLE_NAME,
+                ('SCHEMA_VERSION', time.time()))
+            count = self.cursor.fetchone()[0]
+        return count + len(list(self._iterate_ephemeral()))
+
+    def __iter__(self):
+        """
+        Iteration over keys
+        """
+        return self.iterkeys()
+
+    def iterkeys(self, prefix=None):
+        """
+        Iterate over current keys. Ephemeral keys are returned at the end
+        """
+        for row in self._iterate_rows((), prefix):
+            yield row[0]
+        for key, data in self._iterate_ephemeral(prefix):
+            yield key
+
+    def itervalues(self, prefix=None):
+        """
+        Iterate over current values
+        """
+        for row in self._iterate_rows(('value', 'type'), prefix):
+            yield self._decode(row[1], row[2])
+        for key, data in self._iterate_ephemeral(prefix):
+            yield self._decode(data[0], data[1])
+
+    def iteritems(self, prefix=None):
+        """
+        Iterate over tuples with current items
+        """
+        for row in self._iterate_rows(('value', 'type'), prefix):
+            yield (row[0], self._decode(row[1], row[2]))
+        for key, data in self._iterate_ephemeral(prefix):
+            yield (key, self._decode(data[0], data[1]))
+
+    def keys(self):
+        """
+        Return list of current keys
+        """
+        return list(self.iterkeys())
+
+    def values(self):
+        """
+        Return list of current values
+        """
+        return list(self.itervalues())
+
     def items(self):
         """
-        Return list of tuples with current items
+        Return iterator over tuples with current items
         """
-        self.cursor.execute(
-            'SELECT key, value, type FROM %s' % self.TABLE_NAME)
-        for row in self.cursor.fetchall():
-            if row[0] != 'SCHEMA_VERSION':
-                valuetype = self._SUPPORTED_TYPES[row[2]]
-                if row[2] in self._SERIALIZED_TYPES:
-                    value = json.loads(row[1])
-                else:
-                    value = row[1]
-                yield (row[0], valuetype(value))
+        return self.iteritems()
+
+    def keys_with_prefix(self, prefix):
+        """
+        Return sorted list of keys starting with given prefix
+        """
+        return sorted(self.iterkeys(prefix))
 
 
 class ConfigValues(SQLiteDict):
@@ -157,12 +628,139 @@ class ConfigValues(SQLiteDict):
     """
     TABLE_NAME = 'config'
 
+    # Current session data is meaningless after a service restart
+    EPHEMERAL_KEYS = ('uuid', 'port', 'tunnel_pid')
+
 
 class ProfilesData(SQLiteDict):
     """
-    Configuration values database handler
+    Local cache of profiles data
+
+    Entries are stored along with the time they were cached so they can be
+    discarded after a given time to live.
     """
     TABLE_NAME = 'profiles'
+    COMPRESSION_THRESHOLD = 4096
+
+    INDEX_KEY = 'index'
+    PROFILE_KEY_PREFIX = 'profile:'
+    REVISION_KEY_PREFIX = 'revision:'
+
+    # Time settings revisions are kept for three-way merges of live sessions
+    REVISION_TTL = 7 * 24 * 3600
+
+    def __init__(self, *args, **kwargs):
+        super(ProfilesData, self).__init__(*args, **kwargs)
+        # Incremented on every invalidation so data fetched before one of
+        # them is not cached afterwards
+        self._generation = 0
+
+    def get_generation(self):
+        """
+        Return current invalidation generation
+
+        Take it before fetching data to be cached and pass it to the
+        setters, so data is not cached if it was invalidated meanwhile.
+        """
+        return self._generation
+
+    def _get_fresh(self, key, ttl):
+        """
+        Return cached data for key if it is younger than ttl seconds
+        """
+        entry = self.get(key)
+        if entry is None or time.time() - entry['timestamp'] >= ttl:
+            return None
+        return entry['data']
+
+    def _set_fresh(self, key, data, generation=None):
+        """
+        Cache data for key unless it was invalidated since given generation
+        """
+        # Invalidations are done inside a transaction too, so they can not
+        # happen between the check and the write
+        with self.batch():
+            if generation is not None and generation != self._generation:
+                logging.debug(
+                    'Not caching %s. It was invalidated while fetched' % key)
+                return
+            self[key] = {'timestamp': time.time(), 'data': data}
+
+    def get_index(self, ttl):
+        """
+        Return cached profiles index or None if it is missing or expired
+        """
+        return self._get_fresh(self.INDEX_KEY, ttl)
+
+    def set_index(self, index, generation=None):
+        """
+        Cache profiles index
+        """
+        self._set_fresh(self.INDEX_KEY, index, generation)
+
+    def get_profile(self, name, ttl):
+        """
+        Return cached profile or None if it is missing or expired
+        """
+        return self._get_fresh(self.PROFILE_KEY_PREFIX + name, ttl)
+
+    def set_profile(self, name, profile, generation=None):
+        """
+        Cache profile data
+        """
+        self._set_fresh(self.PROFILE_KEY_PREFIX + name, profile, generation)
+
+    def get_revision(self, revision):
+        """
+        Return profile settings stored for a revision or None
+        """
+        return self.get(self.REVISION_KEY_PREFIX + revision)
+
+    def set_revision(self, revision, settings):
+        """
+        Store profile settings for a revision
+        """
+        self.set(
+            self.REVISION_KEY_PREFIX + revision, settings,
+            ttl=self.REVISION_TTL)
+
+    def keep_revision(self, revision, settings):
+        """
+        Store profile settings for a revision unless they are already stored
+
+        Stored revisions are only written again once half of their time to
+        live has passed, so repeated reads of a profile do not write to the
+        database. Returns whether settings were written.
+        """
+        data = self._get_row(self.REVISION_KEY_PREFIX + revision)
+        if data is not None and (
+                data[2] is None or
+                data[2] - time.time() > self.REVISION_TTL / 2):
+            return False
+        self.set_revision(revision, settings)
+        return True
+
+    def invalidate(self, *names):
+        """
+        Discard cached data for given profiles and profiles index
+        """
+        with self.batch():
+            self._generation += 1
+            del(self[self.INDEX_KEY])
+            for name in names:
+                del(self[self.PROFILE_KEY_PREFIX + name])
+
+    def invalidate_all(self):
+        """
+        Discard all cached profiles data
+
+        Stored revisions are kept as they never change.
+        """
+        with self.batch():
+            self._generation += 1
+            del(self[self.INDEX_KEY])
+            for key in self.keys_with_prefix(self.PROFILE_KEY_PREFIX):
+                del(self[key])
 
 
 class BaseDBManager(object):
@@ -180,21 +778,179 @@ class BaseDBManager(object):
         buffer:  'BLOB'
     }
 
-    def __init__(self, database):
+    def __init__(self, database, storage_profile=DEFAULT_STORAGE_PROFILE):
         """
         Class initialization
+
+        Every thread gets its own connection to the database, so many
+        threads can read at once while writes are serialized. In-memory
+        databases can not be shared between connections, so a single
+        connection is used for them and all access is serialized.
+        """
+        if storage_profile not in STORAGE_PROFILES:
+            raise ValueError(
+                'Unknown database storage profile %s' % storage_profile)
+        self.database = database
+        self.storage_profile = storage_profile
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._transaction_level = 0
+        self._commit_callbacks = []
+        self._rollback_callbacks = []
+        self._shared_connection = None
+        if database == ':memory:':
+            self._shared_connection = self._connect()
+        # Tables using this database, purged by purge_expired()
+        self._tables = []
+
+    def register_table(self, table):
         """
-        self.conn = sqlite3.connect(database)
-        self.cursor = self.conn.cursor()
+        Register a SQLiteDict using this database
+        """
+        self._tables.append(table)
 
-    def create_table(self, name, **structure):
+    def purge_expired(self):
+        """
+        Remove expired keys from all registered tables, returning the
+        number of keys removed
+        """
+        return sum([table.purge_expired() for table in self._tables])
+
+    def _connect(self):
+        """
+        Open a new connection to the database
+        """
+        # Connections are only used by the thread that opened them, but
+        # they can be closed from any thread
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        for pragma, value in STORAGE_PROFILES[self.storage_profile]:
+            conn.execute('PRAGMA %s = %s' % (pragma, value))
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+
+    @property
+    def conn(self):
+        """
+        Database connection for current thread
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if self._shared_connection is not None:
+                conn = self._shared_connection
+            else:
+                conn = self._connect()
+            self._local.conn = conn
+            self._local.cursor = conn.cursor()
+        return conn
+
+    @property
+    def cursor(self):
+        """
+        Database cursor for current thread
+        """
+        self.conn
+        return self._local.cursor
+
+    def close(self):
+        """
+        Close all database connections
+        """
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._shared_connection = None
+        self._local = threading.local()
+
+    @contextmanager
+    def reading(self):
+        """
+        Context manager for read operations
+
+        Reads are only serialized with writes when using a shared connection
+        """
+        if self._shared_connection is not None:
+            with self._write_lock:
+                yield
+        else:
+            yield
+
+    def commit(self):
+        """
+        Commit changes unless a transaction block is in progress
+        """
+        with self._write_lock:
+            if self._transaction_level == 0:
+                self.conn.commit()
+
+    @contextmanager
+    def transaction(self, commit_callback=None, rollback_callback=None):
+        """
+        Context manager for grouping changes in a single transaction
+
+        Only one thread can be inside a transaction at a time. Nested blocks
+        join the outermost one. Given callbacks are called once when the
+        transaction is committed or rolled back.
+        """
+        with self._write_lock:
+            if commit_callback is not None and \
+               commit_callback not in self._commit_callbacks:
+                self._commit_callbacks.append(commit_callback)
+            if rollback_callback is not None and \
+               rollback_callback not in self._rollback_callbacks:
+                self._rollback_callbacks.append(rollback_callback)
+            self._transaction_level += 1
+            try:
+                yield
+            except:
+                self._transaction_level -= 1
+                if self._transaction_level == 0:
+                    self.conn.rollback()
+                    self._run_callbacks(self._rollback_callbacks)
+                raise
+            else:
+                self._transaction_level -= 1
+                if self._transaction_level == 0:
+                    try:
+                        self.conn.commit()
+                    except:
+                        self.conn.rollback()
+                        self._run_callbacks(self._rollback_callbacks)
+                        raise
+                    self._run_callbacks(self._commit_callbacks)
+
+    def _run_callbacks(self, callbacks):
+        """
+        Run and forget transaction callbacks
+        """
+        callbacks = list(callbacks)
+        self._commit_callbacks = []
+        self._rollback_callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def create_table(self, name, primary_key=None, **structure):
         """
         Creates a table
         """
         col_types = ['%s %s' % (colname, self.SQLITE_TYPE_MATCHES[coltype]) for colname, coltype in structure.items()]
+        if primary_key is not None:
+            col_types.append('PRIMARY KEY (%s)' % primary_key)
         query = "CREATE TABLE IF NOT EXISTS %s (%s)" % (name, ','.join(col_types))
         self.cursor.execute(query)
-        self.conn.commit()
+        self.commit()
+
+    def create_index(self, table, column, unique=False):
+        """
+        Creates an index for a table column
+        """
+        query = "CREATE %sINDEX IF NOT EXISTS %s_%s_index ON %s (%s)" % (
+            'UNIQUE ' if unique else '', table, column, table, column)
+        self.cursor.execute(query)
+        self.commit()
 
 
 class DBManager(BaseDBManager):
@@ -202,12 +958,15 @@ class DBManager(BaseDBManager):
     Database manager class
     """
 
-    def __init__(self, database):
+    def __init__(self, database, cache=True, check_external_changes=False,
+                 storage_profile=DEFAULT_STORAGE_PROFILE):
         """
         Class initialization
         """
-        super(DBManager, self).__init__(database)
+        super(DBManager, self).__init__(database, storage_profile)
         # Initialize configuration data
-        self.config = ConfigValues(self)
+        self.config = ConfigValues(
+            self, cache=cache, check_external_changes=check_external_changes)
         # Profiles
-        self.profiles = ProfilesData(self)
+        self.profiles = ProfilesData(
+            self, cache=cache, check_external_changes=check_external_changes)
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4 sw=4 sts=4
+
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+"""
+Local snapshot of IPA users, groups, hosts and hostgroups names
+
+Names are indexed for exact, prefix and substring lookups so completion
+and validation of profile targets do not need to query IPA each time.
+Lookups are case insensitive, as IPA names are.
+"""
+
+import time
+import logging
+import threading
+import heapq
+from array import array
+from bisect import bisect_left
+
+# Length of the substrings indexed for substring lookups
+NGRAM_SIZE = 3
+
+# Limited searches scan sorted names instead of n-gram candidates when more
+# than one in DENSE_RATIO names are candidates
+DENSE_RATIO = 8
+
+# The n-gram index is built on first substring search, in a background
+# thread for indexes with more than NGRAM_BACKGROUND_NAMES names. Indexes
+# with more than NGRAM_MAX_NAMES names are never built and are scanned
+NGRAM_BACKGROUND_NAMES = 10000
+NGRAM_MAX_NAMES = 500000
+
+
+class DirectoryIndex(object):
+    """
+    Index of names supporting exact, prefix and substring lookups
+
+    When given, get_alias returns another name each name is also known by,
+    like the short name of a host. Aliases are only used for exact lookups.
+    """
+
+    def __init__(self, names=(), get_alias=None):
+        self.get_alias = get_alias
+        # Names by lowercased key
+        self._names = {}
+        # Keys by lowercased alias
+        self._aliases = {}
+        for name in names:
+            self._names[name.lower()] = name
+            self._add_alias(name)
+        # Sorted lowercased keys for prefix lookups
+        self._keys = sorted(self._names.keys())
+        # Keys by numeric id, with None for removed ones, and arrays of ids
+        # of the keys containing each n-gram. Built on first search
+        self._ids = {}
+        self._id_keys = []
+        self._ngrams = None
+        self._ngrams_state = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        key = name.lower()
+        return key in self._names or key in self._aliases
+
+    def __iter__(self):
+        with self._lock:
+            names = [self._names[key] for key in self._keys]
+        return iter(names)
+
+    def _add_alias(self, name):
+        if self.get_alias is not None:
+            alias = self.get_alias(name).lower()
+            self._aliases.setdefault(alias, set()).add(name.lower())
+
+    def _remove_alias(self, name):
+        if self.get_alias is not None:
+            alias = self.get_alias(name).lower()
+            keys = self._aliases.get(alias, set())
+            keys.discard(name.lower())
+            if not keys:
+                self._aliases.pop(alias, None)
+
+    def _get_ngrams(self, key):
+        return set([key[i:i + NGRAM_SIZE]
+                    for i in range(len(key) - NGRAM_SIZE + 1)])
+
+    def _index_ngrams(self, ngrams, key_id, key):
+        for ngram in self._get_ngrams(key):
+            ids = ngrams.get(ngram)
+            if ids is None:
+                ids = ngrams[ngram] = array('i')
+            ids.append(key_id)
+
+    def build_ngrams(self):
+        """
+        Builds the n-gram index used for substring lookups
+        """
+        with self._lock:
+            if self._ngrams is not None:
+                return
+            keys = list(self._keys)
+        ngrams = {}
+        ids = {}
+        for key_id, key in enumerate(keys):
+            ids[key] = key_id
+            self._index_ngrams(ngrams, key_id, key)
+        with self._lock:
+            # Keys added meanwhile are indexed now. Removed ones are left
+            # without id, as their n-grams are not looked up again
+            id_keys = [key if key in self._names else None for key in keys]
+            for key in self._keys:
+                if key not in ids:
+                    ids[key] = len(id_keys)
+                    id_keys.append(key)
+                    self._index_ngrams(ngrams, ids[key], key)
+            for key in keys:
+                if key not in self._names:
+                    del(ids[key])
+            self._ids = ids
+            self._id_keys = id_keys
+            self._ngrams = ngrams
+            self._ngrams_state = 'built'
+        logging.debug(
+            'Directory index: Indexed %s n-grams of %s names' % (
+                len(ngrams), len(keys)))
+
+    def _get_ngrams_index(self):
+        with self._lock:
+            if self._ngrams is not None or self._ngrams_state is not None:
+                return self._ngrams
+            if len(self._keys) > NGRAM_MAX_NAMES:
+                self._ngrams_state = 'disabled'
+                return None
+            if len(self._keys) > NGRAM_BACKGROUND_NAMES:
+                self._ngrams_state = 'building'
+                thread = threading.Thread(target=self.build_ngrams)
+                thread.daemon = True
+                thread.start()
+                return None
+        self.build_ngrams()
+        return self._ngrams
+
+    def add(self, name):
+        key = name.lower()
+        with self._lock:
+            if key not in self._names:
+                self._keys.insert(bisect_left(self._keys, key), key)
+                if self._ngrams is not None:
+                    self._ids[key] = len(self._id_keys)
+                    self._id_keys.append(key)
+                    self._index_ngrams(self._ngrams, self._ids[key], key)
+                self._add_alias(name)
+            self._names[key] = name
+
+    def remove(self, name):
+        key = name.lower()
+        with self._lock:
+            if key not in self._names:
+                return
+            self._remove_alias(self._names.pop(key))
+            del(self._keys[bisect_left(self._keys, key)])
+            if self._ngrams is not None:
+                self._id_keys[self._ids.pop(key)] = None
+
+    def prefix(self, prefix, limit=None):
+        """
+        Returns sorted names starting with given prefix
+        """
+        prefix = prefix.lower()
+        result = []
+        with self._lock:
+            for i in xrange(bisect_left(self._keys, prefix), len(self._keys)):
+                key = self._keys[i]
+                if not key.startswith(prefix) or len(result) == limit:
+                    break
+                result.append(self._names[key])
+        return result
+
+    def search(self, text, limit=None):
+        """
+        Returns sorted names containing given text
+        """
+        text = text.lower()
+        ngrams = None
+        if len(text) >= NGRAM_SIZE:
+            ngrams = self._get_ngrams_index()
+        # Names are added and removed from other threads
+        with self._lock:
+            return self._search(text, ngrams, limit)
+
+    def _search(self, text, ngrams, limit):
+        candidates = None
+        if ngrams is not None:
+            # Candidates contain the least common n-gram of given text
+            candidates = min([ngrams.get(ngram, ())
+                              for ngram in self._get_ngrams(text)], key=len)
+            # Scanning sorted keys ends sooner when most of them match
+            if limit is not None and \
+                    len(candidates) * DENSE_RATIO > len(self._keys):
+                candidates = None
+
+        if candidates is None:
+            keys = []
+            for key in self._keys:
+                if len(keys) == limit:
+                    break
+                if text in key:
+                    keys.append(key)
+        else:
+            id_keys = self._id_keys
+            keys = [id_keys[key_id] for key_id in candidates
+                    if id_keys[key_id] is not None and
+                    text in id_keys[key_id]]
+            if limit is None:
+                keys.sort()
+            else:
+                keys = heapq.nsmallest(limit, keys)
+        return [self._names[key] for key in keys]
+
+
+def get_short_hostname(name):
+    """
+    Returns host name without domain
+    """
+    return name.split('.', 1)[0]
+
+
+class DirectorySnapshot(object):
+    """
+    Indexes of IPA principal names by kind, loaded on demand and reloaded
+    once they are older than given TTL in seconds
+    """
+
+    KINDS = ('users', 'groups', 'hosts', 'hostgroups')
+
+    # Functions returning other names principals are known by. Hosts are
+    # listed by FQDN but can be referred to by their short name
+    ALIASES = {
+        'hosts': get_short_hostname,
+    }
+
+    def __init__(self, loader, ttl):
+        """
+        Loader is called with a list of kinds and must return a dictionary
+        with the list of names for each of them
+        """
+        self.loader = loader
+        self.ttl = ttl
+        self._indexes = {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, kind):
+        return kind in self._indexes and \
+            time.time() - self._loaded[kind] < self.ttl
+
+    def load(self, *kinds):
+        """
+        Loads given kinds of names, or all of them, in a single loader call
+        """
+        kinds = kinds or self.KINDS
+        names = self.loader(list(kinds))
+        indexes = dict([
+            (kind, DirectoryIndex(names[kind], self.ALIASES.get(kind)))
+            for kind in kinds])
+        with self._lock:
+            for kind in kinds:
+                self._indexes[kind] = indexes[kind]
+                self._loaded[kind] = time.time()
+                logging.debug(
+                    'Directory snapshot: Loaded %s %s' % (
+                        len(indexes[kind]), kind))
+        return indexes
+
+    def get_index(self, kind):
+        """
+        Returns index for given kind of names, loading it if needed
+        """
+        if kind not in self.KINDS:
+            raise ValueError('Unknown directory kind %s' % kind)
+        with self._lock:
+            if self._is_fresh(kind):
+                return self._indexes[kind]
+        return self.load(kind)[kind]
+
+    def is_loaded(self, kind):
+        """
+        Checks if there is a fresh index for given kind of names
+        """
+        with self._lock:
+            return self._is_fresh(kind)
+
+    def update(self, kind, added=(), removed=()):
+        """
+        Updates a loaded index with known changes, without reloading it.
+        Names already in the index, or aliases of them, are not added
+        """
+        with self._lock:
+            index = self._indexes.get(kind)
+            if index is None:
+                return
+            for name in added:
+                if name not in index:
+                    index.add(name)
+            for name in removed:
+                index.remove(name)
+
+    def invalidate(self, *kinds):
+        """
+        Discards loaded indexes for given kinds of names, or all of them
+        """
+        with self._lock:
+            for kind in kinds or self.KINDS:
+                self._indexes.pop(kind, None)
+                self._loaded.pop(kind, None)
+
+    def complete(self, kind, text, limit=None):
+        """
+        Returns names starting with given text followed by other names
+        containing it
+        """
+        index = self.get_index(kind)
+        result = index.prefix(text, limit)
+        if limit is None or len(result) < limit:
+            found = set(result)
+            for name in index.search(text, limit and limit + len(result)):
+                if len(result) == limit:
+                    break
+                if name not in found:
+                    result.append(name)
+        return result
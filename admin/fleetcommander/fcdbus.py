@@ -28,7 +28,10 @@ import subprocess
 import re
 import uuid
 import time
+import threading
 from functools import wraps
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import dbus
 import dbus.service
@@ -40,11 +43,14 @@ from gi.repository import GObject
 import sshcontroller
 import libvirtcontroller
 from database import DBManager
-from utils import get_ip_address, get_data_from_file
+from utils import get_ip_address, get_data_from_file, iter_json_object
 import mergers
 from goa import GOAProvidersLoader
 import fcfreeipa
 
+# Maximum number of names returned by directory searches
+DIRECTORY_SEARCH_LIMIT = 50
+
 SYSTEM_USER_REGEX = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]{0,30}$')
 IPADDRESS_AND_PORT_REGEX = re.compile(r'^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])(\:[0-9]{1,5})*$')
 HOSTNAME_AND_PORT_REGEX = re.compile(r'^(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9][A-Za-z0-9\-]*[A-Za-z0-9])(\:[0-9]{1,5})*$')
@@ -63,6 +69,32 @@ def set_last_call_time(f):
     return wrapped
 
 
+def ipa_worker(f):
+    """
+    Runs decorated asynchronous D-Bus method in the IPA workers pool so
+    slow IPA requests do not block the main loop. The result is replied
+    from the main loop once the method finishes.
+
+    The method must be declared with reply_cb and error_cb asynchronous
+    callbacks, which are handled by this decorator.
+    """
+    @wraps(f)
+    def wrapped(obj, *args, **kwargs):
+        reply_cb = kwargs.pop('reply_cb')
+        error_cb = kwargs.pop('error_cb')
+
+        def run():
+            try:
+                result = f(obj, *args, **kwargs)
+            except Exception, e:
+                logging.error('Error running %s: %s' % (f.__name__, e))
+                GObject.idle_add(error_cb, e)
+            else:
+                GObject.idle_add(reply_cb, result)
+        obj.ipa_workers.apply_async(run)
+    return wrapped
+
+
 class FleetCommanderDbusClient(object):
 
     """
@@ -136,15 +168,31 @@ class FleetCommanderDbusClient(object):
     def save_profile(self, profiledata):
         return json.loads(self.iface.SaveProfile(json.dumps(profiledata)))
 
+    def check_profile_targets(self, profiledata):
+        return json.loads(
+            self.iface.CheckProfileTargets(json.dumps(profiledata)))
+
+    def search_directory(self, kind, text):
+        return json.loads(self.iface.SearchDirectory(kind, text))
+
+    def get_ipa_metrics(self):
+        return json.loads(self.iface.GetIPAMetrics())
+
     def get_profiles(self):
         return json.loads(self.iface.GetProfiles())
 
     def get_profile(self, uid):
         return json.loads(self.iface.GetProfile(uid))
 
+    def get_profiles_full(self):
+        return json.loads(self.iface.GetProfilesFull())
+
     def delete_profile(self, uid):
         return json.loads(self.iface.DeleteProfile(uid))
 
+    def refresh_profiles(self):
+        return json.loads(self.iface.RefreshProfiles())
+
     def list_domains(self):
         return json.loads(self.iface.ListDomains())
 
@@ -154,7 +202,10 @@ class FleetCommanderDbusClient(object):
     def session_stop(self):
         return json.loads(self.iface.SessionStop())
 
-    def session_save(self, uid, data):
+    def session_save(self, uid, data, revision=None):
+        if revision is not None:
+            return json.loads(self.iface.SessionSaveFromRevision(
+                uid, revision, json.dumps(data)))
         return json.loads(self.iface.SessionSave(uid, json.dumps(data)))
 
     def is_session_active(self, uuid=''):
@@ -205,30 +256,37 @@ class FleetCommanderDbusService(dbus.service.Object):
 
         self.default_profile_priority = args['default_profile_priority']
 
+        # Time in seconds profiles data is cached locally
+        self.profile_cache_ttl = float(args['profile_cache_ttl'])
+
         # Load FreeIPA connector
-        self.ipa = fcfreeipa.FreeIPAConnector()
+        compression_threshold = args['profile_data_compression_threshold']
+        if compression_threshold in (None, ''):
+            compression_threshold = None
+        else:
+            compression_threshold = int(compression_threshold)
+        self.ipa = fcfreeipa.FreeIPAConnector(
+            compression_threshold=compression_threshold,
+            chunk_size=int(args['profile_data_chunk_size']),
+            directory_cache_ttl=int(args['directory_cache_ttl']),
+            keepalive_interval=int(args['ipa_keepalive_interval']),
+            max_backoff=int(args['ipa_reconnect_max_backoff']))
+        # Threads running IPA requests
+        self.ipa_workers = ThreadPool(int(args['ipa_workers']))
+        # Locks serializing reads and writes of each profile by IPA workers
+        self._profile_locks = {}
+        self._profile_locks_lock = threading.Lock()
 
         self.GOA_PROVIDERS_FILE = os.path.join(
             args['data_dir'], 'fc-goa-providers.ini')
 
         # Initialize database
-        self.db = DBManager(self.database_path)
+        self.db = DBManager(
+            self.database_path,
+            storage_profile=args['database_storage_profile'])
 
         # Initialize change mergers
-        self.changemergers = {
-            'org.gnome.gsettings':
-                mergers.GSettingsChangeMerger(),
-            'org.libreoffice.registry':
-                mergers.LibreOfficeChangeMerger(),
-            'org.chromium.Policies':
-                mergers.ChromiumChangeMerger(),
-            'com.google.chrome.Policies':
-                mergers.ChromiumChangeMerger(),
-            'org.mozilla.firefox':
-                mergers.FirefoxChangeMerger(),
-            'org.freedesktop.NetworkManager':
-                mergers.NetworkManagerChangeMerger(),
-        }
+        self.changemergers = mergers.get_registry(args['mergers_dir'])
 
         # Initialize SSH controller
         self.ssh = sshcontroller.SSHController()
@@ -241,20 +299,35 @@ class FleetCommanderDbusService(dbus.service.Object):
             args['auto_quit_timeout'])
 
     def run(self):
+        # IPA requests are run in other threads
+        GObject.threads_init()
+        dbus.mainloop.glib.threads_init()
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
         bus_name = dbus.service.BusName(DBUS_BUS_NAME, dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, DBUS_OBJECT_PATH)
         self._loop = GObject.MainLoop()
 
+        # Remove values expired while service was not running
+        self.db.purge_expired()
+
         # Start session checking
         self.start_session_checking()
 
+        # Keep IPA connection alive
+        GObject.timeout_add_seconds(
+            self.ipa.session.keepalive_interval, self.ipa_keepalive)
+
         # Set last call time to an initial value
         self._last_call_time = time.time()
 
         # Enter main loop
         self._loop.run()
 
+    def ipa_keepalive(self):
+        self.ipa_workers.apply_async(self.ipa.session.keepalive)
+        # Keep timeout running
+        return True
+
     def get_libvirt_controller(self):
         """
         Get a libvirtcontroller instance
@@ -291,6 +364,136 @@ class FleetCommanderDbusService(dbus.service.Object):
             data.update(self.db.config['hypervisor'])
         return data
 
+    @contextmanager
+    def profile_lock(self, *names):
+        """
+        Context manager holding the locks of given profiles
+
+        Saves of a profile read, merge and write it while holding its lock
+        so concurrent saves do not overwrite each other changes.
+        """
+        with self._profile_locks_lock:
+            # Locks are always taken in the same order to avoid deadlocks
+            locks = [
+                self._profile_locks.setdefault(name, threading.Lock())
+                for name in sorted(set(names))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def get_profiles(self):
+        """
+        Get profiles index from local cache or from IPA server
+        """
+        profiles = self.db.profiles.get_index(self.profile_cache_ttl)
+        if profiles is None:
+            generation = self.db.profiles.get_generation()
+            profiles = self.ipa.get_profiles()
+            if profiles is not None:
+                self.db.profiles.set_index(profiles, generation)
+        return profiles
+
+    def get_profile(self, name):
+        """
+        Get profile data from local cache or from IPA server
+        """
+        profile = self.db.profiles.get_profile(name, self.profile_cache_ttl)
+        if profile is None:
+            # Profile is not cached if it is saved while being fetched
+            generation = self.db.profiles.get_generation()
+            profile = self.ipa.get_profile(name)
+            self.db.profiles.set_profile(name, profile, generation)
+        return profile
+
+    def parse_profile_targets(self, data):
+        """
+        Get users, groups, hosts and hostgroups lists from the comma
+        separated values in given profile data
+        """
+        targets = {}
+        for kind in ('users', 'groups', 'hosts', 'hostgroups'):
+            targets[kind] = filter(
+                None, [t.strip() for t in data.get(kind, '').split(',')])
+        return targets
+
+    def save_session(self, uid, data, revision=None):
+        """
+        Merge live session changesets into a profile and save it
+
+        When the settings revision the session started from is given,
+        changes stored meanwhile by others are detected and merged using a
+        three-way merge, reporting conflicting changes.
+        """
+        with self.profile_lock(uid):
+            return self._save_session(uid, data, revision)
+
+    def _save_session(self, uid, data, revision=None):
+        logging.debug('FC: Saving session')
+        try:
+            profile = self.ipa.get_profile(uid)
+        except Exception, e:
+            logging.debug('Could not parse profile %s: %s' % (uid, e))
+            return {
+                'status': False,
+                'error': 'Could not parse profile %s' % uid
+            }
+
+        logging.debug('FC: Loaded profile')
+
+        # Check for changes saved since the session started
+        current_revision = mergers.get_settings_revision(profile['settings'])
+        base = None
+        if revision and revision != current_revision:
+            base = self.db.profiles.get_revision(revision)
+            if base is None:
+                logging.warning(
+                    'FC: Settings revision %s of profile %s is not known. '
+                    'Merging without conflict detection' % (revision, uid))
+
+        # Changesets are decoded and merged one namespace at a time, so
+        # only one of them is held in memory besides the profile. Stored
+        # changesets indexed by a previous save are not indexed again
+        indexes = self.changemergers.get_indexes(uid, current_revision)
+        conflicts = []
+        try:
+            for ns, changeset in iter_json_object(data):
+                if not isinstance(changeset, list):
+                    logging.debug('FC: Invalid changeset: %s' % ns)
+                    return {
+                        'status': False,
+                        'error': 'Changesets should be a change list'
+                    }
+                logging.debug(
+                    'FC: Merging %s changes into %s settings' % (
+                        len(changeset), ns))
+                conflicts.extend(self.changemergers.merge_changeset(
+                    profile['settings'], ns, changeset, base, indexes))
+                del(changeset)
+        except ValueError, e:
+            logging.debug('FC: Could not parse changesets: %s' % e)
+            return {
+                'status': False,
+                'error': 'Could not parse changesets: %s' % e
+            }
+
+        if conflicts:
+            logging.warning(
+                'FC: %s changes to profile %s conflict with changes saved '
+                'since session started' % (len(conflicts), uid))
+
+        logging.debug('FC: Saving profile')
+        self.ipa.save_profile(profile)
+        self.db.profiles.invalidate(uid)
+        self.changemergers.keep_indexes(
+            uid, mergers.get_settings_revision(profile['settings']), indexes)
+        logging.debug('FC: Saved profile')
+
+        return {'status': True, 'conflicts': conflicts}
+
     def get_domains(self, only_temporary=False):
         tries = 0
         while tries < self.LIST_DOMAINS_RETRIES:
@@ -319,9 +522,10 @@ class FleetCommanderDbusService(dbus.service.Object):
         domain_uuid = self.db.config['uuid']
         tunnel_pid = self.db.config['tunnel_pid']
 
-        del(self.db.config['uuid'])
-        del(self.db.config['tunnel_pid'])
-        del(self.db.config['port'])
+        with self.db.config.batch():
+            del(self.db.config['uuid'])
+            del(self.db.config['tunnel_pid'])
+            del(self.db.config['port'])
 
         try:
             self.get_libvirt_controller().session_stop(domain_uuid, tunnel_pid)
@@ -388,6 +592,7 @@ class FleetCommanderDbusService(dbus.service.Object):
                 logging.debug(
                     'Resetting timer for session check')
                 self._last_heartbeat = time.time()
+                self.db.purge_expired()
         return True
 
     @set_last_call_time
@@ -403,9 +608,11 @@ class FleetCommanderDbusService(dbus.service.Object):
         return json.dumps(state)
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='', out_signature='s')
-    def DoIPAConnection(self):
+                         in_signature='', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def DoIPAConnection(self, reply_cb=None, error_cb=None):
         logging.debug('Connecting to IPA server')
         try:
             self.ipa.connect()
@@ -555,7 +762,19 @@ class FleetCommanderDbusService(dbus.service.Object):
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME,
                          in_signature='', out_signature='s')
-    def GetGlobalPolicy(self):
+    def GetIPAMetrics(self):
+        return json.dumps({
+            'status': True,
+            'connected': self.ipa.session.is_connected(),
+            'commands': self.ipa.session.metrics.get_stats(),
+        })
+
+    @set_last_call_time
+    @ipa_worker
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def GetGlobalPolicy(self, reply_cb=None, error_cb=None):
         logging.debug('Getting global policy')
         try:
             policy = self.ipa.get_global_policy()
@@ -568,9 +787,11 @@ class FleetCommanderDbusService(dbus.service.Object):
             })
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='q', out_signature='s')
-    def SetGlobalPolicy(self, policy):
+                         in_signature='q', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def SetGlobalPolicy(self, policy, reply_cb=None, error_cb=None):
 
         logging.debug(
             'Setting policy to %s' % policy)
@@ -587,33 +808,26 @@ class FleetCommanderDbusService(dbus.service.Object):
             })
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='s', out_signature='s')
-    def SaveProfile(self, profiledata):
+                         in_signature='s', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def SaveProfile(self, profiledata, reply_cb=None, error_cb=None):
         logging.debug(
-            'Data received for saving profile: %s' % profiledata)
+            'Data received for saving profile: %s bytes' % len(profiledata))
 
         data = json.loads(profiledata)
-        logging.debug(
-            'Data after JSON decoding: %s' % data)
 
         profile = {
             'name': data['name'],
             'description': data['description'],
             'priority': int(data['priority']),
             'settings': data['settings'],
-            'groups': filter(
-                None, [g.strip() for g in data['groups'].split(",")]),
-            'users': filter(
-                None, [u.strip() for u in data['users'].split(",")]),
-            'hosts': filter(
-                None, [u.strip() for u in data['hosts'].split(",")]),
-            'hostgroups': filter(
-                None, [u.strip() for u in data['hostgroups'].split(",")]),
         }
+        profile.update(self.parse_profile_targets(data))
 
         logging.debug(
-            'Profile built to be saved: %s' % profile)
+            'Profile built to be saved: %s' % profile['name'])
 
         name = profile['name']
 
@@ -625,7 +839,10 @@ class FleetCommanderDbusService(dbus.service.Object):
 
         try:
             logging.debug('Saving profile into IPA server')
-            self.ipa.save_profile(profile)
+            oldname = profile.get('oldname', name)
+            with self.profile_lock(name, oldname):
+                self.ipa.save_profile(profile)
+                self.db.profiles.invalidate(name, oldname)
             return json.dumps({'status': True})
         except fcfreeipa.RenameToExistingException, e:
             logging.error('Error saving profile %s: %s' % (name, e))
@@ -641,11 +858,54 @@ class FleetCommanderDbusService(dbus.service.Object):
             })
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='', out_signature='s')
-    def GetProfiles(self):
+                         in_signature='s', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def CheckProfileTargets(self, profiledata, reply_cb=None, error_cb=None):
+        data = json.loads(profiledata)
+        targets = self.parse_profile_targets(data)
         try:
-            profiles = self.ipa.get_profiles()
+            missing = self.ipa.find_missing_targets(targets)
+            return json.dumps({
+                'status': True,
+                'missing': missing,
+            })
+        except Exception, e:
+            logging.error('Error checking profile targets: %s' % e)
+            return json.dumps({
+                'status': False,
+                'error': 'Error checking profile targets',
+            })
+
+    @set_last_call_time
+    @ipa_worker
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='ss', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def SearchDirectory(self, kind, text, reply_cb=None, error_cb=None):
+        try:
+            names = self.ipa.directory.complete(
+                kind, text, DIRECTORY_SEARCH_LIMIT)
+            return json.dumps({
+                'status': True,
+                'data': names,
+            })
+        except Exception, e:
+            logging.error('Error searching %s directory: %s' % (kind, e))
+            return json.dumps({
+                'status': False,
+                'error': 'Error searching %s' % kind,
+            })
+
+    @set_last_call_time
+    @ipa_worker
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def GetProfiles(self, reply_cb=None, error_cb=None):
+        try:
+            profiles = self.get_profiles()
             logging.debug('Profiles data fetched: %s' % profiles)
             return json.dumps({
                 'status': True,
@@ -659,15 +919,21 @@ class FleetCommanderDbusService(dbus.service.Object):
             })
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='s', out_signature='s')
-    def GetProfile(self, name):
+                         in_signature='s', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def GetProfile(self, name, reply_cb=None, error_cb=None):
         try:
-            profile = self.ipa.get_profile(name)
-            logging.debug('Profile data fetched for %s: %s' % (name, profile))
+            profile = self.get_profile(name)
+            logging.debug('Profile data fetched for %s' % name)
+            # Keep settings of this revision for three-way session merges
+            revision = mergers.get_settings_revision(profile['settings'])
+            self.db.profiles.keep_revision(revision, profile['settings'])
             return json.dumps({
                 'status': True,
-                'data': profile
+                'data': profile,
+                'revision': revision,
             })
         except Exception, e:
             logging.error('Error reading profile %s from IPA: %s' % (name, e))
@@ -677,17 +943,66 @@ class FleetCommanderDbusService(dbus.service.Object):
             })
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='s', out_signature='s')
-    def DeleteProfile(self, name):
+                         in_signature='', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def GetProfilesFull(self, reply_cb=None, error_cb=None):
+        try:
+            generation = self.db.profiles.get_generation()
+            profiles = self.ipa.get_profiles_full()
+            logging.debug('Full data fetched for %s profiles' % len(profiles))
+            # Fill local cache with fetched data
+            with self.db.profiles.batch():
+                self.db.profiles.set_index([
+                    (profile['name'], profile['description'])
+                    for profile in profiles], generation)
+                for profile in profiles:
+                    self.db.profiles.set_profile(
+                        profile['name'], profile, generation)
+            return json.dumps({
+                'status': True,
+                'data': profiles,
+            })
+        except Exception, e:
+            logging.error('Error reading profiles from IPA: %s' % e)
+            return json.dumps({
+                'status': False,
+                'error': 'Error reading profiles',
+            })
+
+    @set_last_call_time
+    @ipa_worker
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='s', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def DeleteProfile(self, name, reply_cb=None, error_cb=None):
         logging.debug('Deleting profile %s' % name)
         try:
-            self.ipa.del_profile(name)
+            with self.profile_lock(name):
+                self.ipa.del_profile(name)
+                self.db.profiles.invalidate(name)
             return json.dumps({'status': True})
         except Exception, e:
             logging.error('Error removing profile %s: %s' % (name, e))
             return json.dumps({'status': False})
 
+    @set_last_call_time
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='', out_signature='s')
+    def RefreshProfiles(self):
+        logging.debug('Discarding locally cached profiles data')
+        try:
+            self.db.profiles.invalidate_all()
+            self.ipa.directory.invalidate()
+            return json.dumps({'status': True})
+        except Exception, e:
+            logging.error('Error discarding cached profiles data: %s' % e)
+            return json.dumps({
+                'status': False,
+                'error': 'Error refreshing profiles data'
+            })
+
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME,
                          in_signature='', out_signature='s')
@@ -726,9 +1041,11 @@ class FleetCommanderDbusService(dbus.service.Object):
                 'status': False,
                 'error': 'Error starting session'})
 
-        self.db.config['uuid'] = new_uuid
-        self.db.config['port'] = port
-        self.db.config['tunnel_pid'] = tunnel_pid
+        self.db.config.update({
+            'uuid': new_uuid,
+            'port': port,
+            'tunnel_pid': tunnel_pid,
+        })
 
         return json.dumps({'status': True, 'port': port})
 
@@ -743,71 +1060,20 @@ class FleetCommanderDbusService(dbus.service.Object):
             return json.dumps({'status': False, 'error': msg})
 
     @set_last_call_time
+    @ipa_worker
     @dbus.service.method(DBUS_INTERFACE_NAME,
-                         in_signature='ss', out_signature='s')
-    def SessionSave(self, uid, data):
-        logging.debug('FC: Saving session')
-        try:
-            profile = self.ipa.get_profile(uid)
-        except Exception, e:
-            logging.debug('Could not parse profile %s: %s' % (uid, e))
-            return json.dumps({
-                'status': False,
-                'error': 'Could not parse profile %s' % uid
-            })
-
-        logging.debug('FC: Loaded profile')
-
-        # Handle changesets
-        try:
-            changesets = json.loads(data)
-        except Exception, e:
-            logging.debug(
-                'Could not parse changeset: %s. Data: %s' % (e, data))
-            return json.dumps({
-                'status': False,
-                'error': 'Could not parse changesets: %s' % data
-            })
-
-        logging.debug('FC: Changesets loaded: %s' % changesets)
-
-        if not isinstance(changesets, dict):
-            logging.debug('FC: Invalid changesets data')
-            return json.dumps({
-                'status': False,
-                'error': 'Changesets should be a namespace/changes lists dict'
-            })
-
-        # Save changes
-        for ns, changeset in changesets.items():
-            logging.debug('FC: Processing %s changeset: %s' % (ns, changeset))
-            if not isinstance(changeset, list):
-                logging.debug('FC: Invalid changeset: %s' % ns)
-                return json.dumps({
-                    'status': False,
-                    'error': 'Changesets should be a change list'
-                })
+                         in_signature='ss', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def SessionSave(self, uid, data, reply_cb=None, error_cb=None):
+        return json.dumps(self.save_session(uid, data))
 
-            logging.debug('FC: Adding changes to profile')
-            if ns not in profile['settings']:
-                logging.debug('FC: Adding new changeset into profile')
-                profile['settings'][ns] = changeset
-            else:
-                if ns in self.changemergers:
-                    logging.debug('FC: Merging changeset into profile')
-                    profile['settings'][ns] = self.changemergers[ns].merge(
-                        profile['settings'][ns],
-                        changeset)
-                else:
-                    logging.debug(
-                        'FC: No merger found for %s. Replacing changes' % ns)
-                    profile['settings'][ns] = changeset
-
-        logging.debug('FC: Saving profile')
-        self.ipa.save_profile(profile)
-        logging.debug('FC: Saved profile')
-
-        return json.dumps({'status': True})
+    @set_last_call_time
+    @ipa_worker
+    @dbus.service.method(DBUS_INTERFACE_NAME,
+                         in_signature='sss', out_signature='s',
+                         async_callbacks=('reply_cb', 'error_cb'))
+    def SessionSaveFromRevision(self, uid, revision, data, reply_cb=None, error_cb=None):
+        return json.dumps(self.save_session(uid, data, revision))
 
     @set_last_call_time
     @dbus.service.method(DBUS_INTERFACE_NAME,
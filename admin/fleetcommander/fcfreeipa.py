@@ -21,18 +21,23 @@
 
 import json
 import logging
+import time
+import hashlib
+import threading
 from functools import wraps
 import base64
 
 from ipalib import api
 from ipalib import errors
 
+from profiledata import dump_settings, encode_settings, decode_settings
+from directory import DirectorySnapshot
+
 
 def connection_required(f):
     @wraps(f)
     def wrapped(obj, *args, **kwargs):
-        if not api.isdone('bootstrap'):
-            obj.connect()
+        obj.session.ensure()
         return f(obj, *args, **kwargs)
     return wrapped
 
@@ -45,37 +50,334 @@ class RenameToExistingException(Exception):
     pass
 
 
-class FreeIPAConnector(object):
+class IPACommandError(Exception):
+    pass
 
-    def connect(self, sanity_check=True):
+
+class RPCMetrics(object):
+    """
+    Latency statistics of IPA commands by command name
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, command, elapsed, failed=False):
+        with self._lock:
+            stats = self._stats.setdefault(command, {
+                'calls': 0,
+                'errors': 0,
+                'total_time': 0.0,
+                'max_time': 0.0,
+            })
+            stats['calls'] += 1
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            if failed:
+                stats['errors'] += 1
+
+    def get_stats(self):
         """
-        Connect to FreeIPA server
+        Returns statistics by command name, with times in seconds
+        """
+        with self._lock:
+            result = {}
+            for command, stats in self._stats.items():
+                result[command] = dict(stats)
+                result[command]['avg_time'] = \
+                    stats['total_time'] / stats['calls']
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class IPASession(object):
+    """
+    Managed connection to the IPA server
+
+    The connection is opened lazily on first use and reused afterwards
+    without checking it on every call. Commands failing because of
+    connection errors invalidate it, so it is opened again on next use,
+    and read only commands are retried once on the new connection.
+    Failed connection attempts are retried with exponential backoff.
+
+    ipalib keeps RPC client connections per thread, so connection state
+    is tracked for each thread.
+    """
+
+    # Delay before first reconnection attempt, in seconds
+    INITIAL_BACKOFF = 1
+
+    # Names of ipalib errors meaning the connection is no longer usable
+    CONNECTION_ERRORS = ('NetworkError', 'KerberosError')
+
+    # Commands that can be run again after a connection error
+    IDEMPOTENT_COMMANDS = ('ping',)
+    IDEMPOTENT_SUFFIXES = ('_show', '_find')
+
+    def __init__(self, keepalive_interval=240, max_backoff=60):
+        self.keepalive_interval = keepalive_interval
+        self.max_backoff = max_backoff
+        self.metrics = RPCMetrics()
+        self.Command = IPACommandProxy(self)
+        # Connections opened before an invalidation are discarded
+        self._generation = 0
+        self._failures = 0
+        self._retry_time = 0
+        self._invalidation_callbacks = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def add_invalidation_callback(self, callback):
+        """
+        Registers a function called with the reason of every invalidation
+        """
+        self._invalidation_callbacks.append(callback)
+
+    def is_connected(self):
+        return getattr(self._local, 'generation', None) == self._generation \
+            and api.isdone('bootstrap') and api.Backend.rpcclient.isconnected()
+
+    def is_idle(self):
+        """
+        Checks if the connection of current thread has been idle for
+        longer than the keep-alive interval
         """
+        idle = time.time() - getattr(self._local, 'last_activity', 0)
+        return idle >= self.keepalive_interval
+
+    def ensure(self):
+        """
+        Connects to IPA server unless already connected. Idle connections
+        are checked with a ping, so a connection dropped by the server is
+        opened again before running commands that can not be retried
+        """
+        if not self.is_connected():
+            self.connect()
+        elif self.is_idle():
+            self.Command.ping()
+
+    def connect(self, check=False):
+        """
+        Connects to IPA server. When check is set, the connection is
+        verified with a ping
+        """
+        with self._lock:
+            wait = self._retry_time - time.time()
+            generation = self._generation
+        if wait > 0:
+            raise IPAConnectionError(
+                'Not connected to FreeIPA. Retrying in %d seconds' % (
+                    wait + 1))
         try:
-            if not api.isdone('bootstrap'):
-                api.bootstrap(context='fleetcommander', log=None)
-                api.finalize()
-            if not api.Backend.rpcclient.isconnected():
-                api.Backend.rpcclient.connect()
-            api.Command.ping()
-            # Sanity check
-            if sanity_check:
-                self._do_sanity_check()
+            # Several threads may be connecting at once
+            with self._lock:
+                if not api.isdone('bootstrap'):
+                    api.bootstrap(context='fleetcommander', log=None)
+                    api.finalize()
+            if api.Backend.rpcclient.isconnected():
+                api.Backend.rpcclient.disconnect()
+            api.Backend.rpcclient.connect()
+            self._local.generation = generation
+            self._local.last_activity = time.time()
+            if check:
+                self.Command.ping()
         except Exception, e:
+            self._local.generation = None
+            with self._lock:
+                self._failures += 1
+                backoff = min(
+                    self.INITIAL_BACKOFF * 2 ** (self._failures - 1),
+                    self.max_backoff)
+                self._retry_time = time.time() + backoff
             logging.error(
-                'FreeIPAConnector: Error connecting to FreeIPA: %s' % e)
+                'FreeIPAConnector: Error connecting to FreeIPA: %s. '
+                'Retrying in %s seconds' % (e, backoff))
             raise
+        with self._lock:
+            self._failures = 0
+            self._retry_time = 0
+
+    def invalidate(self, reason=None):
+        """
+        Discards current connections so they are opened again on next use
+        """
+        logging.debug(
+            'FreeIPAConnector: Invalidating IPA session: %s' % reason)
+        with self._lock:
+            self._generation += 1
+        self._local.generation = None
+        try:
+            if api.isdone('bootstrap') and \
+                    api.Backend.rpcclient.isconnected():
+                api.Backend.rpcclient.disconnect()
+        except Exception, e:
+            logging.debug(
+                'FreeIPAConnector: Error disconnecting from FreeIPA: %s' % e)
+        for callback in self._invalidation_callbacks:
+            callback(reason)
+
+    def keepalive(self):
+        """
+        Pings IPA server if the connection of current thread has been idle
+        for longer than the keep-alive interval. Connections of other threads
+        are checked by ensure() on their next use
+        """
+        if not self.is_connected():
+            return
+        if self.is_idle():
+            try:
+                self.Command.ping()
+            except Exception, e:
+                logging.debug(
+                    'FreeIPAConnector: IPA session keep-alive failed: %s' % e)
+
+    def is_connection_error(self, e):
+        error_names = [getattr(errors, name)
+                       for name in self.CONNECTION_ERRORS
+                       if hasattr(errors, name)]
+        return bool(error_names) and isinstance(e, tuple(error_names))
+
+    def is_idempotent(self, command, args=()):
+        """
+        Checks if given command only reads data from IPA server
+        """
+        if command == 'batch':
+            return all([self.is_idempotent(method['method'])
+                        for method in args])
+        return command in self.IDEMPOTENT_COMMANDS or \
+            command.endswith(self.IDEMPOTENT_SUFFIXES)
+
+    def call(self, command, *args, **kwargs):
+        """
+        Runs given IPA command recording its latency. Read only commands
+        failing because of a connection error are run again once on a new
+        connection
+        """
+        try:
+            return self._call(command, *args, **kwargs)
+        except Exception, e:
+            if not self.is_connection_error(e) or \
+                    not self.is_idempotent(command, args):
+                raise
+        logging.info(
+            'FreeIPAConnector: Retrying %s on a new connection' % command)
+        self.connect()
+        return self._call(command, *args, **kwargs)
+
+    def _call(self, command, *args, **kwargs):
+        start = time.time()
+        failed = True
+        try:
+            result = getattr(api.Command, command)(*args, **kwargs)
+            failed = False
+            return result
+        except Exception, e:
+            if self.is_connection_error(e):
+                self.invalidate('%s failed: %s' % (command, e))
+            raise
+        finally:
+            self._local.last_activity = time.time()
+            self.metrics.record(
+                command, self._local.last_activity - start, failed)
+
+
+class IPACommandProxy(object):
+    """
+    Runs IPA commands accessed as attributes through an IPA session
+    """
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, name):
+        if not hasattr(api.Command, name):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return self._session.call(name, *args, **kwargs)
+        return command
+
+
+class FreeIPAConnector(object):
+
+    # Maximum number of commands sent in a single batch request
+    BATCH_SIZE = 500
+
+    # Commands used to look up each kind of profile target
+    TARGET_SHOW_COMMANDS = (
+        ('users', 'user_show'),
+        ('groups', 'group_show'),
+        ('hosts', 'host_show'),
+        ('hostgroups', 'hostgroup_show'),
+    )
+
+    # Commands and attributes used to get all names of each kind
+    TARGET_FIND_COMMANDS = {
+        'users': ('user_find', 'uid'),
+        'groups': ('group_find', 'cn'),
+        'hosts': ('host_find', 'fqdn'),
+        'hostgroups': ('hostgroup_find', 'cn'),
+    }
+
+    # Commands removing what each command creating profiles added
+    DELETE_COMMANDS = {
+        'deskprofile_add': 'deskprofile_del',
+        'deskprofilerule_add': 'deskprofilerule_del',
+    }
+
+    def __init__(self, compression_threshold=None, chunk_size=0,
+                 directory_cache_ttl=300, keepalive_interval=240,
+                 max_backoff=60):
+        # Connection to IPA server
+        self.session = IPASession(keepalive_interval, max_backoff)
+        # Profile data encoding. See profiledata.encode_settings()
+        self.compression_threshold = compression_threshold
+        self.chunk_size = chunk_size
+        # Local snapshot of users, groups, hosts and hostgroups names
+        self.directory = DirectorySnapshot(
+            self.get_directory_names, directory_cache_ttl)
+
+    def _get_profile_digest(self, profile):
+        return hashlib.sha1('%s\0%s' % (
+            json.dumps(profile['description']),
+            dump_settings(profile['settings']))).hexdigest()
+
+    def _get_profile_data_digest(self, data):
+        return self._get_profile_digest({
+            'description': data.get('description', ('',))[0],
+            'settings': decode_settings(data['ipadeskdata'][0]),
+        })
+
+    def _encode_profile_data(self, profile):
+        data = encode_settings(
+            profile['settings'], self.compression_threshold, self.chunk_size)
+        logging.debug(
+            'FreeIPAConnector: Profile %s data encoded in %s bytes' % (
+                profile['name'], len(data)))
+        return unicode(base64.b64encode(data))
+
+    def connect(self, sanity_check=True):
+        """
+        Connect to FreeIPA server
+        """
+        self.session.connect(check=True)
+        # Sanity check
+        if sanity_check:
+            self._do_sanity_check()
 
     def _create_profile(self, profile):
         name = unicode(profile['name'])
         logging.debug(
             'FreeIPAConnector: Creating profile %s' % name)
         try:
-            api.Command.deskprofile_add(
+            self.session.Command.deskprofile_add(
                 name,
                 description=unicode(profile['description']),
-                ipadeskdata=unicode(
-                    base64.b64encode(json.dumps(profile['settings'])))
+                ipadeskdata=self._encode_profile_data(profile)
             )
             self._create_profile_rules(profile)
         except Exception, e:
@@ -85,6 +387,9 @@ class FreeIPAConnector(object):
             raise e
 
     def _create_profile_rules(self, profile):
+        self._run_commands(self._get_profile_rules_create_commands(profile))
+
+    def _get_profile_rules_create_commands(self, profile):
         name = unicode(profile['name'])
         # Save rule for profile
         logging.debug(
@@ -98,8 +403,7 @@ class FreeIPAConnector(object):
         if profile['hosts'] == [] and profile['hostgroups'] == []:
             parms['hostcategory'] = u'all'
 
-        api.Command.deskprofilerule_add(
-            name, **parms)
+        commands = [('deskprofilerule_add', [name], parms)]
 
         # Save rules for users
         users = map(unicode, profile['users'])
@@ -107,7 +411,10 @@ class FreeIPAConnector(object):
         logging.debug(
             'FreeIPAConnector: Setting users/groups for profile %s: %s, %s' % (
                 name, users, groups))
-        api.Command.deskprofilerule_add_user(name, user=users, group=groups)
+        if users or groups:
+            commands.append((
+                'deskprofilerule_add_user', [name],
+                {'user': users, 'group': groups}))
 
         # Save rules for hosts if needed
         if 'hostcategory' not in parms:
@@ -116,20 +423,110 @@ class FreeIPAConnector(object):
             logging.debug(
                 'FreeIPAConnector: Setting hosts for profile %s: %s, %s' % (
                     name, hosts, hostgroups))
-            api.Command.deskprofilerule_add_host(
-                name, host=hosts, hostgroup=hostgroups)
+            commands.append((
+                'deskprofilerule_add_host', [name],
+                {'host': hosts, 'hostgroup': hostgroups}))
         else:
             logging.debug(
                 'FreeIPAConnector: Skipping hosts for profile %s' % name)
 
-    def _update_profile(self, profile, oldname=None):
+        return commands
+
+    @connection_required
+    def create_profiles(self, profiles):
+        """
+        Creates several new profiles, sending the commands for all of them
+        in batch requests of up to BATCH_SIZE commands
+
+        Profiles are added first, then their rules and then the rule members,
+        so commands of a profile are only run while the previous ones succeed
+        and existing profiles or rules are never modified.
+
+        Returns a dictionary with the error for each profile that could not
+        be created. Whatever was added for failed profiles is removed.
+        """
+        if not hasattr(api.Command, 'batch'):
+            failed = {}
+            for profile in profiles:
+                try:
+                    self._create_profile(profile)
+                except Exception, e:
+                    failed[profile['name']] = '%s' % e
+            return failed
+
+        # Commands of each profile by step
+        steps = {}
+        for profile in profiles:
+            name = unicode(profile['name'])
+            rule_commands = self._get_profile_rules_create_commands(profile)
+            steps[profile['name']] = [
+                [('deskprofile_add', [name], {
+                    'description': unicode(profile['description']),
+                    'ipadeskdata': self._encode_profile_data(profile),
+                })],
+                rule_commands[:1],
+                rule_commands[1:],
+            ]
+
+        failed = {}
+        added = {}
+        for step in range(3):
+            commands = []
+            for profile in profiles:
+                if profile['name'] not in failed:
+                    commands.extend([
+                        (profile['name'], command)
+                        for command in steps[profile['name']][step]])
+            for i in range(0, len(commands), self.BATCH_SIZE):
+                chunk = commands[i:i + self.BATCH_SIZE]
+                results = self._run_batch([command for name, command in chunk])
+                for (name, command), result in zip(chunk, results):
+                    if result.get('error') is None:
+                        if command[0] in self.DELETE_COMMANDS:
+                            added.setdefault(name, []).append(command[0])
+                    elif name not in failed:
+                        failed[name] = 'Error running %s: %s' % (
+                            command[0], result['error'])
+
+        commands = []
+        for name in failed:
+            if name in added:
+                logging.error(
+                    'FreeIPAConnector: Error creating profile %s: %s' % (
+                        name, failed[name]))
+            for command in added.get(name, []):
+                commands.append(
+                    (self.DELETE_COMMANDS[command], [unicode(name)], {}))
+        if commands:
+            results = self._run_batch(commands)
+            for (command, args, options), result in zip(commands, results):
+                if result.get('error') is not None:
+                    logging.error(
+                        'FreeIPAConnector: Error running %s for %s: %s' % (
+                            command, args[0], result['error']))
+        return failed
+
+    def _update_profile(self, profile, oldname=None, current=None):
+        """
+        Updates an existing profile. When given, current is the profile data
+        just read from IPA, used to skip updates that would not modify it
+        """
         name = unicode(profile['name'])
 
+        if oldname is None and current is not None and \
+                self._get_profile_data_digest(current) == \
+                self._get_profile_digest(profile):
+            logging.debug(
+                'FreeIPAConnector: Profile %s data unchanged. '
+                'Skipping update' % name)
+            # Update rules for profile
+            self._update_profile_rules(profile)
+            return
+
         parms = {
             'cn': name,
             'description': unicode(profile['description']),
-            'ipadeskdata': unicode(
-                base64.b64encode(json.dumps(profile['settings'])))
+            'ipadeskdata': self._encode_profile_data(profile)
         }
 
         if oldname is not None:
@@ -143,7 +540,7 @@ class FreeIPAConnector(object):
             logging.debug(
                 'FreeIPAConnector: Updating profile %s' % name)
         try:
-            api.Command.deskprofile_mod(**parms)
+            self.session.Command.deskprofile_mod(**parms)
         except errors.EmptyModlist:
             pass
         except Exception, e:
@@ -156,116 +553,160 @@ class FreeIPAConnector(object):
     def _update_profile_rules(self, profile, oldname=None):
         name = unicode(profile['name'])
 
-        parms = {
-            'cn': name,
-            'ipadeskprofiletarget': name,
-            'ipadeskprofilepriority': profile['priority'],
-        }
-
         if oldname is not None:
             # Update profile renaming it
             logging.debug(
                 'FreeIPAConnector: Updating rule %s and renaming to %s' % (
                     oldname, name))
-            parms['cn'] = oldname
-            parms['rename'] = name
+            rule = self.get_profile_rule(oldname)
         else:
             logging.debug(
                 'FreeIPAConnector: Updating rule for %s' % name)
+            rule = self.get_profile_rule(name)
 
-        # If not hosts, set hostcategory to all
-        if profile['hosts'] == [] and profile['hostgroups'] == []:
-            parms['hostcategory'] = u'all'
-        else:
-            parms['hostcategory'] = None
+        commands, verify = self._plan_profile_rules_update(
+            profile, rule, oldname)
+        if verify:
+            # Hosts may be silently ignored by IPA when they do not exist,
+            # so read back the final rule within the same request
+            commands.append(('deskprofilerule_show', [name], {'all': True}))
 
+        logging.debug(
+            'FreeIPAConnector: Rule update for %s needs %s commands' % (
+                name, len(commands)))
         try:
-            api.Command.deskprofilerule_mod(**parms)
-        except errors.EmptyModlist:
-            pass
+            results = self._run_commands(commands)
         except Exception, e:
             logging.error(
                 'FreeIPAConnector: Error updating rule %s: %s - %s' % (
                     name, e, e.__class__))
             raise e
 
-        # Get current users, groups, hosts and hostgroups for this rule
-        rule = self.get_profile_rule(name)
-        applies = self._get_profile_applies_from_rule(rule)
-        # Get users and groups to add
-        udif = set(profile['users']) - set(applies['users'])
-        gdif = set(profile['groups']) - set(applies['groups'])
-        # Add the users and groups to rule
-        api.Command.deskprofilerule_add_user(
-            name,
-            user=map(unicode, udif),
-            group=map(unicode, gdif)
-        )
-        # Get users and groups to remove
-        udif = set(applies['users']) - set(profile['users'])
-        gdif = set(applies['groups']) - set(profile['groups'])
-        # Remove users and groups from rule
-        api.Command.deskprofilerule_remove_user(
-            name,
-            user=map(unicode, udif),
-            group=map(unicode, gdif)
-        )
-
-        if parms['hostcategory'] == 'all':
-            api.Command.deskprofilerule_remove_host(
-                name,
-                host=map(unicode, applies['hosts']),
-                hostgroup=map(unicode, applies['hostgroups'])
-            )
-        else:
-            # Get hosts and hostgroups to add
-            hdif = set(profile['hosts']) - set(applies['hosts'])
-            hgdif = set(profile['hostgroups']) - set(applies['hostgroups'])
-            # Add the hosts and hostgroups to rule
-            api.Command.deskprofilerule_add_host(
-                name,
-                host=map(unicode, hdif),
-                hostgroup=map(unicode, hgdif)
-            )
-            # Get hosts and hostgroups to remove
-            hdif = set(applies['hosts']) - set(profile['hosts'])
-            hgdif = set(applies['hostgroups']) - set(profile['hostgroups'])
-            # Remove hosts and hostgroups from rule
-            api.Command.deskprofilerule_remove_host(
-                name,
-                host=map(unicode, hdif),
-                hostgroup=map(unicode, hgdif)
-            )
-
+        if verify:
             # Check final hosts and set hostcategory to all if needed
-            rule = self.get_profile_rule(name)
-            applies = self._get_profile_applies_from_rule(rule)
+            applies = self._get_profile_applies_from_rule(
+                results[-1]['result'])
             logging.debug(
                 'FreeIPAConnector: Applies after update: %s' % applies)
             if applies['hosts'] == [] and applies['hostgroups'] == []:
                 logging.debug(
                     'FreeIPAConnector: Setting hostcategory to all')
-                parms['hostcategory'] = u'all'
-                try:
-                    api.Command.deskprofilerule_mod(**parms)
-                except errors.EmptyModlist:
-                    pass
-                except Exception, e:
-                    logging.error(
-                        'FreeIPAConnector: Error updating rule %s: %s - %s' % (
-                            name, e, e.__class__))
-                    raise e
+                parms = {
+                    'ipadeskprofiletarget': name,
+                    'ipadeskprofilepriority': profile['priority'],
+                    'hostcategory': u'all',
+                }
+                self._run_commands([('deskprofilerule_mod', [name], parms)])
 
-    def _get_all_hosts(self):
-        try:
-            hosts = []
-            for host in api.Command.host_find(sizelimit=0)['result']:
-                hosts.append(host['fqdn'][0])
-            return hosts
-        except Exception, e:
-            logging.error(
-                'FreeIPAConnector: Error getting hosts list')
-            raise
+    def _plan_profile_rules_update(self, profile, rule, oldname=None):
+        """
+        Computes the commands needed to turn given rule into the rule for
+        given profile. Commands that would not modify anything are left out.
+
+        Returns the list of commands and whether the resulting hosts need
+        to be checked afterwards
+        """
+        name = unicode(profile['name'])
+        applies = self._get_profile_applies_from_rule(rule)
+        commands = []
+
+        # If not hosts, set hostcategory to all
+        if profile['hosts'] == [] and profile['hostgroups'] == []:
+            hostcategory = u'all'
+        else:
+            hostcategory = None
+
+        current_hostcategory = rule.get('hostcategory', (None,))[0]
+        current_priority = int(rule['ipadeskprofilepriority'][0])
+        if oldname is not None or hostcategory != current_hostcategory or \
+                int(profile['priority']) != current_priority:
+            parms = {
+                'ipadeskprofiletarget': name,
+                'ipadeskprofilepriority': profile['priority'],
+                'hostcategory': hostcategory,
+            }
+            if oldname is not None:
+                parms['rename'] = name
+                commands.append(
+                    ('deskprofilerule_mod', [unicode(oldname)], parms))
+            else:
+                commands.append(('deskprofilerule_mod', [name], parms))
+
+        def add_members(command, members):
+            # Skip commands with nothing to add or remove
+            if any(members.values()):
+                commands.append((command, [name], dict(
+                    [(key, map(unicode, sorted(values)))
+                     for key, values in members.items()])))
+
+        # Users and groups to add and remove
+        add_members('deskprofilerule_add_user', {
+            'user': set(profile['users']) - set(applies['users']),
+            'group': set(profile['groups']) - set(applies['groups']),
+        })
+        add_members('deskprofilerule_remove_user', {
+            'user': set(applies['users']) - set(profile['users']),
+            'group': set(applies['groups']) - set(profile['groups']),
+        })
+
+        if hostcategory == 'all':
+            add_members('deskprofilerule_remove_host', {
+                'host': applies['hosts'],
+                'hostgroup': applies['hostgroups'],
+            })
+            return commands, False
+
+        # Hosts and hostgroups to add and remove
+        add_members('deskprofilerule_add_host', {
+            'host': set(profile['hosts']) - set(applies['hosts']),
+            'hostgroup': set(profile['hostgroups']) - set(applies['hostgroups']),
+        })
+        add_members('deskprofilerule_remove_host', {
+            'host': set(applies['hosts']) - set(profile['hosts']),
+            'hostgroup': set(applies['hostgroups']) - set(profile['hostgroups']),
+        })
+
+        # Rule is left without hosts if none of the kept ones remain and
+        # every added one is unknown to IPA
+        kept = set(profile['hosts']) & set(applies['hosts']) or \
+            set(profile['hostgroups']) & set(applies['hostgroups'])
+        return commands, not kept
+
+    def _run_commands(self, commands):
+        """
+        Runs given (command, args, options) tuples in order. When there is
+        more than one they are sent in a single batch request.
+
+        Returns the list of command results
+        """
+        if len(commands) > 1 and hasattr(api.Command, 'batch'):
+            results = self._run_batch(commands)
+            for (command, args, options), result in zip(commands, results):
+                if result.get('error') is not None and \
+                        result.get('error_name') != 'EmptyModlist':
+                    raise IPACommandError(
+                        'Error running %s for %s: %s' % (
+                            command, args, result['error']))
+            return results
+
+        results = []
+        for command, args, options in commands:
+            try:
+                results.append(
+                    getattr(self.session.Command, command)(*args, **options))
+            except errors.EmptyModlist:
+                results.append(None)
+        return results
+
+    def _run_batch(self, commands):
+        """
+        Sends given (command, args, options) tuples in a single batch
+        request. Returns their results, with the error of failed commands
+        """
+        methods = [
+            {'method': unicode(command), 'params': [args, options]}
+            for command, args, options in commands]
+        return self.session.Command.batch(*methods)['results']
 
     def _do_sanity_check(self):
         """
@@ -302,7 +743,7 @@ class FreeIPAConnector(object):
     @connection_required
     def check_user_exists(self, username):
         try:
-            result = api.Command.user_show(unicode(username))
+            result = self.session.Command.user_show(unicode(username))
             return True
         except errors.NotFound:
             return False
@@ -310,7 +751,7 @@ class FreeIPAConnector(object):
     @connection_required
     def check_group_exists(self, groupname):
         try:
-            result = api.Command.group_show(unicode(groupname))
+            result = self.session.Command.group_show(unicode(groupname))
             return True
         except errors.NotFound:
             return False
@@ -318,7 +759,7 @@ class FreeIPAConnector(object):
     @connection_required
     def check_host_exists(self, hostname):
         try:
-            result = api.Command.host_show(unicode(hostname))
+            result = self.session.Command.host_show(unicode(hostname))
             return True
         except errors.NotFound:
             return False
@@ -326,28 +767,118 @@ class FreeIPAConnector(object):
     @connection_required
     def check_hostgroup_exists(self, groupname):
         try:
-            result = api.Command.hostgroup_show(unicode(groupname))
+            result = self.session.Command.hostgroup_show(unicode(groupname))
             return True
         except errors.NotFound:
             return False
 
+    @connection_required
+    def find_missing_users(self, usernames):
+        return self.find_missing_targets({'users': usernames})['users']
+
+    @connection_required
+    def find_missing_groups(self, groupnames):
+        return self.find_missing_targets({'groups': groupnames})['groups']
+
+    @connection_required
+    def find_missing_hosts(self, hostnames):
+        return self.find_missing_targets({'hosts': hostnames})['hosts']
+
+    @connection_required
+    def find_missing_hostgroups(self, groupnames):
+        return self.find_missing_targets(
+            {'hostgroups': groupnames})['hostgroups']
+
+    @connection_required
+    def find_missing_targets(self, targets):
+        """
+        Checks users, groups, hosts and hostgroups existence in bulk
+
+        Takes a dictionary with lists of names by kind and returns a
+        dictionary with sorted lists of the names that do not exist in IPA.
+        Names found in IPA are added to the loaded directory snapshot
+        """
+        lookups = []
+        for kind, command in self.TARGET_SHOW_COMMANDS:
+            names = set(targets.get(kind, []))
+            # Names in a loaded directory snapshot are known to exist
+            if names and self.directory.is_loaded(kind):
+                index = self.directory.get_index(kind)
+                names = [name for name in names if name not in index]
+            for name in sorted(names):
+                lookups.append((kind, name, command))
+        missing = dict([
+            (kind, []) for kind, command in self.TARGET_SHOW_COMMANDS])
+        found = dict([
+            (kind, []) for kind, command in self.TARGET_SHOW_COMMANDS])
+
+        if len(lookups) < 2 or not hasattr(api.Command, 'batch'):
+            for kind, name, command in lookups:
+                try:
+                    result = getattr(self.session.Command, command)(
+                        unicode(name))
+                    found[kind].append(result.get('value') or name)
+                except errors.NotFound:
+                    missing[kind].append(name)
+            self._update_directory(found)
+            return missing
+
+        for i in range(0, len(lookups), self.BATCH_SIZE):
+            chunk = lookups[i:i + self.BATCH_SIZE]
+            results = self._run_batch([
+                (command, [unicode(name)], {})
+                for kind, name, command in chunk])
+            for (kind, name, command), result in zip(chunk, results):
+                if result.get('error') is None:
+                    found[kind].append(result.get('value') or name)
+                    continue
+                if result.get('error_name') != 'NotFound':
+                    raise IPACommandError(
+                        'Error running %s for %s: %s' % (
+                            command, name, result['error']))
+                missing[kind].append(name)
+        self._update_directory(found)
+        return missing
+
+    def _update_directory(self, found):
+        # Names created in IPA after the snapshot was loaded
+        for kind, names in found.items():
+            if names:
+                self.directory.update(kind, added=names)
+
+    @connection_required
+    def get_directory_names(self, kinds):
+        """
+        Get all names of given kinds of profile targets in a single request
+        """
+        results = self._run_commands([
+            (self.TARGET_FIND_COMMANDS[kind][0], [],
+             {'sizelimit': 0, 'pkey_only': True})
+            for kind in kinds])
+        names = {}
+        for kind, result in zip(kinds, results):
+            attribute = self.TARGET_FIND_COMMANDS[kind][1]
+            names[kind] = [entry[attribute][0] for entry in result['result']]
+        return names
+
     @connection_required
     def check_profile_exists(self, name):
         try:
-            result = api.Command.deskprofile_show(unicode(name), all=False)
+            result = self.session.Command.deskprofile_show(
+                unicode(name), all=False)
             return True
         except errors.NotFound:
             return False
 
     @connection_required
     def get_global_policy(self):
-        policydata = api.Command.deskprofileconfig_show()
+        policydata = self.session.Command.deskprofileconfig_show()
         return int(policydata['result']['ipadeskprofilepriority'][0])
 
     @connection_required
     def set_global_policy(self, policy):
         try:
-            api.Command.deskprofileconfig_mod(
+            self.session.Command.deskprofileconfig_mod(
                 ipadeskprofilepriority=policy)
         except errors.EmptyModlist:
             pass
@@ -381,11 +912,16 @@ class FreeIPAConnector(object):
                 return self._update_profile(profile, oldname=oldname)
         else:
             # Check if profile already exists
-            if self.check_profile_exists(name):
+            try:
+                current = self.session.Command.deskprofile_show(
+                    unicode(name), all=True)['result']
+            except errors.NotFound:
+                current = None
+            if current is not None:
                 # Modify it
                 logging.debug(
                     'FreeIPAConnector: Profile %s already exists. Updating' % name)
-                return self._update_profile(profile)
+                return self._update_profile(profile, current=current)
             else:
                 # Save new
                 logging.debug(
@@ -398,7 +934,7 @@ class FreeIPAConnector(object):
         logging.debug(
             'FreeIPAConnector: Deleting profile %s' % name)
         try:
-            api.Command.deskprofile_del(name)
+            self.session.Command.deskprofile_del(name)
         except Exception, e:
             logging.error(
                 'FreeIPAConnector: Error removing profile %s. %s - %s' % (
@@ -407,7 +943,7 @@ class FreeIPAConnector(object):
         logging.debug(
             'FreeIPAConnector: Deleting profile rule for %s' % name)
         try:
-            api.Command.deskprofilerule_del(name)
+            self.session.Command.deskprofilerule_del(name)
         except Exception, e:
             logging.error(
                 'FreeIPAConnector: Error removing rule for profile %s. %s - %s' % (
@@ -416,7 +952,8 @@ class FreeIPAConnector(object):
     @connection_required
     def get_profiles(self):
         try:
-            results = api.Command.deskprofile_find('', sizelimit=0, all=True)
+            results = self.session.Command.deskprofile_find(
+                '', sizelimit=0, all=True)
         except Exception, e:
             logging.error(
                 'FreeIPAConnector: Error getting profiles: %s - %s' % (
@@ -436,18 +973,88 @@ class FreeIPAConnector(object):
     def get_profile(self, name):
         name = unicode(name)
         try:
-            result = api.Command.deskprofile_show(name, all=True)
+            result = self.session.Command.deskprofile_show(name, all=True)
         except Exception, e:
             logging.error(
                 'Error getting profile %s: %s. %s' % (name, e, e.__class__))
             raise e
         rule = self.get_profile_rule(name)
-        data = result['result']
+        return self._get_profile_from_data(result['result'], rule)
+
+    @connection_required
+    def get_profiles_full(self):
+        """
+        Get all profiles with their rules in a single request
+        """
+        results = self._run_commands([
+            ('deskprofile_find', [u''], {'sizelimit': 0, 'all': True}),
+            ('deskprofilerule_find', [u''], {'sizelimit': 0, 'all': True}),
+        ])
+        rules = dict([
+            (rule['cn'][0], rule) for rule in results[1]['result']])
+        profiles = []
+        for data in results[0]['result']:
+            name = data['cn'][0]
+            if name not in rules:
+                logging.error(
+                    'FreeIPAConnector: Profile %s has no rule. Skipping' % name)
+                continue
+            profiles.append(self._get_profile_from_data(data, rules[name]))
+        return profiles
+
+    @connection_required
+    def get_profile_names(self):
+        """
+        Get the names of all profiles without their data
+        """
+        results = self.session.Command.deskprofile_find(
+            u'', sizelimit=0, pkey_only=True)
+        return [data['cn'][0] for data in results['result']]
+
+    @connection_required
+    def iter_profiles(self, chunk_size=100):
+        """
+        Iterate over all profiles with their rules, fetched in batch requests
+        of chunk_size profiles so only those are held in memory. Profiles
+        removed meanwhile are skipped. Without batch support in the server,
+        they are fetched one by one
+        """
+        names = self.get_profile_names()
+        for i in range(0, len(names), chunk_size):
+            commands = []
+            for name in names[i:i + chunk_size]:
+                commands.append(('deskprofile_show', [name], {'all': True}))
+                commands.append(
+                    ('deskprofilerule_show', [name], {'all': True}))
+            if hasattr(api.Command, 'batch'):
+                results = self._run_batch(commands)
+            else:
+                results = []
+                for command, args, options in commands:
+                    try:
+                        results.append(getattr(self.session.Command, command)(
+                            *args, **options))
+                    except errors.NotFound, e:
+                        results.append(
+                            {'error': '%s' % e, 'error_name': 'NotFound'})
+            for j in range(0, len(results), 2):
+                name = commands[j][1][0]
+                data, rule = results[j], results[j + 1]
+                error = data.get('error') or rule.get('error')
+                if error is not None:
+                    logging.error(
+                        'FreeIPAConnector: Error getting profile %s: %s. '
+                        'Skipping' % (name, error))
+                    continue
+                yield self._get_profile_from_data(
+                    data['result'], rule['result'])
+
+    def _get_profile_from_data(self, data, rule):
         profile = {
             'name': data['cn'][0],
             'description': data.get('description', ('',))[0],
             'priority': int(rule['ipadeskprofilepriority'][0]),
-            'settings': json.loads(data['ipadeskdata'][0]),
+            'settings': decode_settings(data['ipadeskdata'][0]),
         }
         applies = self._get_profile_applies_from_rule(rule)
         profile.update(applies)
@@ -459,7 +1066,7 @@ class FreeIPAConnector(object):
             'FreeIPAConnector: Getting profile rule for %s"' % name)
         name = unicode(name)
         try:
-            result = api.Command.deskprofilerule_show(name, all=True)
+            result = self.session.Command.deskprofilerule_show(name, all=True)
         except Exception, e:
             logging.error(
                 'Error getting rule for profile %s: %s. %s' % (
@@ -20,15 +20,129 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 #
 
+import os
+import imp
+import hashlib
+import inspect
 import itertools
 import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import pkg_resources
+except ImportError:
+    pkg_resources = None
+
+from profiledata import dump_settings
+
+
+class TraceFields(object):
+    """
+    Trace event fields, only formatted when the event is emitted
+    """
+
+    MAX_VALUE_LENGTH = 80
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def _format_value(self, value):
+        if isinstance(value, (list, tuple, dict, set)):
+            return '<%s of %s>' % (type(value).__name__, len(value))
+        value = repr(value)
+        if len(value) > self.MAX_VALUE_LENGTH:
+            value = value[:self.MAX_VALUE_LENGTH] + '...'
+        return value
+
+    def __str__(self):
+        return ' '.join([
+            '%s=%s' % (name, self._format_value(self.fields[name]))
+            for name in sorted(self.fields)])
+
+
+class ChangesetIndex(object):
+    """
+    Changes of a settings namespace indexed by key
+
+    The index is kept between merges so applying a delta only costs
+    O(len(delta)).
+    """
+
+    def __init__(self, merger, changeset=None):
+        self.merger = merger
+        self._changes = {}
+        if changeset is not None:
+            self.apply(changeset)
+
+    def __len__(self):
+        return len(self._changes)
+
+    def __contains__(self, key):
+        return key in self._changes
+
+    def __iter__(self):
+        return iter(self._changes)
+
+    def get(self, key, default=None):
+        return self._changes.get(key, default)
+
+    def apply(self, delta):
+        """
+        Merge a list of changes into the index
+        """
+        merger = self.merger
+        changes = self._changes
+        for change in delta:
+            key = merger.get_key_from_change(change)
+            if key in changes:
+                change = merger.resolve_conflict(key, changes[key], change)
+            changes[key] = change
+        return self
+
+    def changes(self):
+        """
+        Return indexed changes as a changeset list sorted by key
+        """
+        changes = self._changes
+        return [changes[key] for key in sorted(changes)]
+
 
 class BaseChangeMerger(object):
     """
     Base change merger class
     """
+    # Settings namespaces handled by this merger when registered
+    NAMESPACES = ()
+
     KEY_NAME = 'key'
 
+    # What to do when an incoming change has the key of a stored one:
+    # 'replace' keeps the incoming change and 'keep' the stored one
+    CONFLICT_POLICY = 'replace'
+    CONFLICT_POLICIES = ('replace', 'keep')
+
+    # Tracing is enabled per merger class using set_tracing(). Call sites
+    # check TRACE before building trace events so a disabled tracer costs
+    # a single attribute lookup
+    TRACE = False
+
+    @classmethod
+    def set_tracing(cls, enabled=True):
+        """
+        Enable or disable trace events for this merger class
+        """
+        cls.TRACE = enabled
+
+    def trace(self, event, **fields):
+        """
+        Emit a structured trace event as a debug message
+        """
+        logging.debug(
+            '%s: %s %s', self.__class__.__name__, event, TraceFields(fields),
+            extra={'merger': self.__class__.__name__,
+                   'event': event, 'fields': fields})
+
     def get_key_from_change(self, change):
         """
         Return change key identifier
@@ -36,36 +150,98 @@ class BaseChangeMerger(object):
         if self.KEY_NAME in change:
             return change[self.KEY_NAME]
 
+    def resolve_conflict(self, key, stored, incoming):
+        """
+        Return the change to keep when two changes share the same key
+        """
+        if self.CONFLICT_POLICY == 'keep':
+            return stored
+        return incoming
+
+    def index(self, changeset):
+        """
+        Return an index of given changeset for incremental merges
+        """
+        return ChangesetIndex(self, changeset)
+
     def merge(self, *args):
         """
         Merge changesets in the given order
         """
-        index = {}
+        index = ChangesetIndex(self)
         for changeset in args:
-            for change in changeset:
-                key = self.get_key_from_change(change)
-                index[key] = change
-        return index.values()
+            index.apply(changeset)
+        if self.TRACE:
+            self.trace('merged', changesets=len(args), changes=len(index))
+        return index.changes()
+
+    def merge3(self, base, stored, incoming):
+        """
+        Three-way merge of changesets derived from a common base
+
+        Changes modified only on one side since base are taken from that
+        side. Keys modified differently on both sides are resolved using
+        the conflict policy and reported. Returns a tuple with the merged
+        changeset, sorted by key, and a list of conflicts.
+        """
+        base = ChangesetIndex(self, base)
+        stored = ChangesetIndex(self, stored)
+        incoming = ChangesetIndex(self, incoming)
+        merged = []
+        conflicts = []
+        keys = set(stored)
+        keys.update(incoming)
+        for key in sorted(keys):
+            base_change = base.get(key)
+            stored_change = stored.get(key)
+            incoming_change = incoming.get(key)
+            if incoming_change == base_change:
+                change = stored_change
+            elif stored_change == base_change \
+                    or stored_change == incoming_change:
+                change = incoming_change
+            else:
+                conflicts.append({
+                    'key': key,
+                    'base': base_change,
+                    'stored': stored_change,
+                    'incoming': incoming_change,
+                })
+                if stored_change is None or incoming_change is None:
+                    if self.CONFLICT_POLICY == 'keep':
+                        change = stored_change
+                    else:
+                        change = incoming_change
+                else:
+                    change = self.resolve_conflict(
+                        key, stored_change, incoming_change)
+            if change is not None:
+                merged.append(change)
+        if self.TRACE:
+            self.trace(
+                'merged3', changes=len(merged), conflicts=len(conflicts))
+        return merged, conflicts
 
 
 class GSettingsChangeMerger(BaseChangeMerger):
     """
     GSettings change merger class
     """
-    pass
+    NAMESPACES = ('org.gnome.gsettings', )
 
 
 class LibreOfficeChangeMerger(BaseChangeMerger):
     """
     LibreOffice change merger class
     """
-    pass
+    NAMESPACES = ('org.libreoffice.registry', )
 
 
 class NetworkManagerChangeMerger(BaseChangeMerger):
     """
     Network manager change merger class
     """
+    NAMESPACES = ('org.freedesktop.NetworkManager', )
     KEY_NAME = 'uuid'
 
 
@@ -73,46 +249,277 @@ class ChromiumChangeMerger(BaseChangeMerger):
     """
     Chromium/Chrome change merger class
     """
+    NAMESPACES = ('org.chromium.Policies', 'com.google.chrome.Policies')
     KEY_NAME = 'key'
 
-    def merge(self, *args):
+    def resolve_conflict(self, key, stored, incoming):
         """
-        Merge changesets in the given order
+        Merge managed bookmarks instead of replacing them
         """
-        index = {}
-        bookmarks = []
-        for changeset in args:
-            for change in changeset:
-                key = self.get_key_from_change(change)
-                if key == 'ManagedBookmarks':
-                    bookmarks = self.merge_bookmarks(bookmarks, change['value'])
-                    change = {self.KEY_NAME: key, 'value': bookmarks}
-                index[key] = change
-        return index.values()
+        if key == 'ManagedBookmarks':
+            bookmarks = self.merge_bookmarks(
+                stored['value'], incoming['value'])
+            return {self.KEY_NAME: key, 'value': bookmarks}
+        return super(ChromiumChangeMerger, self).resolve_conflict(
+            key, stored, incoming)
 
     def merge_bookmarks(self, a, b):
+        """
+        Merge bookmark tree b into bookmark tree a
+
+        Folders are merged by name and leaves are deduplicated by their
+        (name, url) pair. New elements are appended in their incoming order.
+        Given trees are not modified. Lists and folders changed by the merge
+        are copies.
+        """
+        return self._merge_bookmarks_level(a, b, {}, 0)
+
+    def _get_bookmarks_index(self, bookmarks, indexes):
+        """
+        Return the bookmark list to merge into and its indexes
+
+        Lists not created by this merge are copied before being indexed.
+        Copies are indexed by id so folders repeated in the incoming tree
+        are merged into them in place.
+        """
+        index = indexes.get(id(bookmarks))
+        if index is None:
+            bookmarks = list(bookmarks)
+            folders = {}
+            leaves = set()
+            for position, elem in enumerate(bookmarks):
+                self._add_to_bookmarks_index(elem, position, folders, leaves)
+            index = (folders, leaves)
+            indexes[id(bookmarks)] = index
+        return bookmarks, index
+
+    def _add_to_bookmarks_index(self, elem, position, folders, leaves):
+        if 'children' in elem:
+            folders.setdefault(elem.get('name'), position)
+        else:
+            leaves.add((elem.get('name'), elem.get('url')))
+
+    def _merge_bookmarks_level(self, a, b, indexes, depth):
+        a, (folders, leaves) = self._get_bookmarks_index(a, indexes)
+        appended = 0
         for elem_b in b:
-            logging.debug('Processing %s' % elem_b)
             if 'children' in elem_b:
-                merged = False
-                for elem_a in a:
-                    if elem_a['name'] == elem_b['name'] and 'children' in elem_a:
-                        logging.debug(
-                            'Processing children of %s' % elem_b['name'])
-                        elem_a['children'] = self.merge_bookmarks(
-                            elem_a['children'], elem_b['children'])
-                        merged = True
-                        break
-                if not merged:
-                    a.append(elem_b)
-            else:
-                if elem_b not in a:
-                    a.append(elem_b)
-        logging.debug('Returning %s' % a)
+                position = folders.get(elem_b.get('name'))
+                if position is not None:
+                    if self.TRACE:
+                        self.trace(
+                            'merge_folder', name=elem_b.get('name'),
+                            depth=depth)
+                    elem_a = a[position]
+                    children = self._merge_bookmarks_level(
+                        elem_a['children'], elem_b['children'], indexes,
+                        depth + 1)
+                    if children is not elem_a['children']:
+                        elem_a = dict(elem_a)
+                        elem_a['children'] = children
+                        a[position] = elem_a
+                    continue
+            elif (elem_b.get('name'), elem_b.get('url')) in leaves:
+                continue
+            a.append(elem_b)
+            appended += 1
+            self._add_to_bookmarks_index(elem_b, len(a) - 1, folders, leaves)
+        if self.TRACE:
+            self.trace(
+                'merged_level', depth=depth, existing=len(a) - appended,
+                incoming=len(b), appended=appended)
         return a
 
+
 class FirefoxChangeMerger(BaseChangeMerger):
     """
-    Network manager change merger class
+    Firefox change merger class
+    """
+    NAMESPACES = ('org.mozilla.firefox', )
+
+
+class MergerRegistry(object):
+    """
+    Change mergers by settings namespace
+    """
+
+    # Entry point group of merger classes provided by installed packages
+    ENTRY_POINT_GROUP = 'fleetcommander.mergers'
+
+    # Number of profiles whose settings indexes are kept between merges
+    MAX_CACHED_INDEXES = 16
+
+    def __init__(self):
+        self._mergers = {}
+        # Changeset indexes by namespace of recently merged profiles,
+        # along with the settings revision they were made from
+        self._indexes = OrderedDict()
+        self._indexes_lock = threading.Lock()
+
+    def __contains__(self, namespace):
+        return namespace in self._mergers
+
+    def __getitem__(self, namespace):
+        return self._mergers[namespace]
+
+    def get(self, namespace, default=None):
+        return self._mergers.get(namespace, default)
+
+    def namespaces(self):
+        return sorted(self._mergers.keys())
+
+    def register(self, merger_class):
+        """
+        Register a merger class for the namespaces it declares
+        """
+        if merger_class.CONFLICT_POLICY not in merger_class.CONFLICT_POLICIES:
+            raise ValueError(
+                'Unknown conflict policy %s for %s' % (
+                    merger_class.CONFLICT_POLICY, merger_class.__name__))
+        merger = merger_class()
+        for namespace in merger_class.NAMESPACES:
+            self._mergers[namespace] = merger
+
+    def register_module(self, module):
+        """
+        Register merger classes defined in a module
+        """
+        for name, obj in sorted(inspect.getmembers(module, inspect.isclass)):
+            if issubclass(obj, BaseChangeMerger) and \
+                    obj.__module__ == module.__name__ and obj.NAMESPACES:
+                self.register(obj)
+
+    def load_directory(self, path):
+        """
+        Register merger classes from python files in a directory
+        """
+        if not os.path.isdir(path):
+            return
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext != '.py':
+                continue
+            filepath = os.path.join(path, filename)
+            try:
+                module = imp.load_source(
+                    'fleetcommander_mergers_%s' % name, filepath)
+                self.register_module(module)
+            except Exception, e:
+                logging.error(
+                    'Error loading mergers from %s: %s' % (filepath, e))
+
+    def load_entry_points(self, group=ENTRY_POINT_GROUP):
+        """
+        Register merger classes, or modules defining them, published as
+        entry points by installed packages
+        """
+        if pkg_resources is None:
+            logging.debug(
+                'pkg_resources not available. Skipping merger entry points')
+            return
+        for entry_point in pkg_resources.iter_entry_points(group):
+            try:
+                obj = entry_point.load()
+                if inspect.ismodule(obj):
+                    self.register_module(obj)
+                else:
+                    self.register(obj)
+            except Exception, e:
+                logging.error(
+                    'Error loading mergers from entry point %s: %s' % (
+                        entry_point, e))
+
+    def get_indexes(self, key, revision):
+        """
+        Return the changeset indexes by namespace kept for a profile, or an
+        empty dictionary unless they were made from settings with given
+        revision. Indexes are updated in place by merge_changeset(), so
+        they are only kept again by keep_indexes().
+        """
+        with self._indexes_lock:
+            cached = self._indexes.pop(key, None)
+        if cached is None or cached[0] != revision:
+            return {}
+        return cached[1]
+
+    def keep_indexes(self, key, revision, indexes):
+        """
+        Keep changeset indexes of profile settings with given revision
+        """
+        with self._indexes_lock:
+            self._indexes[key] = (revision, indexes)
+            while len(self._indexes) > self.MAX_CACHED_INDEXES:
+                self._indexes.popitem(last=False)
+
+    def merge_changeset(self, settings, ns, changeset, base=None,
+                        indexes=None):
+        """
+        Merge a namespace changeset into profile settings
+
+        When the settings the changeset was made against are given as
+        base, a three-way merge is done and conflicts with changes stored
+        meanwhile are returned, tagged with their namespace. Namespaces
+        without merger are replaced.
+
+        Indexes of the settings by namespace, as returned by get_indexes(),
+        are used and updated when given, so the stored changeset is not
+        indexed again on every merge.
+        """
+        if indexes is None:
+            indexes = {}
+        merger = self.get(ns)
+        if merger is None:
+            logging.debug('No merger found for %s. Replacing changes' % ns)
+            settings[ns] = changeset
+            indexes.pop(ns, None)
+            return []
+        if base is None:
+            index = indexes.get(ns)
+            if index is None:
+                index = merger.index(settings.get(ns, []))
+            settings[ns] = index.apply(changeset).changes()
+            indexes[ns] = index
+            return []
+        indexes.pop(ns, None)
+        base_changeset = base.get(ns, [])
+        incoming = merger.index(base_changeset).apply(changeset)
+        settings[ns], conflicts = merger.merge3(
+            base_changeset, settings.get(ns, []), incoming.changes())
+        for conflict in conflicts:
+            conflict['namespace'] = ns
+        return conflicts
+
+    def merge_settings(self, settings, changesets, base=None, indexes=None):
+        """
+        Merge namespace changesets into profile settings
+
+        Returns the list of conflicts found. See merge_changeset().
+        """
+        conflicts = []
+        for ns, changeset in changesets.items():
+            conflicts.extend(
+                self.merge_changeset(settings, ns, changeset, base, indexes))
+        return conflicts
+
+
+def get_settings_revision(settings):
+    """
+    Return a revision identifier for profile settings
+    """
+    return hashlib.sha1(dump_settings(settings)).hexdigest()
+
+
+def get_registry(directory=None):
+    """
+    Return a registry with the builtin mergers, those published as entry
+    points and those in given directory, in increasing precedence order
     """
-    pass
+    registry = MergerRegistry()
+    for merger_class in (GSettingsChangeMerger, LibreOfficeChangeMerger,
+                         ChromiumChangeMerger, FirefoxChangeMerger,
+                         NetworkManagerChangeMerger):
+        registry.register(merger_class)
+    registry.load_entry_points()
+    if directory is not None:
+        registry.load_directory(directory)
+    return registry
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# vi:ts=4 sw=4 sts=4
+
+# Copyright (C) 2014 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+"""
+Encoding of profile settings stored in IPA as ipadeskdata
+
+Settings are stored as canonical JSON. Large settings can be stored
+compressed instead, wrapped in a JSON object like:
+
+    {"fc-chunks":["eJzt...","..."],"fc-encoding":"zlib"}
+
+where the chunks joined together are the base64 encoded zlib stream of
+the canonical JSON settings. decode_settings() accepts both forms and
+only depends on the standard library so clients can reuse it.
+"""
+
+import json
+import zlib
+import base64
+
+ENCODING_KEY = 'fc-encoding'
+CHUNKS_KEY = 'fc-chunks'
+ZLIB_ENCODING = 'zlib'
+
+
+def dump_settings(settings):
+    """
+    Serialize profile settings in canonical form
+
+    Object keys are sorted and no whitespace is added, so equal settings
+    always serialize to the same string.
+    """
+    return json.dumps(settings, sort_keys=True, separators=(',', ':'))
+
+
+def encode_settings(settings, compression_threshold=None, chunk_size=0):
+    """
+    Encode profile settings for storage
+
+    Settings whose canonical JSON is at least compression_threshold bytes
+    long are compressed, unless that does not make them smaller. A positive
+    chunk_size splits compressed data in chunks of at most that length.
+    """
+    data = dump_settings(settings)
+    if compression_threshold is None or len(data) < compression_threshold:
+        return data
+    compressed = base64.b64encode(zlib.compress(data, 9))
+    if chunk_size > 0:
+        chunks = [compressed[i:i + chunk_size]
+                  for i in range(0, len(compressed), chunk_size)]
+    else:
+        chunks = [compressed]
+    encoded = dump_settings({ENCODING_KEY: ZLIB_ENCODING, CHUNKS_KEY: chunks})
+    if len(encoded) >= len(data):
+        return data
+    return encoded
+
+
+def decode_settings(data):
+    """
+    Decode profile settings stored either plain or compressed
+    """
+    settings = json.loads(data)
+    if isinstance(settings, dict) and ENCODING_KEY in settings:
+        encoding = settings[ENCODING_KEY]
+        if encoding != ZLIB_ENCODING:
+            raise ValueError('Unknown profile data encoding %s' % encoding)
+        settings = json.loads(zlib.decompress(
+            base64.b64decode(''.join(settings[CHUNKS_KEY]))))
+    return settings
@@ -22,7 +22,9 @@
 
 # Python imports
 import os
+import re
 import sys
+import json
 import logging
 import copy
 import socket
@@ -35,6 +37,8 @@ except ImportError:
 
 import constants
 
+JSON_WHITESPACE_REGEX = re.compile(r'[ \t\n\r]*')
+
 
 def get_data_from_file(path):
     with open(path, 'r') as fd:
@@ -115,6 +119,29 @@ def parse_config(config_file=None):
         'auto_quit_timeout': section.get(
             'auto_quit_timeout',
             constants.DEFAULT_AUTO_QUIT_TIMEOUT),
+        'database_storage_profile': section.get(
+            'database_storage_profile',
+            constants.DEFAULT_DATABASE_STORAGE_PROFILE),
+        'profile_cache_ttl': section.get(
+            'profile_cache_ttl', constants.DEFAULT_PROFILE_CACHE_TTL),
+        'directory_cache_ttl': section.get(
+            'directory_cache_ttl', constants.DEFAULT_DIRECTORY_CACHE_TTL),
+        'ipa_keepalive_interval': section.get(
+            'ipa_keepalive_interval',
+            constants.DEFAULT_IPA_KEEPALIVE_INTERVAL),
+        'ipa_reconnect_max_backoff': section.get(
+            'ipa_reconnect_max_backoff',
+            constants.DEFAULT_IPA_RECONNECT_MAX_BACKOFF),
+        'ipa_workers': section.get(
+            'ipa_workers', constants.DEFAULT_IPA_WORKERS),
+        'mergers_dir': section.get(
+            'mergers_dir', constants.DEFAULT_MERGERS_DIR),
+        'profile_data_compression_threshold': section.get(
+            'profile_data_compression_threshold',
+            constants.DEFAULT_PROFILE_DATA_COMPRESSION_THRESHOLD),
+        'profile_data_chunk_size': section.get(
+            'profile_data_chunk_size',
+            constants.DEFAULT_PROFILE_DATA_CHUNK_SIZE),
     }
 
     if not args['client_data_url'][-1] == args['client_data_url'][0] == '/':
@@ -124,6 +151,42 @@ def parse_config(config_file=None):
     return args
 
 
+def iter_json_object(data):
+    """
+    Iterate over the (key, value) members of a JSON object document
+
+    Member values are decoded one at a time as iteration goes on, so only
+    one of them needs to be held in memory. ValueError is raised when the
+    document is not a valid JSON object.
+    """
+    decoder = json.JSONDecoder()
+    skip = JSON_WHITESPACE_REGEX.match
+    idx = skip(data, 0).end()
+    if data[idx:idx + 1] != '{':
+        raise ValueError('Expecting object at position %s' % idx)
+    idx = skip(data, idx + 1).end()
+    if data[idx:idx + 1] != '}':
+        while True:
+            key, idx = decoder.raw_decode(data, idx)
+            if not isinstance(key, basestring):
+                raise ValueError('Expecting property name at position %s' % idx)
+            idx = skip(data, idx).end()
+            if data[idx:idx + 1] != ':':
+                raise ValueError('Expecting : delimiter at position %s' % idx)
+            idx = skip(data, idx + 1).end()
+            value, idx = decoder.raw_decode(data, idx)
+            yield key, value
+            idx = skip(data, idx).end()
+            if data[idx:idx + 1] == '}':
+                break
+            if data[idx:idx + 1] != ',':
+                raise ValueError('Expecting , delimiter at position %s' % idx)
+            idx = skip(data, idx + 1).end()
+    idx = skip(data, idx + 1).end()
+    if idx != len(data):
+        raise ValueError('Extra data at position %s' % idx)
+
+
 def get_ip_address(hostname):
     """
     Returns first IP address for given hostname
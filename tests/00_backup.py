@@ -0,0 +1,211 @@
+#!./python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+import os
+import sys
+import tempfile
+import shutil
+import unittest
+import json
+from StringIO import StringIO
+import freeipamock
+
+sys.path.append(os.path.join(os.environ['TOPSRCDIR'], 'admin'))
+
+from fleetcommander import fcfreeipa
+from fleetcommander import backup
+
+# Mocking assignments
+fcfreeipa.api = freeipamock.FreeIPAMock
+fcfreeipa.errors = freeipamock.FreeIPAErrors
+
+
+class TestBackup(unittest.TestCase):
+
+    maxDiff = None
+
+    def get_profile(self, i):
+        profile = {
+            'name': u'Profile %03d' % i,
+            'description': u'Test profile %s' % i,
+            'priority': i,
+            'settings': {
+                'org.gnome.gsettings': [
+                    {
+                        'key': '/org/gnome/desktop/background/picture-uri',
+                        'value': "'file:///%s.png'" % i,
+                        'signature': 's',
+                    }
+                ],
+            },
+            'users': [u'admin'],
+            'groups': [u'editors'],
+            'hosts': [],
+            'hostgroups': [],
+        }
+        if i % 2:
+            profile['hosts'] = [u'client1']
+            profile['hostgroups'] = [u'ipaservers']
+        return profile
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp(prefix='fc-backup-test')
+        self.state_file = os.path.join(self.test_directory, 'state')
+        self.profiles = [self.get_profile(i) for i in range(20)]
+        freeipamock.FreeIPACommand.data = freeipamock.FreeIPAData()
+        self.ipa = fcfreeipa.FreeIPAConnector()
+        self.ipa.connect()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+    def sorted(self, profiles):
+        return sorted(profiles, key=lambda profile: profile['name'])
+
+    def import_profiles(self, profiles, **kwargs):
+        kwargs.setdefault('workers', 4)
+        kwargs.setdefault('chunk_size', 3)
+        importer = backup.ProfileImporter(self.ipa, **kwargs)
+        return importer.run(profiles)
+
+    def test_01_export_import(self):
+        report = self.import_profiles(self.profiles)
+        self.assertEqual(report, {
+            'created': 20, 'updated': 0, 'skipped': 0, 'failed': {}})
+
+        fd = StringIO()
+        self.assertEqual(backup.export_profiles(self.ipa, fd, 8), 20)
+        lines = fd.getvalue().splitlines()
+        self.assertEqual(len(lines), 20)
+        self.assertEqual(
+            self.sorted([json.loads(line) for line in lines]), self.profiles)
+
+        # Restore into an empty realm
+        freeipamock.FreeIPACommand.data = freeipamock.FreeIPAData()
+        self.ipa = fcfreeipa.FreeIPAConnector()
+        profiles = backup.read_profiles(StringIO(fd.getvalue()))
+        report = self.import_profiles(profiles)
+        self.assertEqual(report['created'], 20)
+        self.assertEqual(
+            self.sorted(self.ipa.get_profiles_full()), self.profiles)
+
+    def test_02_read_profiles(self):
+        data = '\n'.join([
+            backup.dump_profile(self.profiles[0]),
+            '',
+            backup.dump_profile(self.profiles[1]),
+        ])
+        self.assertEqual(
+            list(backup.read_profiles(StringIO(data))), self.profiles[:2])
+        self.assertRaisesRegexp(
+            ValueError, 'Invalid JSON at line 4', list,
+            backup.read_profiles(StringIO(data + '\n{"name":')))
+        self.assertRaisesRegexp(
+            ValueError, 'Missing priority at line 1', list,
+            backup.read_profiles(StringIO('{"name":"a","description":"",'
+                                          '"settings":{},"users":[],'
+                                          '"groups":[],"hosts":[],'
+                                          '"hostgroups":[]}')))
+
+    def test_03_import_batched(self):
+        calls = []
+        create_profiles = self.ipa.create_profiles
+
+        def wrapper(profiles):
+            calls.append([profile['name'] for profile in profiles])
+            return create_profiles(profiles)
+        self.ipa.create_profiles = wrapper
+
+        self.import_profiles(self.profiles, chunk_size=8)
+        self.assertEqual(sorted([len(chunk) for chunk in calls]), [4, 8, 8])
+        self.assertEqual(
+            len(freeipamock.FreeIPACommand.data.profiles), 20)
+
+    def test_04_import_resume(self):
+        self.import_profiles(self.profiles[:5], state_file=self.state_file)
+        with open(self.state_file, 'r') as fd:
+            self.assertEqual(len(fd.readlines()), 5)
+
+        # Already imported profiles are not sent again
+        freeipamock.FreeIPACommand.data.profiles.clear()
+        freeipamock.FreeIPACommand.data.profilerules.clear()
+        report = self.import_profiles(
+            self.profiles, state_file=self.state_file)
+        self.assertEqual(report, {
+            'created': 15, 'updated': 0, 'skipped': 5, 'failed': {}})
+        self.assertEqual(
+            sorted(freeipamock.FreeIPACommand.data.profiles.keys()),
+            [profile['name'] for profile in self.profiles[5:]])
+        self.assertEqual(len(backup.ProfileImporter(
+            self.ipa, state_file=self.state_file).load_state()), 20)
+
+    def test_05_import_failed(self):
+        # Profiles with rules failing to be created are removed, without
+        # modifying or removing the existing rule
+        data = freeipamock.FreeIPACommand.data
+        data.profilerules[self.profiles[3]['name']] = {}
+        report = self.import_profiles(
+            self.profiles[:6], state_file=self.state_file)
+        self.assertEqual(report['created'], 5)
+        self.assertEqual(
+            report['failed'].keys(), [self.profiles[3]['name']])
+        self.assertFalse(self.profiles[3]['name'] in data.profiles)
+        self.assertEqual(data.profilerules[self.profiles[3]['name']], {})
+        self.assertFalse(
+            self.profiles[3]['name'] in backup.ProfileImporter(
+                self.ipa, state_file=self.state_file).load_state())
+
+    def test_06_create_existing(self):
+        # Profiles created after existing ones were listed are not modified
+        self.ipa.save_profile(self.profiles[1])
+        profile = dict(self.profiles[1])
+        profile['users'] = []
+        profile['groups'] = [u'admins']
+        failed = self.ipa.create_profiles([profile, self.profiles[2]])
+        self.assertEqual(failed.keys(), [profile['name']])
+        self.assertEqual(
+            self.ipa.get_profile(profile['name']), self.profiles[1])
+        self.assertEqual(
+            self.ipa.get_profile(self.profiles[2]['name']), self.profiles[2])
+
+    def test_07_import_listing_failed(self):
+        def get_profile_names():
+            raise freeipamock.FreeIPAErrors.NetworkError('Connection lost')
+        self.ipa.get_profile_names = get_profile_names
+        self.assertRaises(
+            freeipamock.FreeIPAErrors.NetworkError,
+            self.import_profiles, self.profiles)
+        self.assertEqual(freeipamock.FreeIPACommand.data.profiles, {})
+
+    def test_08_import_existing(self):
+        self.ipa.save_profile(self.profiles[0])
+        profile = dict(self.profiles[0])
+        profile['description'] = u'Restored profile'
+        profile['priority'] = 99
+        report = self.import_profiles([profile] + self.profiles[1:3])
+        self.assertEqual(report, {
+            'created': 2, 'updated': 1, 'skipped': 0, 'failed': {}})
+        self.assertEqual(self.ipa.get_profile(profile['name']), profile)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,12 +24,19 @@
 import sys
 import os
 import json
+import marshal
+import sqlite3
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
 sys.path.append(PYTHONPATH)
 
-from fleetcommander.database import DBManager
+from fleetcommander.database import BaseDBManager, DBManager, ConfigValues
+from fleetcommander.database import SCHEMA_VERSION, MarshalCodec
 
 
 class UnsupportedType(object):
@@ -106,5 +113,460 @@ class TestDBManager(unittest.TestCase):
         for item in items:
             self.assertEqual(item[1], self.INITIAL_VALUES[item[0]])
 
+    def test_07_config_cache(self):
+        # Cached values are returned without querying the database
+        self.db.config.cursor.execute('DELETE FROM config')
+        for k, v in self.INITIAL_VALUES.items():
+            self.assertEqual(self.db.config[k], v)
+        # Serialized values are not shared between reads
+        value = self.db.config['testkeydict']
+        value['value'] = True
+        self.assertEqual(self.db.config['testkeydict'], self.test_setting)
+        # Writes and deletions update the cache
+        self.db.config['testkeystr'] = 'newvalue'
+        self.assertEqual(self.db.config['testkeystr'], 'newvalue')
+        del(self.db.config['testkeystr'])
+        self.assertFalse('testkeystr' in self.db.config)
+        # Clearing the cache reads from database again
+        self.db.config.clear_cache()
+        self.assertFalse('testkeyint' in self.db.config)
+
+    def test_08_config_cache_external_changes(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            db1 = DBManager(path, check_external_changes=True)
+            db2 = DBManager(path, check_external_changes=True)
+            db1.config['testkey'] = 'value1'
+            self.assertEqual(db2.config['testkey'], 'value1')
+            db1.config['testkey'] = 'value2'
+            self.assertEqual(db2.config['testkey'], 'value2')
+            del(db1.config['testkey'])
+            self.assertFalse('testkey' in db2.config)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_09_config_update(self):
+        self.db.config.update({
+            'testkeystr': 'newvalue',
+            'newkey': ['foo', 'bar'],
+        })
+        self.assertEqual(self.db.config['testkeystr'], 'newvalue')
+        self.assertEqual(self.db.config['newkey'], ['foo', 'bar'])
+        # Replaced values do not leave duplicated rows
+        self.db.cursor.execute(
+            'SELECT COUNT(*) FROM config WHERE key = ?', ('testkeystr',))
+        self.assertEqual(self.db.cursor.fetchone()[0], 1)
+
+    def test_10_config_batch(self):
+        with self.db.config.batch():
+            self.db.config['testkeystr'] = 'newvalue'
+            del(self.db.config['testkeyint'])
+            # Nested batches join the outer transaction
+            with self.db.config.batch():
+                self.db.config['newkey'] = 'newvalue'
+        self.db.config.clear_cache()
+        self.assertEqual(self.db.config['testkeystr'], 'newvalue')
+        self.assertEqual(self.db.config['newkey'], 'newvalue')
+        self.assertFalse('testkeyint' in self.db.config)
+
+    def test_11_config_batch_rollback(self):
+        try:
+            with self.db.config.batch():
+                self.db.config['testkeystr'] = 'newvalue'
+                del(self.db.config['testkeyint'])
+                self.db.config['unsupported'] = UnsupportedType()
+        except ValueError:
+            pass
+        self.assertEqual(self.db.config['testkeystr'], 'strvalue')
+        self.assertEqual(self.db.config['testkeyint'], 42)
+        self.assertFalse('unsupported' in self.db.config)
+
+    def test_12_storage_profiles(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'test.db')
+            db = DBManager(path, storage_profile='wal')
+            db.cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(db.cursor.fetchone()[0], 'wal')
+            db.cursor.execute('PRAGMA synchronous')
+            self.assertEqual(db.cursor.fetchone()[0], 1)
+            db.config['testkey'] = 'value'
+            db.conn.close()
+            # Switching profile keeps data
+            db = DBManager(path, storage_profile='safe')
+            db.cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(db.cursor.fetchone()[0], 'delete')
+            self.assertEqual(db.config['testkey'], 'value')
+            db.conn.close()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertRaises(
+            ValueError, DBManager, ':memory:', storage_profile='unknown')
+
+    def test_13_profiles_value_codecs(self):
+        small = {'name': 'Profile', 'settings': {'foo': ['bar', 42]}}
+        large = {'name': 'Profile', 'settings': {
+            'org.gnome.gsettings': [self.test_setting] * 1000}}
+        self.db.profiles['small'] = small
+        self.db.profiles['large'] = large
+        # Legacy rows using JSON text keep working
+        self.db.cursor.execute(
+            'INSERT INTO profiles (key, value, type) VALUES (?, ?, ?)',
+            ('legacy', json.dumps(small), 'dict'))
+        self.db.conn.commit()
+        self.db.profiles.clear_cache()
+        self.assertEqual(self.db.profiles['small'], small)
+        self.assertEqual(self.db.profiles['large'], large)
+        self.assertEqual(self.db.profiles['legacy'], small)
+        # Check stored formats
+        self.db.cursor.execute(
+            'SELECT key, type, length(value) FROM profiles '
+            'WHERE key != ? ORDER BY key', ('SCHEMA_VERSION',))
+        rows = self.db.cursor.fetchall()
+        self.assertEqual([row[:2] for row in rows], [
+            ('large', 'dict:zlib+json'),
+            ('legacy', 'dict'),
+            ('small', 'dict'),
+        ])
+        self.assertTrue(rows[0][2] < len(json.dumps(large)) / 10)
+        # Marshal data is only read by the Python version that wrote it
+        self.db.profiles.CODEC = MarshalCodec.NAME
+        self.db.profiles['marshal'] = small
+        self.db.cursor.execute(
+            'INSERT INTO profiles (key, value, type) VALUES (?, ?, ?)',
+            ('unknown', sqlite3.Binary(marshal.dumps(small)), 'dict:marshal'))
+        self.db.conn.commit()
+        self.db.profiles.clear_cache()
+        self.assertEqual(self.db.profiles['marshal'], small)
+        self.assertEqual(self.db.profiles.get('unknown'), None)
+        self.assertEqual(self.db.profiles.get_profile('unknown', 60), None)
+        # Config values are still stored as JSON text
+        self.db.cursor.execute(
+            'SELECT value, type FROM config WHERE key = ?', ('testkeydict',))
+        self.assertEqual(
+            self.db.cursor.fetchone(), (self.test_setting_json, 'dict'))
+
+    def test_14_config_dictionary_keys_values(self):
+        self.assertEqual(len(self.db.config), 8)
+        self.assertEqual(
+            sorted(self.db.config.keys()), sorted(self.INITIAL_VALUES.keys()))
+        self.assertEqual(sorted(self.db.config), sorted(self.INITIAL_VALUES))
+        self.assertEqual(
+            sorted(self.db.config.values()),
+            sorted(self.INITIAL_VALUES.values()))
+        del(self.db.config['testkeystr'])
+        self.assertEqual(len(self.db.config), 7)
+
+    def test_15_config_dictionary_streaming_iteration(self):
+        self.db.config.FETCH_SIZE = 3
+        with self.db.config.batch():
+            for i in range(20):
+                self.db.config['page%02d' % i] = i
+        # Other operations can be done while iterating
+        count = 0
+        for key, value in self.db.config.iteritems():
+            self.assertEqual(self.db.config[key], value)
+            count += 1
+        self.assertEqual(count, 28)
+        # Stopping early does not need to read every row
+        iterator = self.db.config.iterkeys()
+        next(iterator)
+        iterator.close()
+
+    def test_16_config_dictionary_prefix(self):
+        with self.db.config.batch():
+            for key in ('profile-b', 'profile-a', 'profile', 'profilf',
+                        'profile-c/1'):
+                self.db.config[key] = key
+        self.assertEqual(
+            self.db.config.keys_with_prefix('profile-'),
+            ['profile-a', 'profile-b', 'profile-c/1'])
+        self.assertEqual(
+            list(self.db.config.itervalues('profile-c')), ['profile-c/1'])
+        self.assertEqual(
+            list(self.db.config.iteritems('testkeyi')),
+            [('testkeyint', 42)])
+        self.assertEqual(self.db.config.keys_with_prefix('unknown'), [])
+
+    def test_17_profiles_cache(self):
+        profile = {
+            'name': u'Profile',
+            'description': u'Description',
+            'priority': 50,
+            'settings': {},
+            'users': [u'admin'],
+            'groups': [],
+            'hosts': [],
+            'hostgroups': [],
+        }
+        index = [(u'Profile', u'Description')]
+        self.assertEqual(self.db.profiles.get_index(60), None)
+        self.assertEqual(self.db.profiles.get_profile('Profile', 60), None)
+        self.db.profiles.set_index(index)
+        self.db.profiles.set_profile('Profile', profile)
+        # Cached data is stored as JSON
+        self.assertEqual(
+            self.db.profiles.get_index(60), [[u'Profile', u'Description']])
+        self.assertEqual(self.db.profiles.get_profile('Profile', 60), profile)
+        # Expired entries are not returned
+        self.assertEqual(self.db.profiles.get_index(0), None)
+        self.assertEqual(self.db.profiles.get_profile('Profile', 0), None)
+        # Invalidation
+        self.db.profiles.set_profile('Other', profile)
+        self.db.profiles.invalidate('Profile')
+        self.assertEqual(self.db.profiles.get_index(60), None)
+        self.assertEqual(self.db.profiles.get_profile('Profile', 60), None)
+        self.assertEqual(self.db.profiles.get_profile('Other', 60), profile)
+        # Revisions survive invalidation
+        self.db.profiles.set_revision('abcd', profile['settings'])
+        self.db.profiles.invalidate_all()
+        self.assertEqual(self.db.profiles.keys(), ['revision:abcd'])
+        self.assertEqual(self.db.profiles.get_revision('abcd'), {})
+        self.assertEqual(self.db.profiles.get_revision('missing'), None)
+
+    def test_18_config_expiration(self):
+        self.db.config.set('expired', 'value', ttl=-1)
+        self.db.config.set('alive', 'value', ttl=60)
+        self.assertFalse('expired' in self.db.config)
+        self.assertEqual(self.db.config.get('expired'), None)
+        self.assertEqual(self.db.config['alive'], 'value')
+        self.assertEqual(len(self.db.config), 9)
+        self.assertFalse('expired' in self.db.config.keys())
+        # Setting a value again without ttl makes it permanent
+        self.db.config.set('expired', 'value', ttl=-1)
+        self.db.config['expired'] = 'value'
+        self.assertEqual(self.db.config['expired'], 'value')
+        # Expired keys are purged from database
+        self.db.config.set('expired', 'value', ttl=-1)
+        self.db.config.set('expired2', 'value', ttl=-1)
+        self.assertEqual(self.db.config.purge_expired(), 2)
+        self.db.cursor.execute(
+            'SELECT COUNT(*) FROM config WHERE key LIKE ?', ('expired%',))
+        self.assertEqual(self.db.cursor.fetchone()[0], 0)
+        # Purging uses the expiration index
+        self.db.cursor.execute(
+            'EXPLAIN QUERY PLAN DELETE FROM config WHERE expires <= ?', (0,))
+        plan = ' '.join([row[-1] for row in self.db.cursor.fetchall()])
+        self.assertTrue('config_expires_index' in plan)
+
+    def test_19_config_ephemeral_keys(self):
+        self.db.config.update({
+            'uuid': 'fefb45d9-5a81-3392-b7bc-e2e37c2d',
+            'port': 5900,
+        })
+        self.db.config.set('tunnel_pid', 1234, ttl=-1)
+        self.assertEqual(
+            self.db.config['uuid'], 'fefb45d9-5a81-3392-b7bc-e2e37c2d')
+        self.assertEqual(self.db.config['port'], 5900)
+        self.assertFalse('tunnel_pid' in self.db.config)
+        self.assertEqual(len(self.db.config), 10)
+        self.assertEqual(
+            self.db.config.keys_with_prefix('p'), ['port'])
+        # Ephemeral keys are not stored in database
+        self.db.cursor.execute(
+            'SELECT COUNT(*) FROM config WHERE key IN (?, ?, ?)',
+            ('uuid', 'port', 'tunnel_pid'))
+        self.assertEqual(self.db.cursor.fetchone()[0], 0)
+        del(self.db.config['uuid'])
+        self.assertFalse('uuid' in self.db.config)
+
+    def test_20_profiles_cache_invalidated_while_fetching(self):
+        profile = {'name': 'Profile', 'settings': {}}
+        generation = self.db.profiles.get_generation()
+        # Profile is saved while data is being fetched
+        self.db.profiles.invalidate('Profile')
+        self.db.profiles.set_index([['Profile', '']], generation)
+        self.db.profiles.set_profile('Profile', profile, generation)
+        self.assertEqual(self.db.profiles.get_index(60), None)
+        self.assertEqual(self.db.profiles.get_profile('Profile', 60), None)
+        # Data fetched after the invalidation is cached
+        generation = self.db.profiles.get_generation()
+        self.db.profiles.set_profile('Profile', profile, generation)
+        self.assertEqual(self.db.profiles.get_profile('Profile', 60), profile)
+
+    def test_21_purge_expired(self):
+        self.db.config.set('expired', 'value', ttl=-1)
+        self.db.profiles.set_revision('abcd', {})
+        self.db.profiles.set_revision('efgh', {})
+        self.db.cursor.execute(
+            'UPDATE profiles SET expires = ? WHERE key = ?',
+            (0, 'revision:abcd'))
+        self.db.commit()
+        # Expired keys of every table are purged
+        self.assertEqual(self.db.purge_expired(), 2)
+        self.db.cursor.execute(
+            'SELECT key FROM profiles WHERE key LIKE ?', ('revision:%',))
+        self.assertEqual(self.db.cursor.fetchall(), [('revision:efgh',)])
+        self.assertFalse('expired' in self.db.config.keys())
+
+    def test_22_profiles_keep_revision(self):
+        settings = {'org.gnome.gsettings': []}
+        self.assertTrue(self.db.profiles.keep_revision('abcd', settings))
+        self.assertEqual(self.db.profiles.get_revision('abcd'), settings)
+        # Revisions already stored are not written again
+        self.assertFalse(self.db.profiles.keep_revision('abcd', settings))
+        # Revisions are written again once half of their TTL has passed
+        self.db.cursor.execute(
+            'UPDATE profiles SET expires = ? WHERE key = ?',
+            (time.time() + 60, 'revision:abcd'))
+        self.db.commit()
+        self.db.profiles.clear_cache()
+        self.assertTrue(self.db.profiles.keep_revision('abcd', settings))
+        self.assertFalse(self.db.profiles.keep_revision('abcd', settings))
+
+    def test_23_config_write_while_iterating(self):
+        self.db.config.FETCH_SIZE = 3
+        with self.db.config.batch():
+            for i in range(10):
+                self.db.config['rewrite%02d' % i] = i
+        # Keys set while iterating are not returned again
+        for prefix in (None, 'rewrite'):
+            seen = []
+            for key, value in self.db.config.iteritems(prefix):
+                seen.append(key)
+                if len(seen) > 100:
+                    break
+                self.db.config[key] = value
+            self.assertEqual(sorted(seen), sorted(set(seen)))
+            self.assertEqual(
+                len([key for key in seen if key.startswith('rewrite')]), 10)
+
+
+class TestDBManagerThreads(unittest.TestCase):
+
+    THREADS = 8
+    ITERATIONS = 50
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+    def hammer_config(self, db):
+        errors = []
+
+        def worker(number):
+            try:
+                for i in range(self.ITERATIONS):
+                    with db.config.batch():
+                        db.config['counter'] = db.config.get('counter', 0) + 1
+                        db.config['thread-%s' % number] = i
+                    # Values from other threads are complete
+                    for key, value in db.config.items():
+                        if key.startswith('thread-'):
+                            self.assertTrue(0 <= value < self.ITERATIONS)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(self.THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(db.config['counter'], self.THREADS * self.ITERATIONS)
+        for n in range(self.THREADS):
+            self.assertEqual(db.config['thread-%s' % n], self.ITERATIONS - 1)
+
+    def test_01_threads(self):
+        path = os.path.join(self.test_directory, 'test.db')
+        db = DBManager(path, storage_profile='wal')
+        self.hammer_config(db)
+        db.close()
+        # Data was committed to database
+        db = DBManager(path, cache=False)
+        self.assertEqual(db.config['counter'], self.THREADS * self.ITERATIONS)
+        db.close()
+
+    def test_02_threads_memory(self):
+        self.hammer_config(DBManager(':memory:'))
+
+
+class TestDBSchemaMigration(unittest.TestCase):
+
+    SCHEMA_1_ROWS = [
+        ('SCHEMA_VERSION', '1.0', 'float'),
+        ('testkeystr', 'oldvalue', 'str'),
+        ('testkeyint', '42', 'int'),
+        ('testkeystr', 'strvalue', 'str'),
+        ('testkeylist', '["foo", 42, "bar"]', 'list'),
+    ]
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_directory, 'test.db')
+        # Create tables using schema 1.0
+        conn = sqlite3.connect(self.path)
+        for table in ('config', 'profiles'):
+            conn.execute(
+                'CREATE TABLE %s (key TEXT, value TEXT, type TEXT)' % table)
+            conn.executemany(
+                'INSERT INTO %s (key, value, type) VALUES (?, ?, ?)' % table,
+                self.SCHEMA_1_ROWS)
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+    def test_01_migration(self):
+        db = DBManager(self.path)
+        for table in (db.config, db.profiles):
+            self.assertEqual(table['SCHEMA_VERSION'], SCHEMA_VERSION)
+            self.assertEqual(dict(table.items()), {
+                'testkeystr': 'strvalue',
+                'testkeyint': 42,
+                'testkeylist': ['foo', 42, 'bar'],
+            })
+        # Lookups use primary key index
+        db.cursor.execute(
+            'EXPLAIN QUERY PLAN SELECT value, type FROM config WHERE key = ?',
+            ('testkeystr',))
+        plan = ' '.join([row[-1] for row in db.cursor.fetchall()])
+        self.assertTrue('INDEX' in plan)
+        # Opening again does not migrate twice
+        db = DBManager(self.path)
+        self.assertEqual(db.config['testkeystr'], 'strvalue')
+
+    def test_02_migration_from_schema_2(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute('DROP TABLE config')
+        conn.execute(
+            'CREATE TABLE config (key TEXT, value TEXT, type TEXT, '
+            'PRIMARY KEY (key))')
+        conn.executemany(
+            'INSERT INTO config (key, value, type) VALUES (?, ?, ?)', [
+                ('SCHEMA_VERSION', '2.0', 'float'),
+                ('hypervisor', '{"host": "myhost"}', 'dict'),
+                ('uuid', 'fefb45d9-5a81-3392-b7bc-e2e37c2d', 'str'),
+                ('port', '5900', 'int'),
+            ])
+        conn.commit()
+        conn.close()
+        db = DBManager(self.path)
+        self.assertEqual(db.config['SCHEMA_VERSION'], SCHEMA_VERSION)
+        self.assertEqual(db.config['hypervisor'], {'host': 'myhost'})
+        # Stale session data is removed
+        self.assertFalse('uuid' in db.config)
+        self.assertFalse('port' in db.config)
+
+    def test_03_failed_migration(self):
+
+        class FailingConfigValues(ConfigValues):
+
+            def _migrate_key_to_primary_key(self):
+                super(FailingConfigValues, self)._migrate_key_to_primary_key()
+                raise sqlite3.OperationalError('Migration failed')
+
+        db = BaseDBManager(self.path)
+        self.assertRaises(sqlite3.OperationalError, FailingConfigValues, db)
+        # Table is left untouched
+        db.cursor.execute('SELECT key, value, type FROM config ORDER BY rowid')
+        self.assertEqual(db.cursor.fetchall(), self.SCHEMA_1_ROWS)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,238 @@
+#!./python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+# Python imports
+import sys
+import os
+import time
+import threading
+import unittest
+
+PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
+sys.path.append(PYTHONPATH)
+
+from fleetcommander import directory
+from fleetcommander.directory import DirectoryIndex, DirectorySnapshot
+
+
+class TestDirectoryIndex(unittest.TestCase):
+
+    HOSTS = [
+        'client1.example.com',
+        'client2.example.com',
+        'Client10.example.com',
+        'server.example.com',
+        'ipa.example.org',
+    ]
+
+    def setUp(self):
+        self.index = DirectoryIndex(self.HOSTS)
+
+    def test_01_contains(self):
+        self.assertEqual(len(self.index), 5)
+        self.assertTrue('client1.example.com' in self.index)
+        self.assertTrue('CLIENT10.example.com' in self.index)
+        self.assertFalse('client1' in self.index)
+        self.assertEqual(list(self.index), [
+            'client1.example.com',
+            'Client10.example.com',
+            'client2.example.com',
+            'ipa.example.org',
+            'server.example.com',
+        ])
+
+    def test_02_prefix(self):
+        self.assertEqual(self.index.prefix('client1'), [
+            'client1.example.com', 'Client10.example.com'])
+        self.assertEqual(
+            self.index.prefix('CLI', limit=1), ['client1.example.com'])
+        self.assertEqual(self.index.prefix('unknown'), [])
+        self.assertEqual(len(self.index.prefix('')), 5)
+
+    def test_03_search(self):
+        self.assertEqual(self.index.search('example.org'), ['ipa.example.org'])
+        self.assertEqual(self.index.search('nt1'), [
+            'client1.example.com', 'Client10.example.com'])
+        # Texts shorter than indexed substrings
+        self.assertEqual(self.index.search('1'), [
+            'client1.example.com', 'Client10.example.com'])
+        self.assertEqual(self.index.search('VER'), ['server.example.com'])
+        self.assertEqual(len(self.index.search('example', limit=2)), 2)
+        self.assertEqual(self.index.search('unknown'), [])
+
+    def test_04_incremental(self):
+        self.index.add('client3.example.com')
+        self.index.remove('client1.example.com')
+        self.index.remove('unknown')
+        self.assertEqual(self.index.prefix('client'), [
+            'Client10.example.com',
+            'client2.example.com',
+            'client3.example.com',
+        ])
+        self.assertEqual(
+            self.index.search('nt3.'), ['client3.example.com'])
+        self.assertEqual(self.index.search('client1.'), [])
+        # Changes after n-grams are indexed
+        self.index.add('client4.example.com')
+        self.index.remove('client2.example.com')
+        self.assertEqual(
+            self.index.search('nt4.'), ['client4.example.com'])
+        self.assertEqual(self.index.search('nt2.'), [])
+
+    def test_05_aliases(self):
+        index = DirectoryIndex(self.HOSTS, directory.get_short_hostname)
+        self.assertTrue('client1' in index)
+        self.assertTrue('CLIENT10' in index)
+        self.assertTrue('client1.example.com' in index)
+        self.assertFalse('example' in index)
+        # Aliases are not listed nor searched
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.prefix('ipa'), ['ipa.example.org'])
+        self.assertEqual(index.search('ipa'), ['ipa.example.org'])
+        index.remove('client1.example.com')
+        self.assertFalse('client1' in index)
+        index.add('client1.example.net')
+        self.assertTrue('client1' in index)
+
+    def test_06_lazy_ngrams(self):
+        # N-grams are indexed on first substring search
+        self.index.prefix('cli')
+        self.assertEqual(self.index._ngrams, None)
+        self.index.search('nt1')
+        self.assertTrue(self.index._ngrams is not None)
+
+        limits = directory.NGRAM_BACKGROUND_NAMES, directory.NGRAM_MAX_NAMES
+        directory.NGRAM_BACKGROUND_NAMES = 2
+        try:
+            # Large indexes are scanned until n-grams are indexed
+            index = DirectoryIndex(self.HOSTS)
+            self.assertEqual(index.search('nt1'), [
+                'client1.example.com', 'Client10.example.com'])
+            for i in range(100):
+                if index._ngrams is not None:
+                    break
+                time.sleep(0.05)
+            self.assertTrue(index._ngrams is not None)
+            self.assertEqual(index.search('nt1'), [
+                'client1.example.com', 'Client10.example.com'])
+            # N-grams of indexes too large are never indexed
+            directory.NGRAM_MAX_NAMES = 2
+            index = DirectoryIndex(self.HOSTS)
+            self.assertEqual(index.search('VER'), ['server.example.com'])
+            self.assertEqual(index._ngrams, None)
+        finally:
+            directory.NGRAM_BACKGROUND_NAMES, directory.NGRAM_MAX_NAMES = \
+                limits
+
+    def test_07_concurrent_changes(self):
+        names = ['host%04d.example.com' % i for i in range(2000)]
+        index = DirectoryIndex(names)
+        index.search('host')
+        done = []
+
+        def change():
+            for i in range(5):
+                for name in names:
+                    index.remove(name)
+                for name in names:
+                    index.add(name)
+            done.append(True)
+        thread = threading.Thread(target=change)
+        thread.start()
+        try:
+            while not done:
+                # Lookups see consistent names while others are changed
+                found = index.prefix('host')
+                self.assertEqual(len(found), len(set(found)))
+                found = index.search('.example.')
+                self.assertEqual(len(found), len(set(found)))
+                list(index)
+        finally:
+            thread.join()
+        self.assertEqual(index.prefix('host'), names)
+
+
+class TestDirectorySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.snapshot = DirectorySnapshot(self.loader, 60)
+
+    def loader(self, kinds):
+        self.calls.append(kinds)
+        return {
+            'users': ['admin', 'guest'],
+            'groups': ['admins', 'developers', 'editors'],
+            'hosts': ['client1.example.com'],
+            'hostgroups': ['ipaservers'],
+        }
+
+    def test_01_load_on_demand(self):
+        self.assertFalse(self.snapshot.is_loaded('users'))
+        self.assertTrue('admin' in self.snapshot.get_index('users'))
+        self.assertTrue(self.snapshot.is_loaded('users'))
+        self.assertFalse(self.snapshot.is_loaded('groups'))
+        self.snapshot.get_index('users')
+        self.assertEqual(self.calls, [['users']])
+        # All kinds are loaded in a single call
+        self.snapshot.load()
+        self.assertEqual(self.calls[-1], list(DirectorySnapshot.KINDS))
+        self.assertRaises(ValueError, self.snapshot.get_index, 'unknown')
+
+    def test_02_ttl(self):
+        self.snapshot.get_index('hosts')
+        self.snapshot.ttl = 0
+        self.assertFalse(self.snapshot.is_loaded('hosts'))
+        self.snapshot.get_index('hosts')
+        self.assertEqual(len(self.calls), 2)
+        # Explicit invalidation
+        self.snapshot.ttl = 60
+        self.snapshot.invalidate('hosts')
+        self.snapshot.get_index('hosts')
+        self.assertEqual(len(self.calls), 3)
+
+    def test_03_update(self):
+        # Updates to indexes not loaded are ignored
+        self.snapshot.update('users', added=['newuser'])
+        self.assertEqual(self.calls, [])
+        self.snapshot.get_index('users')
+        self.snapshot.update('users', added=['newuser'], removed=['guest'])
+        self.assertEqual(
+            list(self.snapshot.get_index('users')), ['admin', 'newuser'])
+        self.assertEqual(len(self.calls), 1)
+        # Hosts are known by their short name too
+        self.assertTrue('client1' in self.snapshot.get_index('hosts'))
+        self.snapshot.update('hosts', added=['client1'])
+        self.assertEqual(
+            list(self.snapshot.get_index('hosts')), ['client1.example.com'])
+
+    def test_04_complete(self):
+        self.assertEqual(
+            self.snapshot.complete('groups', 'i'), ['admins', 'editors'])
+        self.assertEqual(
+            self.snapshot.complete('groups', 'e'), ['editors', 'developers'])
+        self.assertEqual(
+            self.snapshot.complete('groups', 'e', limit=1), ['editors'])
+        self.assertEqual(self.snapshot.complete('users', 'x'), [])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -32,12 +32,42 @@ import freeipamock
 sys.path.append(os.path.join(os.environ['TOPSRCDIR'], 'admin'))
 
 from fleetcommander import fcfreeipa
+from fleetcommander import profiledata
+from fleetcommander.profiledata import dump_settings
 
 # Mocking assignments
 fcfreeipa.api = freeipamock.FreeIPAMock
 fcfreeipa.errors = freeipamock.FreeIPAErrors
 
 
+class CommandRecorder(object):
+    """
+    Records the IPA commands requested, one entry per round trip. Batch
+    command can be disabled, as in servers not supporting it
+    """
+
+    def __init__(self, command, batch=True):
+        self.command = command
+        self.batch_enabled = batch
+        self.calls = []
+
+    def __getattr__(self, name):
+        if name == 'batch' and not self.batch_enabled:
+            raise AttributeError(name)
+        attr = getattr(self.command, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            if name == 'batch':
+                self.calls.append(
+                    (name, [method['method'] for method in args]))
+            else:
+                self.calls.append(name)
+            return attr(*args, **kwargs)
+        return wrapper
+
+
 class TestFreeIPA(unittest.TestCase):
 
     maxDiff = None
@@ -66,7 +96,7 @@ class TestFreeIPA(unittest.TestCase):
     SAVED_PROFILE_DATA = {
         u'cn': (TEST_PROFILE['name'],),
         u'description': (TEST_PROFILE['description'],),
-        u'ipadeskdata': (base64.b64encode(json.dumps(TEST_PROFILE['settings'])),),
+        u'ipadeskdata': (base64.b64encode(dump_settings(TEST_PROFILE['settings'])),),
     }
 
     SAVED_PROFILERULE_DATA = {
@@ -102,7 +132,7 @@ class TestFreeIPA(unittest.TestCase):
     SAVED_PROFILE_DATA_MOD = {
         u'cn': (TEST_PROFILE_MOD['name'],),
         u'description': (TEST_PROFILE_MOD['description'],),
-        u'ipadeskdata': (base64.b64encode(json.dumps(TEST_PROFILE_MOD['settings'])),),
+        u'ipadeskdata': (base64.b64encode(dump_settings(TEST_PROFILE_MOD['settings'])),),
     }
 
     SAVED_PROFILERULE_DATA_MOD = {
@@ -143,6 +173,33 @@ class TestFreeIPA(unittest.TestCase):
         # Check inexistent hostgroup
         self.assertFalse(self.ipa.check_hostgroup_exists('fake'))
 
+    def test_04_find_missing_targets(self):
+        self.assertEqual(
+            self.ipa.find_missing_users(['admin', 'fake', 'guest']), ['fake'])
+        self.assertEqual(
+            self.ipa.find_missing_groups(['admins', 'editors']), [])
+        self.assertEqual(
+            self.ipa.find_missing_hosts(['fake2', 'client1', 'fake1']),
+            ['fake1', 'fake2'])
+        self.assertEqual(
+            self.ipa.find_missing_hostgroups(['fake', 'fake']), ['fake'])
+        # All targets are checked in a single request
+        targets = {
+            'users': ['admin', 'fake'],
+            'groups': ['admins'],
+            'hosts': ['client1', 'fake'],
+            'hostgroups': [],
+        }
+        calls = self.record_commands(self.ipa.find_missing_targets, targets)
+        self.assertEqual(calls, [('batch', [
+            'user_show', 'user_show', 'group_show', 'host_show', 'host_show'])])
+        self.assertEqual(self.ipa.find_missing_targets(targets), {
+            'users': ['fake'],
+            'groups': [],
+            'hosts': ['fake'],
+            'hostgroups': [],
+        })
+
     def test_05_save_profile(self):
         name = self.TEST_PROFILE['name']
         self.ipa.save_profile(self.TEST_PROFILE)
@@ -176,6 +233,38 @@ class TestFreeIPA(unittest.TestCase):
             freeipamock.FreeIPACommand.data.profilerules,
             {name: self.SAVED_PROFILERULE_DATA_MOD})
 
+    def test_07_update_profile_unchanged(self):
+        name = self.TEST_PROFILE['name']
+        self.ipa.save_profile(self.TEST_PROFILE)
+        calls = []
+        command = freeipamock.FreeIPACommand
+        deskprofile_mod = command.deskprofile_mod
+        command.deskprofile_mod = lambda *args, **kwargs: calls.append(kwargs)
+        try:
+            # Saving same data does not modify the profile
+            self.ipa.save_profile(self.TEST_PROFILE)
+            self.assertEqual(calls, [])
+            # Rules are updated anyway
+            profile = self.TEST_PROFILE.copy()
+            profile['priority'] = 60
+            self.ipa.save_profile(profile)
+            self.assertEqual(calls, [])
+            self.assertEqual(
+                freeipamock.FreeIPACommand.data.profilerules[name]['priority'],
+                60)
+            # Modified data is written
+            self.ipa.save_profile(self.TEST_PROFILE_MOD)
+            self.assertEqual(len(calls), 1)
+            # Stubbed update did not modify data stored in IPA
+            self.ipa.save_profile(self.TEST_PROFILE)
+            self.assertEqual(len(calls), 1)
+        finally:
+            command.deskprofile_mod = deskprofile_mod
+        # Changes made by other administrators are overwritten
+        fcfreeipa.FreeIPAConnector().save_profile(self.TEST_PROFILE_MOD)
+        self.ipa.save_profile(self.TEST_PROFILE)
+        self.assertEqual(self.ipa.get_profile(name), self.TEST_PROFILE)
+
     def test_08_del_profile(self):
         # Save a profile
         self.ipa.save_profile(self.TEST_PROFILE)
@@ -260,5 +349,329 @@ class TestFreeIPA(unittest.TestCase):
         profiledata = profilerules[self.TEST_PROFILE['name']]
         self.assertEqual(profiledata['hostcategory'], 'all')
 
+    def test_15_compressed_profile_data(self):
+        name = self.TEST_PROFILE['name']
+        profile = self.TEST_PROFILE.copy()
+        profile['settings'] = {
+            'org.gnome.gsettings': [{
+                'schema': 'org.gnome.desktop.notifications.application',
+                'key': '/org/gnome/desktop/notifications/key%s' % i,
+                'value': "'abrt-applet.desktop'",
+                'signature': 's',
+            } for i in range(20)]
+        }
+        self.ipa = fcfreeipa.FreeIPAConnector(
+            compression_threshold=0, chunk_size=64)
+        self.ipa.save_profile(profile)
+        stored = base64.b64decode(
+            freeipamock.FreeIPACommand.data.profiles[name]['ipadeskdata'][0])
+        encoded = json.loads(stored)
+        self.assertEqual(encoded[profiledata.ENCODING_KEY], 'zlib')
+        self.assertTrue(len(encoded[profiledata.CHUNKS_KEY]) > 1)
+        for chunk in encoded[profiledata.CHUNKS_KEY]:
+            self.assertTrue(len(chunk) <= 64)
+        self.assertTrue(
+            len(stored) < len(dump_settings(profile['settings'])))
+        self.assertEqual(self.ipa.get_profile(name), profile)
+        # Plain data is still read by compressing connectors
+        self.ipa.del_profile(name)
+        fcfreeipa.FreeIPAConnector().save_profile(self.TEST_PROFILE)
+        self.assertEqual(self.ipa.get_profile(name), self.TEST_PROFILE)
+
+    def test_16_profile_data_encoding(self):
+        settings = self.TEST_PROFILE['settings']
+        # Below threshold or not worth compressing data is kept plain
+        self.assertEqual(
+            profiledata.encode_settings(settings), dump_settings(settings))
+        self.assertEqual(
+            profiledata.encode_settings(settings, 100000),
+            dump_settings(settings))
+        self.assertEqual(
+            profiledata.encode_settings({}, 0), dump_settings({}))
+        self.assertEqual(
+            profiledata.decode_settings(
+                profiledata.encode_settings(settings, 0, 10)),
+            settings)
+        self.assertRaises(
+            ValueError, profiledata.decode_settings,
+            '{"fc-encoding": "unknown", "fc-chunks": []}')
+
+    def record_commands(self, fun, *args):
+        recorder = CommandRecorder(freeipamock.FreeIPAMock.Command)
+        fcfreeipa.api.Command = recorder
+        try:
+            fun(*args)
+        finally:
+            fcfreeipa.api.Command = recorder.command
+        return recorder.calls
+
+    def test_17_rule_update_round_trips(self):
+        name = self.TEST_PROFILE['name']
+        # Rule is created in one request
+        calls = self.record_commands(self.ipa.save_profile, self.TEST_PROFILE)
+        self.assertEqual(calls, [
+            'deskprofile_show',
+            'deskprofile_add',
+            ('batch', [
+                'deskprofilerule_add',
+                'deskprofilerule_add_user',
+                'deskprofilerule_add_host']),
+        ])
+        # Unchanged rule is only read
+        calls = self.record_commands(self.ipa.save_profile, self.TEST_PROFILE)
+        self.assertEqual(calls, ['deskprofile_show', 'deskprofilerule_show'])
+        # Only needed commands are sent in one request
+        calls = self.record_commands(
+            self.ipa.save_profile, self.TEST_PROFILE_MOD)
+        self.assertEqual(calls, [
+            'deskprofile_show',
+            'deskprofile_mod',
+            'deskprofilerule_show',
+            ('batch', ['deskprofilerule_mod', 'deskprofilerule_remove_user']),
+        ])
+        self.assertEqual(
+            freeipamock.FreeIPACommand.data.profilerules,
+            {name: self.SAVED_PROFILERULE_DATA_MOD})
+        # Single commands are not batched
+        profile = self.TEST_PROFILE_MOD.copy()
+        profile['priority'] = 60
+        calls = self.record_commands(self.ipa.save_profile, profile)
+        self.assertEqual(calls, [
+            'deskprofile_show',
+            'deskprofilerule_show',
+            'deskprofilerule_mod',
+        ])
+
+    def test_18_rule_update_plan(self):
+        name = self.TEST_PROFILE['name']
+        self.ipa.save_profile(self.TEST_PROFILE)
+        rule = self.ipa.get_profile_rule(name)
+        # Nothing to do
+        self.assertEqual(
+            self.ipa._plan_profile_rules_update(self.TEST_PROFILE, rule),
+            ([], False))
+        # Removing all hosts sets hostcategory and removes them in one step
+        profile = self.TEST_PROFILE.copy()
+        profile['hosts'] = []
+        profile['hostgroups'] = []
+        commands, verify = self.ipa._plan_profile_rules_update(profile, rule)
+        self.assertFalse(verify)
+        self.assertEqual(commands, [
+            ('deskprofilerule_mod', [name], {
+                'ipadeskprofiletarget': name,
+                'ipadeskprofilepriority': 100,
+                'hostcategory': u'all',
+            }),
+            ('deskprofilerule_remove_host', [name], {
+                'host': [u'client1'],
+                'hostgroup': [u'ipaservers'],
+            }),
+        ])
+        # Replacing every host needs the result to be checked
+        profile['hosts'] = ['nonexisting']
+        commands, verify = self.ipa._plan_profile_rules_update(profile, rule)
+        self.assertTrue(verify)
+        self.assertEqual(
+            [command for command, args, options in commands],
+            ['deskprofilerule_add_host', 'deskprofilerule_remove_host'])
+        # Renaming always modifies the rule
+        profile = self.TEST_PROFILE.copy()
+        profile['name'] = 'Renamed'
+        commands, verify = self.ipa._plan_profile_rules_update(
+            profile, rule, name)
+        self.assertEqual(commands[0][:2], ('deskprofilerule_mod', [name]))
+        self.assertEqual(commands[0][2]['rename'], u'Renamed')
+        self.ipa.save_profile(dict(profile, oldname=name))
+        self.assertEqual(
+            freeipamock.FreeIPACommand.data.profilerules.keys(), ['Renamed'])
+
+    def test_19_get_profiles_full(self):
+        self.assertEqual(self.ipa.get_profiles_full(), [])
+        self.ipa.save_profile(self.TEST_PROFILE)
+        profile = self.TEST_PROFILE.copy()
+        profile['name'] = 'Other Profile'
+        profile['hosts'] = []
+        profile['hostgroups'] = []
+        self.ipa.save_profile(profile)
+        # All profiles are fetched in one request
+        calls = self.record_commands(self.ipa.get_profiles_full)
+        self.assertEqual(calls, [
+            ('batch', ['deskprofile_find', 'deskprofilerule_find'])])
+        profiles = sorted(
+            self.ipa.get_profiles_full(), key=lambda p: p['name'])
+        self.assertEqual(profiles, [profile, self.TEST_PROFILE])
+        self.assertEqual(
+            profiles[1], self.ipa.get_profile(self.TEST_PROFILE['name']))
+
+    def test_19_iter_profiles(self):
+        self.ipa.save_profile(self.TEST_PROFILE)
+        profile = self.TEST_PROFILE.copy()
+        profile['name'] = 'Other Profile'
+        self.ipa.save_profile(profile)
+        expected = [profile, self.TEST_PROFILE]
+        for batch in (True, False):
+            recorder = CommandRecorder(
+                freeipamock.FreeIPAMock.Command, batch)
+            fcfreeipa.api.Command = recorder
+            try:
+                profiles = list(self.ipa.iter_profiles(1))
+            finally:
+                fcfreeipa.api.Command = recorder.command
+            self.assertEqual(
+                sorted(profiles, key=lambda p: p['name']), expected)
+            if batch:
+                self.assertEqual(recorder.calls, ['deskprofile_find'] + [
+                    ('batch', ['deskprofile_show', 'deskprofilerule_show'])
+                ] * 2)
+            else:
+                self.assertEqual(recorder.calls, ['deskprofile_find'] + [
+                    'deskprofile_show', 'deskprofilerule_show'] * 2)
+        # Profiles removed while iterating are skipped
+        recorder = CommandRecorder(freeipamock.FreeIPAMock.Command, False)
+        fcfreeipa.api.Command = recorder
+        try:
+            profiles = self.ipa.iter_profiles(1)
+            first = next(profiles)
+            for name in freeipamock.FreeIPACommand.data.profiles.keys():
+                if name != first['name']:
+                    del(freeipamock.FreeIPACommand.data.profilerules[name])
+            self.assertEqual(list(profiles), [])
+        finally:
+            fcfreeipa.api.Command = recorder.command
+
+    def test_20_directory_snapshot(self):
+        calls = self.record_commands(self.ipa.directory.load)
+        self.assertEqual(calls, [('batch', [
+            'user_find', 'group_find', 'host_find', 'hostgroup_find'])])
+        self.assertEqual(
+            self.ipa.directory.complete('hosts', 'cli'), ['client1'])
+        self.assertEqual(
+            self.ipa.directory.complete('users', 'm'), ['admin'])
+        # Names in the snapshot are not looked up in IPA
+        targets = {'users': ['admin', 'fake'], 'hosts': ['client1']}
+        calls = self.record_commands(self.ipa.find_missing_targets, targets)
+        self.assertEqual(calls, ['user_show'])
+        self.assertEqual(self.ipa.find_missing_targets(targets), {
+            'users': ['fake'],
+            'groups': [],
+            'hosts': [],
+            'hostgroups': [],
+        })
+        # Names created in IPA after loading the snapshot are added to it
+        freeipamock.FreeIPACommand.data.users.append('newuser')
+        self.ipa.find_missing_targets({'users': ['newuser']})
+        self.assertTrue('newuser' in self.ipa.directory.get_index('users'))
+        calls = self.record_commands(
+            self.ipa.find_missing_targets, {'users': ['newuser']})
+        self.assertEqual(calls, [])
+
+    def test_21_session(self):
+        session = self.ipa.session
+        rpcclient = freeipamock.FreeIPARPCClient
+        # Connected session is used without checking it
+        calls = self.record_commands(self.ipa.get_global_policy)
+        self.assertEqual(calls, ['deskprofileconfig_show'])
+        # Dropped connection is opened again on next use
+        rpcclient.disconnect()
+        self.assertEqual(self.ipa.get_global_policy(), 1)
+        self.assertTrue(rpcclient.isconnected())
+        # Connection errors invalidate the session
+        reasons = []
+        session.add_invalidation_callback(reasons.append)
+        self.ipa.save_profile(self.TEST_PROFILE)
+        command = freeipamock.FreeIPACommand
+        deskprofileconfig_show = command.deskprofileconfig_show
+
+        def network_error(*args, **kwargs):
+            raise freeipamock.FreeIPAErrors.NetworkError('Connection lost')
+        command.deskprofileconfig_show = network_error
+        try:
+            # Read commands are retried once
+            self.assertRaises(
+                freeipamock.FreeIPAErrors.NetworkError,
+                self.ipa.get_global_policy)
+        finally:
+            command.deskprofileconfig_show = deskprofileconfig_show
+        self.assertEqual(len(reasons), 2)
+        self.assertFalse(session.is_connected())
+        self.assertEqual(self.ipa.get_global_policy(), 1)
+        self.assertTrue(session.is_connected())
+
+    def test_21_session_retry(self):
+        session = self.ipa.session
+        self.ipa.save_profile(self.TEST_PROFILE)
+        command = freeipamock.FreeIPAMock.Command
+
+        def fail_once(name):
+            original = getattr(command, name)
+
+            def wrapper(*args, **kwargs):
+                setattr(command, name, original)
+                raise freeipamock.FreeIPAErrors.NetworkError('Connection lost')
+            setattr(command, name, wrapper)
+        try:
+            # Reads run again on a new connection
+            fail_once('deskprofileconfig_show')
+            self.assertEqual(self.ipa.get_global_policy(), 1)
+            self.assertTrue(session.is_connected())
+            fail_once('batch')
+            self.assertEqual(len(self.ipa.get_profiles_full()), 1)
+            # Modifications are not retried
+            fail_once('deskprofileconfig_mod')
+            self.assertRaises(
+                freeipamock.FreeIPAErrors.NetworkError,
+                self.ipa.set_global_policy, 2)
+            self.assertEqual(self.ipa.get_global_policy(), 1)
+        finally:
+            for name in ['deskprofileconfig_show', 'deskprofileconfig_mod',
+                         'batch']:
+                command.__dict__.pop(name, None)
+        # Idle connections are checked before being used
+        session.keepalive_interval = 0
+        calls = self.record_commands(self.ipa.get_global_policy)
+        self.assertEqual(calls, ['ping', 'deskprofileconfig_show'])
+
+    def test_22_session_backoff(self):
+        session = self.ipa.session
+        rpcclient = freeipamock.FreeIPARPCClient
+        connect = rpcclient.__dict__['connect']
+
+        def connection_refused():
+            raise freeipamock.FreeIPAErrors.NetworkError('Connection refused')
+        rpcclient.connect = staticmethod(connection_refused)
+        try:
+            session.invalidate('test')
+            self.assertRaises(
+                freeipamock.FreeIPAErrors.NetworkError,
+                self.ipa.get_global_policy)
+            # No connection attempts until backoff time passes
+            rpcclient.connect = connect
+            self.assertRaises(
+                fcfreeipa.IPAConnectionError, self.ipa.get_global_policy)
+            session._retry_time = 0
+            self.assertEqual(self.ipa.get_global_policy(), 1)
+            self.assertEqual(session._failures, 0)
+        finally:
+            rpcclient.connect = connect
+
+    def test_23_session_keepalive_and_metrics(self):
+        session = self.ipa.session
+        session.metrics.reset()
+        # Recently used connection is not pinged
+        calls = self.record_commands(session.keepalive)
+        self.assertEqual(calls, [])
+        session.keepalive_interval = 0
+        calls = self.record_commands(session.keepalive)
+        self.assertEqual(calls, ['ping'])
+        self.ipa.get_global_policy()
+        self.ipa.get_global_policy()
+        stats = session.metrics.get_stats()
+        self.assertEqual(sorted(stats.keys()), ['deskprofileconfig_show', 'ping'])
+        self.assertEqual(stats['deskprofileconfig_show']['calls'], 2)
+        self.assertEqual(stats['deskprofileconfig_show']['errors'], 0)
+        self.assertTrue(
+            stats['deskprofileconfig_show']['max_time'] >=
+            stats['deskprofileconfig_show']['avg_time'])
+
 if __name__ == '__main__':
     unittest.main()
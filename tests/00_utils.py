@@ -0,0 +1,76 @@
+#!./python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+# Python imports
+import sys
+import os
+import json
+import unittest
+
+PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
+sys.path.append(PYTHONPATH)
+
+from fleetcommander.utils import iter_json_object
+
+
+class TestIterJSONObject(unittest.TestCase):
+
+    CHANGESETS = {
+        'org.gnome.gsettings': [
+            {'key': '/foo/bar', 'value': True, 'signature': 'b'},
+        ],
+        'org.chromium.Policies': [
+            {'key': 'ManagedBookmarks', 'value': [
+                {'name': 'Fedora', 'children': [
+                    {'name': 'Get Fedora', 'url': 'https://getfedora.org/'},
+                ]},
+            ]},
+        ],
+        'org.freedesktop.NetworkManager': [],
+    }
+
+    def test_01_iterate(self):
+        for data in (json.dumps(self.CHANGESETS),
+                     json.dumps(self.CHANGESETS, indent=4),
+                     ' \n %s \n' % json.dumps(self.CHANGESETS)):
+            self.assertEqual(dict(iter_json_object(data)), self.CHANGESETS)
+
+    def test_02_empty(self):
+        self.assertEqual(list(iter_json_object('{}')), [])
+        self.assertEqual(list(iter_json_object(' { } ')), [])
+
+    def test_03_lazy(self):
+        # Members are decoded as iteration goes on
+        members = iter_json_object('{"foo": [1, 2], "bar": [3], invalid}')
+        self.assertEqual(members.next(), (u'foo', [1, 2]))
+        self.assertEqual(members.next(), (u'bar', [3]))
+        self.assertRaises(ValueError, members.next)
+
+    def test_04_invalid(self):
+        for data in ('', '[]', '"foo"', '{"foo": 1', '{"foo" 1}',
+                     '{1: 1}', '{"foo": 1,}', '{"foo": 1} {}',
+                     '{"foo": 1 "bar": 2}'):
+            self.assertRaises(ValueError, list, iter_json_object(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,6 +24,10 @@
 import sys
 import os
 import json
+import copy
+import logging
+import shutil
+import tempfile
 import unittest
 
 PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
@@ -81,6 +85,18 @@ class BaseMergerTest(unittest.TestCase):
         self.assertEqual(len(merged), 4)
         self.assertEqual(merged, expected)
 
+    def test_02_incremental_merge(self):
+        changeset1, changeset2 = self.generate_changesets()
+
+        index = self.merger.index(changeset1)
+        self.assertEqual(len(index), len(changeset1))
+        merged = index.apply(changeset2).changes()
+        merged.sort()
+        expected = self.merger.merge(changeset1, changeset2)
+        expected.sort()
+        self.assertEqual(merged, expected)
+        self.assertTrue(changeset2[2][self.KEY_NAME] in index)
+
 
 class NetworkManagerChangeMergerTest(BaseMergerTest):
 
@@ -192,12 +208,43 @@ class ChromiumMergerTest(BaseMergerTest):
         return (changeset1, changeset2)
 
     def test_00_merge_bookmarks(self):
+        change1 = copy.deepcopy(self.BOOKMARKS_CHANGE1)
+        change2 = copy.deepcopy(self.BOOKMARKS_CHANGE2)
         result = self.merger.merge_bookmarks(
             self.BOOKMARKS_CHANGE1['value'],
             self.BOOKMARKS_CHANGE2['value'])
 
         self.assertEqual(result, self.BOOKMARKS_CHANGE_MERGED['value'])
-
+        # Merged trees are not modified
+        self.assertEqual(self.BOOKMARKS_CHANGE1, change1)
+        self.assertEqual(self.BOOKMARKS_CHANGE2, change2)
+
+    def test_00_merge_bookmarks_repeated_names(self):
+        # Folders and leaves sharing names are kept apart and repeated
+        # incoming folders are merged into the first matching one
+        a = [
+            {'name': 'Docs', 'url': 'http://docs.example.com'},
+            {'name': 'Docs', 'children': [
+                {'name': 'One', 'url': 'http://one.example.com'}]},
+        ]
+        b = [
+            {'name': 'Docs', 'children': [
+                {'name': 'Two', 'url': 'http://two.example.com'}]},
+            {'name': 'Docs', 'url': 'http://docs.example.com'},
+            {'name': 'Docs', 'url': 'http://other.example.com'},
+            {'name': 'Docs', 'children': [
+                {'name': 'One', 'url': 'http://one.example.com'},
+                {'name': 'Three', 'url': 'http://three.example.com'}]},
+        ]
+        result = self.merger.merge_bookmarks(a, b)
+        self.assertEqual(result, [
+            {'name': 'Docs', 'url': 'http://docs.example.com'},
+            {'name': 'Docs', 'children': [
+                {'name': 'One', 'url': 'http://one.example.com'},
+                {'name': 'Two', 'url': 'http://two.example.com'},
+                {'name': 'Three', 'url': 'http://three.example.com'}]},
+            {'name': 'Docs', 'url': 'http://other.example.com'},
+        ])
 
     def test_01_merge(self):
         changeset1, changeset2 = self.generate_changesets()
@@ -211,5 +258,379 @@ class ChromiumMergerTest(BaseMergerTest):
         self.assertEqual(len(merged), 5)
         self.assertEqual(merged, expected)
 
+    def test_02_tracing(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger()
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            changeset1, changeset2 = self.generate_changesets()
+            self.merger.merge(changeset1, changeset2)
+            self.assertEqual(records, [])
+
+            self.MERGER_CLASS.set_tracing()
+            self.merger.merge(changeset1, changeset2)
+            # Other merger classes are not traced
+            mergers.GSettingsChangeMerger().merge(changeset1, changeset2)
+        finally:
+            self.MERGER_CLASS.set_tracing(False)
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertTrue(records)
+        for record in records:
+            self.assertEqual(record.merger, 'ChromiumChangeMerger')
+        self.assertEqual(
+            [r.event for r in records if r.event == 'merge_folder'],
+            ['merge_folder'])
+        self.assertEqual(records[-1].event, 'merged')
+        self.assertEqual(records[-1].fields['changes'], 5)
+        self.assertEqual(
+            records[-1].getMessage(),
+            'ChromiumChangeMerger: merged changes=5 changesets=2')
+
+
+class ThreeWayMergeTest(unittest.TestCase):
+
+    BASE = [
+        {'key': '/foo/bar', 'value': 1},
+        {'key': '/foo/baz', 'value': 2},
+        {'key': '/foo/removed', 'value': 3},
+        {'key': '/foo/conflict', 'value': 4},
+    ]
+
+    STORED = [
+        {'key': '/foo/bar', 'value': 10},
+        {'key': '/foo/baz', 'value': 2},
+        {'key': '/foo/conflict', 'value': 40},
+        {'key': '/foo/stored', 'value': 5},
+    ]
+
+    INCOMING = [
+        {'key': '/foo/bar', 'value': 1},
+        {'key': '/foo/baz', 'value': 20},
+        {'key': '/foo/removed', 'value': 3},
+        {'key': '/foo/conflict', 'value': 400},
+        {'key': '/foo/incoming', 'value': 6},
+    ]
+
+    def test_01_merge3(self):
+        merger = mergers.GSettingsChangeMerger()
+        merged, conflicts = merger.merge3(
+            self.BASE, self.STORED, self.INCOMING)
+        self.assertEqual(merged, [
+            {'key': '/foo/bar', 'value': 10},
+            {'key': '/foo/baz', 'value': 20},
+            {'key': '/foo/conflict', 'value': 400},
+            {'key': '/foo/incoming', 'value': 6},
+            {'key': '/foo/stored', 'value': 5},
+        ])
+        self.assertEqual(conflicts, [{
+            'key': '/foo/conflict',
+            'base': {'key': '/foo/conflict', 'value': 4},
+            'stored': {'key': '/foo/conflict', 'value': 40},
+            'incoming': {'key': '/foo/conflict', 'value': 400},
+        }])
+
+    def test_02_merge3_keep_policy(self):
+        merger = KeepChangeMerger()
+        merged, conflicts = merger.merge3(
+            self.BASE, self.STORED, self.INCOMING)
+        self.assertEqual(len(conflicts), 1)
+        self.assertTrue({'key': '/foo/conflict', 'value': 40} in merged)
+
+    def test_03_merge_settings(self):
+        registry = mergers.get_registry()
+        base = {'org.gnome.gsettings': self.BASE}
+        settings = {
+            'org.gnome.gsettings': list(self.STORED),
+            'org.example.unknown': [{'key': 'foo'}],
+        }
+        changesets = {
+            'org.gnome.gsettings': [
+                {'key': '/foo/baz', 'value': 20},
+                {'key': '/foo/conflict', 'value': 400},
+            ],
+            'org.example.unknown': [{'key': 'bar'}],
+        }
+        conflicts = registry.merge_settings(settings, changesets, base)
+        self.assertEqual(len(conflicts), 1)
+        self.assertEqual(conflicts[0]['namespace'], 'org.gnome.gsettings')
+        self.assertEqual(conflicts[0]['key'], '/foo/conflict')
+        self.assertEqual(settings['org.example.unknown'], [{'key': 'bar'}])
+        self.assertEqual(settings['org.gnome.gsettings'], [
+            {'key': '/foo/bar', 'value': 10},
+            {'key': '/foo/baz', 'value': 20},
+            {'key': '/foo/conflict', 'value': 400},
+            {'key': '/foo/stored', 'value': 5},
+        ])
+        # Without base changes are merged on top of stored ones
+        settings = {'org.gnome.gsettings': list(self.STORED)}
+        conflicts = registry.merge_settings(settings, changesets)
+        self.assertEqual(conflicts, [])
+        self.assertEqual(len(settings['org.gnome.gsettings']), 4)
+
+    def test_04_canonical_order(self):
+        merger = mergers.GSettingsChangeMerger()
+        merged = merger.merge(self.STORED, self.INCOMING)
+        self.assertEqual(
+            [change['key'] for change in merged],
+            sorted([change['key'] for change in merged]))
+        self.assertEqual(
+            merged,
+            merger.merge(list(reversed(self.STORED)), self.INCOMING))
+
+    def test_05_dump_settings(self):
+        settings = {
+            'org.gnome.gsettings': self.BASE,
+            'org.freedesktop.NetworkManager': [],
+        }
+        dump = mergers.dump_settings(settings)
+        self.assertEqual(json.loads(dump), settings)
+        self.assertTrue(dump.startswith(
+            '{"org.freedesktop.NetworkManager":[],"org.gnome.gsettings":'))
+        self.assertEqual(
+            dump, mergers.dump_settings(json.loads(json.dumps(settings))))
+
+    def test_06_settings_revision(self):
+        settings = {'org.gnome.gsettings': self.BASE}
+        revision = mergers.get_settings_revision(settings)
+        self.assertEqual(
+            revision, mergers.get_settings_revision(
+                json.loads(json.dumps(settings))))
+        self.assertNotEqual(
+            revision, mergers.get_settings_revision(
+                {'org.gnome.gsettings': self.STORED}))
+
+    def test_07_merge_settings_nested_bookmarks(self):
+        registry = mergers.get_registry()
+        ns = 'org.chromium.Policies'
+        bookmarks = {
+            'key': 'ManagedBookmarks',
+            'value': [
+                {'name': 'Fedora', 'children': [
+                    {'name': 'Get Fedora', 'url': 'https://getfedora.org/'}]},
+            ]
+        }
+        base = {ns: [copy.deepcopy(bookmarks)]}
+        settings = {ns: [copy.deepcopy(bookmarks)]}
+        # Session adds a bookmark inside an existing folder
+        changesets = {ns: [{
+            'key': 'ManagedBookmarks',
+            'value': [
+                {'name': 'Fedora', 'children': [
+                    {'name': 'SSSD', 'url': 'https://pagure.io/SSSD'}]},
+            ]
+        }]}
+        conflicts = registry.merge_settings(settings, changesets, base)
+        self.assertEqual(conflicts, [])
+        self.assertEqual(settings[ns], [{
+            'key': 'ManagedBookmarks',
+            'value': [
+                {'name': 'Fedora', 'children': [
+                    {'name': 'Get Fedora', 'url': 'https://getfedora.org/'},
+                    {'name': 'SSSD', 'url': 'https://pagure.io/SSSD'}]},
+            ]
+        }])
+        # Base is left untouched
+        self.assertEqual(base, {ns: [bookmarks]})
+
+
+class MergerPropertiesTest(unittest.TestCase):
+
+    MERGER_CLASSES = [
+        mergers.GSettingsChangeMerger,
+        mergers.NetworkManagerChangeMerger,
+        mergers.ChromiumChangeMerger,
+        mergers.FirefoxChangeMerger,
+    ]
+
+    def get_changesets(self, merger):
+        # Overlapping changesets, each one modifying a key of the others
+        def changes(*items):
+            return [{merger.KEY_NAME: key, 'value': value}
+                    for key, value in items]
+        return (
+            changes(('a', 1), ('b', True)),
+            changes(('b', False), ('c', 'value')),
+            changes(('c', 3), ('a', 'other'), ('d', 4)),
+        )
+
+    def check_properties(self, merger, a, b, c):
+        inputs = copy.deepcopy([a, b, c])
+        # Idempotence
+        self.assertEqual(merger.merge(a, a), merger.merge(a))
+        # Associativity
+        self.assertEqual(
+            merger.merge(merger.merge(a, b), c),
+            merger.merge(a, merger.merge(b, c)))
+        # Changes are sorted by key
+        merged = merger.merge(c, b, a)
+        keys = [merger.get_key_from_change(change) for change in merged]
+        self.assertEqual(keys, sorted(set(keys)))
+        # Merged changesets are not modified
+        self.assertEqual([a, b, c], inputs)
+
+    def test_01_properties(self):
+        for merger_class in self.MERGER_CLASSES:
+            merger = merger_class()
+            self.check_properties(merger, *self.get_changesets(merger))
+
+    def test_02_bookmarks_properties(self):
+        def bookmarks(*names):
+            return {
+                'key': 'ManagedBookmarks',
+                'value': [{'name': 'Folder', 'children': [
+                    {'name': name, 'url': 'http://%s.example.com' % name}
+                    for name in names]}],
+            }
+        self.check_properties(
+            mergers.ChromiumChangeMerger(),
+            [bookmarks('a', 'b')],
+            [bookmarks('b', 'c')],
+            [bookmarks('d'), {'key': 'Policy', 'value': 1}])
+
+
+class KeepChangeMerger(mergers.BaseChangeMerger):
+    NAMESPACES = ('org.example.keep', )
+    CONFLICT_POLICY = 'keep'
+
+
+class MergerRegistryTest(unittest.TestCase):
+
+    PLUGIN = """
+from fleetcommander import mergers
+
+class ExampleChangeMerger(mergers.GSettingsChangeMerger):
+    NAMESPACES = ('org.example.plugin', 'org.gnome.gsettings')
+    KEY_NAME = 'id'
+"""
+
+    def setUp(self):
+        self.test_directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_directory)
+
+    def test_01_builtin_mergers(self):
+        registry = mergers.get_registry()
+        self.assertEqual(registry.namespaces(), [
+            'com.google.chrome.Policies',
+            'org.chromium.Policies',
+            'org.freedesktop.NetworkManager',
+            'org.gnome.gsettings',
+            'org.libreoffice.registry',
+            'org.mozilla.firefox',
+        ])
+        self.assertTrue(isinstance(
+            registry['org.freedesktop.NetworkManager'],
+            mergers.NetworkManagerChangeMerger))
+        self.assertFalse('org.example.unknown' in registry)
+        self.assertEqual(registry.get('org.example.unknown'), None)
+
+    def test_02_conflict_policy(self):
+        registry = mergers.MergerRegistry()
+        registry.register(KeepChangeMerger)
+        merger = registry['org.example.keep']
+        merged = merger.merge(
+            [{'key': 'foo', 'value': 1}],
+            [{'key': 'foo', 'value': 2}, {'key': 'bar', 'value': 3}])
+        self.assertEqual(merged, [
+            {'key': 'bar', 'value': 3}, {'key': 'foo', 'value': 1}])
+
+        class BadChangeMerger(KeepChangeMerger):
+            CONFLICT_POLICY = 'unknown'
+
+        self.assertRaises(ValueError, registry.register, BadChangeMerger)
+
+    def test_03_load_directory(self):
+        with open(os.path.join(self.test_directory, 'example.py'), 'w') as fd:
+            fd.write(self.PLUGIN)
+            fd.close()
+        with open(os.path.join(self.test_directory, 'broken.py'), 'w') as fd:
+            fd.write('raise Exception("Broken plugin")')
+            fd.close()
+        registry = mergers.get_registry(self.test_directory)
+        self.assertEqual(
+            registry['org.example.plugin'].__class__.__name__,
+            'ExampleChangeMerger')
+        # Plugins override builtin mergers
+        self.assertTrue(
+            registry['org.gnome.gsettings'] is
+            registry['org.example.plugin'])
+        self.assertEqual(
+            registry['org.gnome.gsettings'].get_key_from_change(
+                {'id': 'foo'}), 'foo')
+        # Imported builtin classes are not registered again
+        self.assertTrue(isinstance(
+            registry['org.mozilla.firefox'], mergers.FirefoxChangeMerger))
+
+    def test_04_missing_directory(self):
+        registry = mergers.get_registry(
+            os.path.join(self.test_directory, 'missing'))
+        self.assertEqual(len(registry.namespaces()), 6)
+
+    def test_05_load_entry_points(self):
+        class EntryPoint(object):
+            def __init__(self, obj):
+                self.obj = obj
+
+            def load(self):
+                if isinstance(self.obj, Exception):
+                    raise self.obj
+                return self.obj
+
+        class PkgResources(object):
+            def iter_entry_points(self, group):
+                self.group = group
+                return [EntryPoint(KeepChangeMerger),
+                        EntryPoint(ImportError('Broken package'))]
+
+        pkg_resources = mergers.pkg_resources
+        mergers.pkg_resources = PkgResources()
+        try:
+            registry = mergers.get_registry()
+            self.assertEqual(
+                mergers.pkg_resources.group, 'fleetcommander.mergers')
+        finally:
+            mergers.pkg_resources = pkg_resources
+        self.assertTrue(isinstance(
+            registry['org.example.keep'], KeepChangeMerger))
+        self.assertEqual(len(registry.namespaces()), 7)
+
+    def test_06_cached_indexes(self):
+        registry = mergers.get_registry()
+        ns = 'org.gnome.gsettings'
+        merger = registry[ns]
+        settings = {ns: [{'key': '/foo', 'value': 1}]}
+        indexes = registry.get_indexes('profile', 'rev1')
+        self.assertEqual(indexes, {})
+        registry.merge_changeset(
+            settings, ns, [{'key': '/bar', 'value': 2}], indexes=indexes)
+        registry.keep_indexes('profile', 'rev2', indexes)
+        # Stored changes indexed by last merge are not indexed again
+        indexes = registry.get_indexes('profile', 'rev2')
+        merger.index = None
+        try:
+            registry.merge_changeset(
+                settings, ns, [{'key': '/foo', 'value': 3}], indexes=indexes)
+        finally:
+            del merger.index
+        self.assertEqual(settings[ns], [
+            {'key': '/bar', 'value': 2}, {'key': '/foo', 'value': 3}])
+        # Indexes are only returned for the revision they were made from
+        registry.keep_indexes('profile', 'rev3', indexes)
+        self.assertEqual(registry.get_indexes('profile', 'rev2'), {})
+        self.assertEqual(registry.get_indexes('profile', 'rev3'), {})
+        # Only indexes of the last merged profiles are kept
+        for i in range(registry.MAX_CACHED_INDEXES + 1):
+            registry.keep_indexes(i, 'rev', indexes)
+        self.assertEqual(registry.get_indexes(0, 'rev'), {})
+        self.assertTrue(registry.get_indexes(1, 'rev') is indexes)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -30,6 +30,7 @@ import unittest
 import json
 import urllib2
 import base64
+import threading
 
 import dbus
 
@@ -109,6 +110,13 @@ class TestDbusService(unittest.TestCase):
             'tmp_session_destroy_timeout': 60,
         }
 
+        self.start_service()
+
+        self.ssh = sshcontroller.SSHController()
+        self.known_hosts_file = os.path.join(
+            self.test_directory, 'known_hosts')
+
+    def start_service(self, env=None):
         # Open service
         self.service = subprocess.Popen([
             os.environ['PYTHON'],
@@ -116,7 +124,7 @@ class TestDbusService(unittest.TestCase):
                 os.environ['TOPSRCDIR'],
                 'tests/test_fcdbus_service.py'),
             self.test_directory,
-        ])
+        ], env=env)
 
         checks = 0
         while True:
@@ -133,10 +141,6 @@ class TestDbusService(unittest.TestCase):
                         'Test error: ' +
                         'DBUS Service is taking too much to start')
 
-        self.ssh = sshcontroller.SSHController()
-        self.known_hosts_file = os.path.join(
-            self.test_directory, 'known_hosts')
-
     def tearDown(self):
         # Kill service
         self.service.kill()
@@ -424,6 +428,40 @@ class TestDbusService(unittest.TestCase):
         del(profile['hostcategory'])
         self.assertEqual(resp['data'], profile)
 
+    def test_17_get_profiles_full(self):
+        resp = self.c.get_profiles_full()
+        self.assertTrue(resp['status'])
+        self.assertEqual(resp['data'], [])
+        # Create a profile
+        resp = self.c.save_profile(self.DUMMY_PROFILE_PAYLOAD)
+        # Profiles have the same data returned by get_profile
+        resp = self.c.get_profiles_full()
+        self.assertTrue(resp['status'])
+        profile = self.DUMMY_PROFILE_DATA.copy()
+        del(profile['hostcategory'])
+        self.assertEqual(resp['data'], [profile])
+        self.assertEqual(
+            self.c.get_profile(self.DUMMY_PROFILE_NAME)['data'], profile)
+
+    def test_17_check_profile_targets(self):
+        resp = self.c.check_profile_targets(self.DUMMY_PROFILE_PAYLOAD)
+        self.assertTrue(resp['status'])
+        self.assertEqual(resp['missing'], {
+            'users': ['unknownuser'],
+            'groups': [],
+            'hosts': ['unknownhost'],
+            'hostgroups': ['unknowngroup'],
+        })
+
+    def test_17_search_directory(self):
+        resp = self.c.search_directory('users', 'ad')
+        self.assertTrue(resp['status'])
+        self.assertEqual(resp['data'], ['admin'])
+        resp = self.c.search_directory('hostgroups', 'server')
+        self.assertEqual(resp['data'], ['ipaservers'])
+        resp = self.c.search_directory('unknown', 'ad')
+        self.assertFalse(resp['status'])
+
     def test_18_get_goa_providers(self):
         resp = self.c.get_goa_providers()
         self.assertTrue(resp['status'])
@@ -450,5 +488,161 @@ class TestDbusService(unittest.TestCase):
         resp = self.c.is_session_active('')
         self.assertTrue(resp)
 
+    def test_20_refresh_profiles(self):
+        # Get profiles to fill local cache
+        resp = self.c.get_profiles()
+        self.assertTrue(resp['status'])
+        self.assertEqual(resp['data'], [])
+        # Saving a profile discards cached data
+        resp = self.c.save_profile(self.DUMMY_PROFILE_PAYLOAD)
+        resp = self.c.get_profiles()
+        self.assertEqual(resp['data'], [[
+            self.DUMMY_PROFILE_NAME,
+            self.DUMMY_PROFILE_PAYLOAD['description']
+        ]])
+        # Explicit refresh
+        resp = self.c.refresh_profiles()
+        self.assertTrue(resp['status'])
+        resp = self.c.get_profile(self.DUMMY_PROFILE_NAME)
+        self.assertTrue(resp['status'])
+        # Deleting a profile discards cached data
+        resp = self.c.delete_profile(self.DUMMY_PROFILE_NAME)
+        resp = self.c.get_profiles()
+        self.assertEqual(resp['data'], [])
+        resp = self.c.get_profile(self.DUMMY_PROFILE_NAME)
+        self.assertFalse(resp['status'])
+
+    def test_21_session_save_concurrent(self):
+        # Create a profile and get its settings revision
+        resp = self.c.save_profile(self.DUMMY_PROFILE_PAYLOAD)
+        resp = self.c.get_profile(self.DUMMY_PROFILE_NAME)
+        revision = resp['revision']
+        # Configure hypervisor
+        self.configure_hypervisor()
+        # Start a session
+        self.c.session_start(self.TEMPLATE_UUID)
+
+        # Other session saves changes in the meantime
+        resp = self.c.session_save(self.DUMMY_PROFILE_NAME, {
+            'org.gnome.gsettings': [
+                {'key': '/foo/bar', 'value': False, 'signature': 'b'},
+                {'key': '/foo/baz', 'value': 1, 'signature': 'i'},
+            ]
+        })
+        self.assertEqual(resp['conflicts'], [])
+
+        # Save session started from the previous revision
+        resp = self.c.session_save(self.DUMMY_PROFILE_NAME, {
+            'org.gnome.gsettings': [
+                {'key': '/foo/bar', 'value': True, 'signature': 'b'},
+            ]
+        }, revision)
+        self.assertTrue(resp['status'])
+        self.assertEqual(len(resp['conflicts']), 1)
+        conflict = resp['conflicts'][0]
+        self.assertEqual(conflict['namespace'], 'org.gnome.gsettings')
+        self.assertEqual(conflict['key'], '/foo/bar')
+        self.assertEqual(conflict['base'], None)
+        self.assertEqual(conflict['stored']['value'], False)
+        self.assertEqual(conflict['incoming']['value'], True)
+
+        # Changes from both sessions are kept
+        gsettings = self.get_profile_data(
+            self.DUMMY_PROFILE_NAME)['settings']['org.gnome.gsettings']
+        self.assertEqual(len(gsettings), 2)
+        self.assertEqual(gsettings[0]['value'], True)
+        self.assertEqual(gsettings[1]['key'], '/foo/baz')
+
+    def test_22_ipa_metrics(self):
+        self.c.get_profiles()
+        resp = self.c.get_ipa_metrics()
+        self.assertTrue(resp['status'])
+        self.assertTrue(resp['connected'])
+        stats = resp['commands']['deskprofile_find']
+        self.assertEqual(stats['calls'], 1)
+        self.assertEqual(stats['errors'], 0)
+
+    def test_23_heartbeat_during_slow_save(self):
+        # Restart service with a slow IPA server
+        self.service.kill()
+        self.service.wait()
+        env = os.environ.copy()
+        env['FC_TEST_IPA_LATENCY'] = '0.5'
+        self.start_service(env)
+
+        def heartbeat_latency():
+            start = time.time()
+            self.assertTrue(self.c.heartbeat())
+            return time.time() - start
+
+        baseline = max([heartbeat_latency() for i in range(5)])
+
+        # Save profile from another connection
+        results = []
+
+        def save_profile():
+            client = fcdbus.FleetCommanderDbusClient(
+                dbus.SessionBus(private=True))
+            results.append(client.save_profile(self.DUMMY_PROFILE_PAYLOAD))
+        thread = threading.Thread(target=save_profile)
+        start = time.time()
+        thread.start()
+
+        latencies = []
+        while thread.is_alive():
+            latencies.append(heartbeat_latency())
+            time.sleep(0.05)
+        thread.join()
+        elapsed = time.time() - start
+
+        # Saving took several slow IPA commands
+        self.assertTrue(results[0]['status'])
+        self.assertTrue(elapsed > 1)
+        # Heartbeats were answered meanwhile without waiting for them
+        self.assertTrue(len(latencies) > 5)
+        self.assertTrue(max(latencies) < baseline + 0.25)
+
+    def test_24_parallel_session_saves(self):
+        # Restart service with a slow IPA server
+        self.service.kill()
+        self.service.wait()
+        env = os.environ.copy()
+        env['FC_TEST_IPA_LATENCY'] = '0.2'
+        self.start_service(env)
+
+        resp = self.c.save_profile(self.DUMMY_PROFILE_PAYLOAD)
+        revision = self.c.get_profile(self.DUMMY_PROFILE_NAME)['revision']
+        self.configure_hypervisor()
+        self.c.session_start(self.TEMPLATE_UUID)
+
+        # Two sessions started from the same revision save at once
+        results = []
+
+        def session_save(key):
+            client = fcdbus.FleetCommanderDbusClient(
+                dbus.SessionBus(private=True))
+            results.append(client.session_save(self.DUMMY_PROFILE_NAME, {
+                'org.gnome.gsettings': [
+                    {'key': key, 'value': True, 'signature': 'b'},
+                ]
+            }, revision))
+        threads = [
+            threading.Thread(target=session_save, args=(key,))
+            for key in ('/foo/bar', '/foo/baz')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 2)
+        for resp in results:
+            self.assertTrue(resp['status'])
+            self.assertEqual(resp['conflicts'], [])
+        # Changes from both sessions are kept
+        gsettings = self.get_profile_data(
+            self.DUMMY_PROFILE_NAME)['settings']['org.gnome.gsettings']
+        self.assertEqual(
+            [change['key'] for change in gsettings], ['/foo/bar', '/foo/baz'])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,338 @@
+#!./python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+"""
+Benchmark suite for fleetcommander.database
+
+Results are written as JSON so runs can be compared between revisions:
+
+    TOPSRCDIR=.. ./benchmark_database.py --output results.json
+"""
+
+# Python imports
+import sys
+import os
+import json
+import platform
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+
+PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
+sys.path.append(PYTHONPATH)
+
+from fleetcommander.database import DBManager, STORAGE_PROFILES
+from fleetcommander.database import SCHEMA_VERSION
+from fleetcommander.database import encode_value, decode_value, MarshalCodec
+
+DEFAULT_SIZES = [10, 1000, 100000]
+
+# Maximum number of timed operations per benchmark
+OPERATIONS = 2000
+COMMIT_OPERATIONS = 200
+THREAD_OPERATIONS = 2000
+
+# Fixed seed so every run looks up the same keys
+RANDOM_SEED = 42
+
+HYPERVISOR = {
+    'host': 'myhost',
+    'username': 'valid_user',
+    'mode': 'session',
+    'keys': 'myhost ssh-rsa KEY',
+}
+
+VALUE_FACTORIES = {
+    'scalar': lambda i: i,
+    'serialized': lambda i: {'key': '/foo/bar%s' % i, 'value': [i, 'baz']},
+}
+
+
+class Timer(object):
+    """
+    Context manager measuring elapsed wall time
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+
+
+def result(name, operations, elapsed, **parameters):
+    """
+    Builds a benchmark result entry
+    """
+    entry = {
+        'name': name,
+        'operations': operations,
+        'seconds': elapsed,
+        'ops_per_second': operations / elapsed if elapsed else None,
+    }
+    entry.update(parameters)
+    return entry
+
+
+def populate(path, size, valuetype):
+    """
+    Creates a database with given number of keys in config table
+    """
+    db = DBManager(path, storage_profile='wal')
+    factory = VALUE_FACTORIES[valuetype]
+    with db.config.batch():
+        for i in range(size):
+            db.config['key%s' % i] = factory(i)
+    db.close()
+
+
+def bench_dictionary(tmpdir, size, valuetype):
+    """
+    Measures SQLiteDict operations on a table of given size
+    """
+    results = []
+    parameters = {'size': size, 'type': valuetype}
+    path = os.path.join(tmpdir, 'dict-%s-%s.db' % (size, valuetype))
+    populate(path, size, valuetype)
+    factory = VALUE_FACTORIES[valuetype]
+    rand = random.Random(RANDOM_SEED)
+    operations = min(size, OPERATIONS)
+    commits = min(size, COMMIT_OPERATIONS)
+    keys = ['key%s' % rand.randrange(size) for i in range(operations)]
+
+    with Timer() as t:
+        db = DBManager(path, storage_profile='wal', cache=False)
+    results.append(result('startup', 1, t.elapsed, **parameters))
+
+    with Timer() as t:
+        for key in keys:
+            db.config[key]
+    results.append(result('get', operations, t.elapsed, **parameters))
+
+    with Timer() as t:
+        for key in keys:
+            key in db.config
+    results.append(result('contains', operations, t.elapsed, **parameters))
+
+    with Timer() as t:
+        for key in keys:
+            'missing-' + key in db.config
+    results.append(
+        result('contains_missing', operations, t.elapsed, **parameters))
+
+    with Timer() as t:
+        count = 0
+        for item in db.config.iteritems():
+            count += 1
+    results.append(result('items', count, t.elapsed, **parameters))
+
+    with Timer() as t:
+        for i, key in enumerate(keys[:commits]):
+            db.config[key] = factory(i)
+    results.append(result('set', commits, t.elapsed, **parameters))
+
+    with Timer() as t:
+        with db.config.batch():
+            for i, key in enumerate(keys):
+                db.config[key] = factory(i)
+    results.append(result('set_batch', operations, t.elapsed, **parameters))
+
+    deleted = set(keys[:commits])
+    with Timer() as t:
+        for key in deleted:
+            del(db.config[key])
+    results.append(result('delete', len(deleted), t.elapsed, **parameters))
+    db.close()
+
+    db = DBManager(path, storage_profile='wal', cache=True)
+    for key in keys:
+        db.config.get(key)
+    with Timer() as t:
+        for key in keys:
+            db.config.get(key)
+    results.append(result('get_cached', operations, t.elapsed, **parameters))
+    db.close()
+    return results
+
+
+def bench_session_reads(tmpdir):
+    """
+    Emulates the configuration reads done by session handling methods
+
+    Session uuid and port are ephemeral keys, only kept in memory, so
+    stored keys are read instead.
+    """
+    results = []
+    path = os.path.join(tmpdir, 'session.db')
+    for label, kwargs in (
+            ('uncached', {'cache': False}),
+            ('cached', {'cache': True}),
+            ('cached_external', {
+                'cache': True, 'check_external_changes': True})):
+        db = DBManager(path, **kwargs)
+        db.config.update({
+            'hypervisor': HYPERVISOR,
+            'ipa_server': 'ipa.example.com',
+        })
+        with Timer() as t:
+            for i in range(OPERATIONS):
+                'hypervisor' in db.config
+                db.config['hypervisor']
+                db.config.get('ipa_server', None)
+                db.config['ipa_server']
+        db.close()
+        results.append(
+            result('session_reads', OPERATIONS * 4, t.elapsed, cache=label))
+    return results
+
+
+def bench_storage_profiles(tmpdir):
+    """
+    Measures commit latency for each storage profile
+    """
+    results = []
+    for storage_profile in sorted(STORAGE_PROFILES.keys()):
+        path = os.path.join(tmpdir, 'commits-%s.db' % storage_profile)
+        db = DBManager(path, storage_profile=storage_profile)
+        with Timer() as t:
+            for i in range(COMMIT_OPERATIONS):
+                db.config['counter'] = i
+        db.close()
+        results.append(result(
+            'commit', COMMIT_OPERATIONS, t.elapsed,
+            storage_profile=storage_profile))
+    return results
+
+
+def bench_threads(tmpdir):
+    """
+    Measures config operations done from several threads
+    """
+    results = []
+    for threads in (1, 4, 16):
+        path = os.path.join(tmpdir, 'threads-%s.db' % threads)
+        db = DBManager(path, storage_profile='wal')
+        db.config['hypervisor'] = HYPERVISOR
+
+        def worker(number):
+            for i in range(THREAD_OPERATIONS):
+                if i % 10 == 0:
+                    db.config['thread-%s' % number] = i
+                else:
+                    db.config['hypervisor']
+
+        workers = [threading.Thread(target=worker, args=(n,))
+                   for n in range(threads)]
+        with Timer() as t:
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join()
+        db.close()
+        results.append(result(
+            'threads', threads * THREAD_OPERATIONS, t.elapsed,
+            threads=threads))
+    return results
+
+
+def bench_codecs():
+    """
+    Measures stored size and decoding rate of a large profile per codec
+    """
+    profile = {
+        'name': 'Profile',
+        'settings': {
+            'org.gnome.gsettings': [{
+                'key': '/org/gnome/desktop/key%s' % i,
+                'schema': 'org.gnome.desktop',
+                'value': 'value%s' % i,
+                'signature': 's',
+            } for i in range(1000)],
+        },
+    }
+    results = []
+    for codec, threshold in (('json', None), ('json', 0),
+                             (MarshalCodec.NAME, None),
+                             (MarshalCodec.NAME, 0)):
+        data, chain = encode_value(profile, codec, threshold)
+        operations = 200
+        with Timer() as t:
+            for i in range(operations):
+                decode_value(data, chain)
+        entry = result('decode', operations, t.elapsed, codec=chain)
+        entry['bytes'] = len(data)
+        results.append(entry)
+    return results
+
+
+def main():
+    parser = ArgumentParser(description='Fleet Commander database benchmark')
+    parser.add_argument(
+        '--sizes', action='store', default=None,
+        help='Comma separated table sizes (default: %s)' % ','.join(
+            [str(size) for size in DEFAULT_SIZES]))
+    parser.add_argument(
+        '--output', action='store', default=None,
+        help='Write JSON results to given file instead of standard output')
+    args = parser.parse_args()
+
+    sizes = DEFAULT_SIZES
+    if args.sizes:
+        sizes = [int(size) for size in args.sizes.split(',')]
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'schema_version': SCHEMA_VERSION,
+        'results': [],
+    }
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for size in sizes:
+            for valuetype in sorted(VALUE_FACTORIES.keys()):
+                report['results'].extend(
+                    bench_dictionary(tmpdir, size, valuetype))
+        report['results'].extend(bench_session_reads(tmpdir))
+        report['results'].extend(bench_storage_profiles(tmpdir))
+        report['results'].extend(bench_threads(tmpdir))
+        report['results'].extend(bench_codecs())
+    finally:
+        shutil.rmtree(tmpdir)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output)
+            fd.close()
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
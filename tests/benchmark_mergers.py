@@ -0,0 +1,420 @@
+#!./python-wrapper.sh
+# -*- coding: utf-8 -*-
+# vi:ts=2 sw=2 sts=2
+
+# Copyright (C) 2015 Red Hat, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the licence, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, see <http://www.gnu.org/licenses/>.
+#
+# Authors: Alberto Ruiz <aruiz@redhat.com>
+#          Oliver Gutiérrez <ogutierrez@redhat.com>
+
+"""
+Benchmark suite for fleetcommander.mergers
+
+Results are written as JSON so runs can be compared between revisions:
+
+    TOPSRCDIR=.. ./benchmark_mergers.py --output results.json
+"""
+
+# Python imports
+import sys
+import os
+import copy
+import json
+import logging
+import platform
+import random
+import resource
+import subprocess
+import time
+from argparse import ArgumentParser
+
+PYTHONPATH = os.path.join(os.environ['TOPSRCDIR'], 'admin')
+sys.path.append(PYTHONPATH)
+
+from fleetcommander import mergers
+
+DEFAULT_SIZES = [1000, 50000]
+
+# Fixed seed so every run merges the same trees
+RANDOM_SEED = 42
+
+# Tree shape
+FOLDER_RATIO = 0.1
+MAX_CHILDREN = 20
+
+# Random changesets for fuzzing and merge throughput
+DEFAULT_CHANGESET_SIZE = 100
+DEFAULT_DEPTH = 3
+DEFAULT_ITERATIONS = 200
+MERGE_OPERATIONS = 200
+
+
+class Timer(object):
+    """
+    Context manager measuring elapsed wall time
+    """
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+
+
+def result(name, operations, elapsed, **parameters):
+    """
+    Builds a benchmark result entry
+    """
+    entry = {
+        'name': name,
+        'operations': operations,
+        'seconds': elapsed,
+        'ops_per_second': operations / elapsed if elapsed else None,
+    }
+    entry.update(parameters)
+    return entry
+
+
+def generate_bookmarks(size, rand, prefix=''):
+    """
+    Generates a bookmark tree with given number of nodes
+    """
+    root = []
+    pending = [root]
+    for i in range(size):
+        level = pending[rand.randrange(len(pending))]
+        if rand.random() < FOLDER_RATIO:
+            elem = {'name': '%sfolder%s' % (prefix, i), 'children': []}
+            pending.append(elem['children'])
+        else:
+            elem = {
+                'name': '%sbookmark%s' % (prefix, i),
+                'url': 'https://%s%s.example.com/' % (prefix, i),
+            }
+        level.append(elem)
+        if len(level) >= MAX_CHILDREN and len(pending) > 1:
+            pending.remove(level)
+    return root
+
+
+def generate_value(rand, depth):
+    """
+    Generates a random JSON value nested up to given depth
+    """
+    if depth <= 0 or rand.random() < 0.5:
+        return rand.choice([
+            rand.randint(0, 100),
+            'value%s' % rand.randint(0, 100),
+            rand.random() < 0.5,
+        ])
+    return dict([
+        ('item%s' % i, generate_value(rand, depth - 1))
+        for i in range(rand.randint(1, 3))])
+
+
+def generate_gsettings_change(rand, key, depth):
+    return {
+        'key': '/org/example/key%s' % key,
+        'schema': 'org.example',
+        'value': json.dumps(generate_value(rand, depth)),
+        'signature': 's',
+    }
+
+
+def generate_nm_change(rand, key, depth):
+    return {
+        'uuid': 'connection-uuid-%s' % key,
+        'type': rand.choice(['vpn', 'wifi', '802-3-ethernet']),
+        'id': 'Connection %s' % key,
+        'data': 'ENCODED CONNECTION DATA %s' % rand.randint(0, 100),
+    }
+
+
+def generate_chromium_change(rand, key, depth):
+    if key == 0:
+        return {
+            'key': 'ManagedBookmarks',
+            'value': generate_bookmarks(rand.randint(1, 20), rand),
+        }
+    return {
+        'key': 'Policy%s' % key,
+        'value': generate_value(rand, depth),
+    }
+
+
+def generate_firefox_change(rand, key, depth):
+    return {
+        'key': 'example.preference.%s' % key,
+        'value': generate_value(rand, depth),
+    }
+
+
+# Merger classes and change generators fuzzed and benchmarked
+MERGERS = {
+    'gsettings': (mergers.GSettingsChangeMerger, generate_gsettings_change),
+    'networkmanager': (
+        mergers.NetworkManagerChangeMerger, generate_nm_change),
+    'chromium': (mergers.ChromiumChangeMerger, generate_chromium_change),
+    'firefox': (mergers.FirefoxChangeMerger, generate_firefox_change),
+}
+
+
+def generate_changeset(rand, generator, size, depth):
+    """
+    Generates a changeset with keys taken from a space twice its size, so
+    changesets generated together partially overlap
+    """
+    keys = rand.sample(range(size * 2), size)
+    return [generator(rand, key, depth) for key in keys]
+
+
+def peak_memory():
+    """
+    Returns peak resident memory of this process in kilobytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def count_nodes(bookmarks):
+    count = 0
+    for elem in bookmarks:
+        count += 1
+        if 'children' in elem:
+            count += count_nodes(elem['children'])
+    return count
+
+
+def bench_bookmarks(size):
+    """
+    Merges two partially overlapping bookmark trees of given size
+    """
+    results = []
+    rand = random.Random(RANDOM_SEED)
+    stored = generate_bookmarks(size, rand)
+    # Incoming tree shares every folder and leaf with the stored one and
+    # adds the same amount of new nodes
+    incoming = copy.deepcopy(stored) + generate_bookmarks(size, rand, 'new-')
+    nodes = count_nodes(stored) + count_nodes(incoming)
+    merger = mergers.ChromiumChangeMerger()
+
+    with Timer() as t:
+        merged = merger.merge_bookmarks(stored, incoming)
+    results.append(result('merge_bookmarks', nodes, t.elapsed, size=size))
+
+    incoming_copy = copy.deepcopy(incoming)
+    with Timer() as t:
+        merger.merge_bookmarks(merged, incoming_copy)
+    results.append(
+        result('merge_bookmarks_idempotent', nodes, t.elapsed, size=size))
+
+    changesets = [
+        [{'key': 'ManagedBookmarks', 'value': copy.deepcopy(stored)}],
+        [{'key': 'ManagedBookmarks', 'value': incoming}],
+    ]
+    with Timer() as t:
+        merger.merge(*changesets)
+    results.append(result('merge', nodes, t.elapsed, size=size))
+    return results
+
+
+def bench_tracing(size):
+    """
+    Compares bookmark merges with tracing disabled and enabled
+    """
+    results = []
+    rand = random.Random(RANDOM_SEED)
+    stored = generate_bookmarks(size, rand)
+    incoming = copy.deepcopy(stored) + generate_bookmarks(size, rand, 'new-')
+    nodes = count_nodes(stored) + count_nodes(incoming)
+    merger = mergers.ChromiumChangeMerger()
+    logger = logging.getLogger()
+    # Emitted events are formatted and written, as they would be to a log
+    stream = open(os.devnull, 'w')
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(
+        '[%(levelname)s] %(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    level = logger.level
+    try:
+        for tracing, loglevel in (('off', logging.DEBUG),
+                                  ('on', logging.INFO),
+                                  ('on_emitted', logging.DEBUG)):
+            logger.setLevel(loglevel)
+            merger.set_tracing(tracing != 'off')
+            with Timer() as t:
+                merger.merge_bookmarks(stored, incoming)
+            results.append(result(
+                'merge_bookmarks_tracing', nodes, t.elapsed, size=size,
+                tracing=tracing, debug=loglevel == logging.DEBUG))
+    finally:
+        merger.set_tracing(False)
+        logger.setLevel(level)
+        logger.removeHandler(handler)
+        stream.close()
+    return results
+
+
+def fuzz_merger(name, size, depth, iterations):
+    """
+    Checks merge invariants on random changesets
+
+    Merging a changeset with itself must be the same as merging it alone
+    (idempotence) and merge must be associative. Inputs are copied for
+    every merge as merges may modify them.
+    """
+    merger_class, generator = MERGERS[name]
+    merger = merger_class()
+    failures = {'idempotence': [], 'associativity': []}
+
+    def merge(*changesets):
+        return merger.merge(*copy.deepcopy(changesets))
+
+    for iteration in range(iterations):
+        seed = RANDOM_SEED + iteration
+        rand = random.Random(seed)
+        a, b, c = [generate_changeset(rand, generator, size, depth)
+                   for i in range(3)]
+        if merge(a, a) != merge(a):
+            failures['idempotence'].append(seed)
+        if merge(merge(a, b), c) != merge(a, merge(b, c)):
+            failures['associativity'].append(seed)
+
+    entry = {
+        'name': 'fuzz',
+        'merger': name,
+        'size': size,
+        'depth': depth,
+        'iterations': iterations,
+        'failures': dict([(invariant, len(seeds))
+                          for invariant, seeds in failures.items()]),
+        'failed_seeds': failures,
+    }
+    return entry
+
+
+def bench_merger(name, size, depth):
+    """
+    Measures merges per second of two random changesets of given size
+
+    Peak memory is that of the whole process, so it is only meaningful
+    when run in a process of its own. See run_bench_merger().
+    """
+    merger_class, generator = MERGERS[name]
+    merger = merger_class()
+    baseline = peak_memory()
+    rand = random.Random(RANDOM_SEED)
+    inputs = [
+        (generate_changeset(rand, generator, size, depth),
+         generate_changeset(rand, generator, size, depth))
+        for i in range(MERGE_OPERATIONS)]
+    with Timer() as t:
+        for stored, incoming in inputs:
+            merger.merge(stored, incoming)
+    entry = result(
+        'merge_changesets', MERGE_OPERATIONS, t.elapsed, merger=name,
+        size=size, depth=depth)
+    entry['peak_memory_kb'] = peak_memory()
+    entry['baseline_memory_kb'] = baseline
+    return entry
+
+
+def run_bench_merger(name, size, depth):
+    """
+    Runs bench_merger() in a new process, so peak memory of each merger
+    is not hidden by that of previous benchmarks
+    """
+    process = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), '--merger', name,
+        '--changeset-size', str(size), '--depth', str(depth),
+    ], stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        raise Exception('Benchmark of %s merger failed' % name)
+    return json.loads(output)
+
+
+def main():
+    parser = ArgumentParser(description='Fleet Commander mergers benchmark')
+    parser.add_argument(
+        '--sizes', action='store', default=None,
+        help='Comma separated tree sizes (default: %s)' % ','.join(
+            [str(size) for size in DEFAULT_SIZES]))
+    parser.add_argument(
+        '--changeset-size', action='store', type=int,
+        default=DEFAULT_CHANGESET_SIZE,
+        help='Number of changes in random changesets (default: %s)' % (
+            DEFAULT_CHANGESET_SIZE))
+    parser.add_argument(
+        '--depth', action='store', type=int, default=DEFAULT_DEPTH,
+        help='Maximum nesting of random change values (default: %s)' % (
+            DEFAULT_DEPTH))
+    parser.add_argument(
+        '--iterations', action='store', type=int,
+        default=DEFAULT_ITERATIONS,
+        help='Number of fuzzing iterations per merger (default: %s)' % (
+            DEFAULT_ITERATIONS))
+    parser.add_argument(
+        '--output', action='store', default=None,
+        help='Write JSON results to given file instead of standard output')
+    parser.add_argument(
+        '--merger', action='store', default=None, choices=sorted(MERGERS),
+        help='Only benchmark merges of given merger')
+    args = parser.parse_args()
+
+    if args.merger:
+        print json.dumps(bench_merger(
+            args.merger, args.changeset_size, args.depth))
+        return
+
+    sizes = DEFAULT_SIZES
+    if args.sizes:
+        sizes = [int(size) for size in args.sizes.split(',')]
+
+    report = {
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'results': [],
+    }
+    for size in sizes:
+        report['results'].extend(bench_bookmarks(size))
+        report['results'].extend(bench_tracing(size))
+
+    failed = False
+    for name in sorted(MERGERS.keys()):
+        report['results'].append(
+            run_bench_merger(name, args.changeset_size, args.depth))
+        entry = fuzz_merger(
+            name, args.changeset_size, args.depth, args.iterations)
+        failed = failed or any(entry['failures'].values())
+        report['results'].append(entry)
+    report['peak_memory_kb'] = peak_memory()
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as fd:
+            fd.write(output)
+            fd.close()
+    else:
+        print output
+
+    # Invariant violations make the run fail
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,6 +20,7 @@
 #          Oliver Gutiérrez <ogutierrez@redhat.com>
 
 import os
+import time
 import logging
 import json
 import base64
@@ -84,17 +85,26 @@ class FreeIPAErrors(object):
     class ValidationError(Exception):
         pass
 
+    class NetworkError(Exception):
+        pass
+
 
 class FreeIPARPCClient(object):
 
-    @staticmethod
-    def isconnected():
-        return True
+    connected = False
 
-    @staticmethod
-    def connect():
+    @classmethod
+    def isconnected(cls):
+        return cls.connected
+
+    @classmethod
+    def connect(cls):
         logging.debug('Mocking IPA connection')
-        return
+        cls.connected = True
+
+    @classmethod
+    def disconnect(cls):
+        cls.connected = False
 
 
 class FreeIPABackend(object):
@@ -105,9 +115,42 @@ class FreeIPACommand(object):
 
     data = None
 
+    # Seconds taken by every command, to simulate a slow server
+    latency = 0
+
+    def __getattribute__(self, name):
+        attr = object.__getattribute__(self, name)
+        latency = object.__getattribute__(self, 'latency')
+        if not latency or name.startswith('_') or not callable(attr):
+            return attr
+
+        def command(*args, **kwargs):
+            time.sleep(latency)
+            return attr(*args, **kwargs)
+        return command
+
     def ping(self):
         return
 
+    def batch(self, *methods):
+        results = []
+        for method in methods:
+            args, options = method['params']
+            try:
+                result = getattr(self, method['method'])(*args, **options)
+                result = dict(result or {})
+                result['error'] = None
+            except Exception, e:
+                result = {
+                    'error': unicode(e),
+                    'error_name': e.__class__.__name__,
+                }
+            results.append(result)
+        return {
+            u'count': len(results),
+            u'results': results,
+        }
+
     def deskprofileconfig_show(self):
         return {
             'result': {
@@ -152,21 +195,33 @@ class FreeIPACommand(object):
         else:
             raise FreeIPAErrors.NotFound()
 
-    def host_find(self, sizelimit):
-        count = len(self.data.hosts)
+    def _find(self, names, attribute, kind):
+        count = len(names)
         result = []
-        for host in self.data.hosts:
+        for name in names:
             result.append({
-                'fqdn': (host,)
+                attribute: (name,)
             })
         res = {
             u'count': count,
-            u'summary': u'%s Hosts matched' % count,
+            u'summary': u'%s %s matched' % (count, kind),
             u'result': tuple(result),
             u'truncated': False
         }
         return res
 
+    def user_find(self, sizelimit, pkey_only=False):
+        return self._find(self.data.users, 'uid', 'users')
+
+    def group_find(self, sizelimit, pkey_only=False):
+        return self._find(self.data.groups, 'cn', 'groups')
+
+    def host_find(self, sizelimit, pkey_only=False):
+        return self._find(self.data.hosts, 'fqdn', 'hosts')
+
+    def hostgroup_find(self, sizelimit, pkey_only=False):
+        return self._find(self.data.hostgroups, 'cn', 'hostgroups')
+
     def host_show(self, host):
         if host in self.data.hosts:
             return {
@@ -220,10 +275,13 @@ class FreeIPACommand(object):
             }
 
     @FreeIPAData.export_data
-    def deskprofile_mod(self, cn, description, ipadeskdata):
+    def deskprofile_mod(self, cn, description, ipadeskdata, rename=None):
         if cn in self.data.profiles:
             self.data.profiles[cn]['description'] = (unicode(description),)
             self.data.profiles[cn]['ipadeskdata'] = (unicode(ipadeskdata),)
+            if rename is not None:
+                self.data.profiles[cn]['cn'] = (unicode(rename),)
+                self.data.profiles[rename] = self.data.profiles.pop(cn)
         else:
             raise FreeIPAErrors.NotFound()
 
@@ -316,50 +374,80 @@ class FreeIPACommand(object):
         else:
             raise FreeIPAErrors.NotFound()
 
-    def deskprofile_find(self, criteria, sizelimit, all):
+    def deskprofile_find(self, criteria, sizelimit, all=False,
+                         pkey_only=False):
         count = len(self.data.profiles.keys())
+        if pkey_only:
+            result = [{u'cn': (name,)} for name in self.data.profiles]
+        else:
+            result = [self._get_profile(name) for name in self.data.profiles]
         res = {
             u'count': count,
             u'summary': u'%s Desktop Profiles matched' % count,
-            u'result': tuple(self.data.profiles.values()),
+            u'result': tuple(result),
             u'truncated': False
         }
         return res
 
+    def _get_profile(self, name):
+        profile = self.data.profiles[name].copy()
+        profile['ipadeskdata'] = (base64.b64decode(profile['ipadeskdata'][0]),)
+        return profile
+
     def deskprofile_show(self, name, all):
         if name in self.data.profiles:
-            profile = self.data.profiles[name].copy()
-            profile['ipadeskdata'] = (base64.b64decode(profile['ipadeskdata'][0]),)
-            return {'result': profile}
+            return {'result': self._get_profile(name)}
         else:
             raise FreeIPAErrors.NotFound()
 
+    def deskprofilerule_find(self, criteria, sizelimit, all):
+        count = len(self.data.profilerules.keys())
+        result = []
+        for name in self.data.profilerules:
+            rule = self._get_profilerule(name)
+            rule['cn'] = (unicode(name),)
+            result.append(rule)
+        res = {
+            u'count': count,
+            u'summary': u'%s Desktop Profile Rules matched' % count,
+            u'result': tuple(result),
+            u'truncated': False
+        }
+        return res
+
     def deskprofilerule_show(self, name, all):
         if name in self.data.profilerules:
-            return {
-                'result': {
-                    'memberuser_user': sorted(
-                        self.data.profilerules[name]['users']),
-                    'memberuser_group': sorted(
-                        self.data.profilerules[name]['groups']),
-                    'memberhost_host': sorted(
-                        self.data.profilerules[name]['hosts']),
-                    'memberhost_hostgroup': sorted(
-                        self.data.profilerules[name]['hostgroups']),
-                    'ipadeskprofilepriority': (
-                        self.data.profilerules[name]['priority'],),
-                }
-            }
+            return {'result': self._get_profilerule(name)}
         else:
             raise FreeIPAErrors.NotFound()
 
+    def _get_profilerule(self, name):
+        result = {
+            'memberuser_user': sorted(
+                self.data.profilerules[name]['users']),
+            'memberuser_group': sorted(
+                self.data.profilerules[name]['groups']),
+            'memberhost_host': sorted(
+                self.data.profilerules[name]['hosts']),
+            'memberhost_hostgroup': sorted(
+                self.data.profilerules[name]['hostgroups']),
+            'ipadeskprofilepriority': (
+                self.data.profilerules[name]['priority'],),
+        }
+        if self.data.profilerules[name]['hostcategory'] is not None:
+            result['hostcategory'] = (
+                self.data.profilerules[name]['hostcategory'],)
+        return result
+
     @FreeIPAData.export_data
     def deskprofilerule_mod(self, cn,
                             ipadeskprofiletarget, ipadeskprofilepriority,
-                            hostcategory=None):
+                            hostcategory=None, rename=None):
         if cn in self.data.profilerules:
             self.data.profilerules[cn]['priority'] = ipadeskprofilepriority
             self.data.profilerules[cn]['hostcategory'] = hostcategory
+            if rename is not None:
+                self.data.profilerules[rename] = self.data.profilerules.pop(cn)
         else:
             raise FreeIPAErrors.NotFound()
 
@@ -99,10 +99,22 @@ class TestFleetCommanderDbusService(fcdbus.FleetCommanderDbusService):
             'tmp_session_destroy_timeout': 60,
             'auto_quit_timeout': 60,
             'default_profile_priority': 50,
+            'database_storage_profile': 'wal',
+            'profile_cache_ttl': 60,
+            'directory_cache_ttl': 300,
+            'ipa_keepalive_interval': 240,
+            'ipa_reconnect_max_backoff': 60,
+            'ipa_workers': 4,
+            'mergers_dir': os.path.join(test_directory, 'mergers'),
+            'profile_data_compression_threshold': None,
+            'profile_data_chunk_size': 0,
             # Force state directory
             'state_dir': test_directory,
         }
         freeipamock.FreeIPACommand.data = freeipamock.FreeIPAData(test_directory)
+        # Simulate a slow IPA server if requested
+        freeipamock.FreeIPACommand.latency = float(
+            os.environ.get('FC_TEST_IPA_LATENCY', 0))
 
         super(TestFleetCommanderDbusService, self).__init__(args)
         self.known_hosts_file = os.path.join(test_directory, 'known_hosts')